@@ -1,108 +1,2318 @@
 # cafe_cashier_bot.py
+import io
 import os
+import csv
+import re
+import sys
+import gzip
+import json
+import shutil
+import tempfile
+import hmac
+import time
+import signal
+import select
+import threading
+import uuid
+import multiprocessing
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import telebot
 from telebot import types
 import psycopg2
+import psycopg2.extensions
 from psycopg2 import Error
-from functools import wraps
-from datetime import datetime
+from psycopg2.pool import PoolError
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import receipts
 load_dotenv()
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DB_URI = os.environ.get("DB_URI")
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")
-print(BOT_TOKEN)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))
+# اتصالی که بیش از این مدت (ثانیه) بیکار مانده قبل از تحویل با SELECT 1 بررسی می‌شود
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))
+# تعداد ترد‌های پردازش آپدیت؛ آپدیت‌های یک چت همیشه به ترتیب پردازش می‌شوند
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "8"))
+# منو (محصولات و دسته‌ها) در حافظه نگه داشته می‌شود؛ TTL فقط پشتیبان NOTIFY است
+MENU_CACHE_TTL = float(os.environ.get("MENU_CACHE_TTL", "300"))
+MENU_CHANNEL = "menu_changed"
+# تعداد محصول در هر صفحهٔ انتخابگر محصول (کیبورد inline هنگام ثبت سفارش)
+PICKER_PAGE_SIZE = int(os.environ.get("PICKER_PAGE_SIZE", "8"))
+# صف آشپزخانه: چت‌هایی (ایستگاه‌ها) که سفارش‌های pending را زنده دریافت می‌کنند، با کاما جدا
+KITCHEN_CHAT_IDS = [int(x) for x in os.environ.get("KITCHEN_CHAT_IDS", "").replace(" ", "").split(",") if x]
+KITCHEN_DEBOUNCE = float(os.environ.get("KITCHEN_DEBOUNCE", "1"))
+KITCHEN_QUEUE_LIMIT = int(os.environ.get("KITCHEN_QUEUE_LIMIT", "20"))
+KITCHEN_MAX_AGE_HOURS = int(os.environ.get("KITCHEN_MAX_AGE_HOURS", "12"))
+ORDER_CHANNEL = "order_events"
+# حالت اجرا: polling یا webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")          # آدرس عمومی برای setWebhook (اختیاری)
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_BODY = 1024 * 1024
+# update_idهای اخیر برای کنار گذاشتن آپدیت‌هایی که تلگرام دوباره تحویل می‌دهد (تعداد، ثانیه)
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_TTL = float(os.environ.get("UPDATE_DEDUP_TTL", "900"))
+ORDERS_PAGE_SIZE = int(os.environ.get("ORDERS_PAGE_SIZE", "10"))
+# تغییر وضعیت گروهی: حداکثر تعداد کد سفارش در یک دستور و حداقل سن برای حالت «قدیمی‌تر از» (دقیقه)
+BULK_STATUS_MAX_IDS = int(os.environ.get("BULK_STATUS_MAX_IDS", "500"))
+BULK_STATUS_MIN_AGE = int(os.environ.get("BULK_STATUS_MIN_AGE", "10"))
+# پارتیشن‌های ماهانهٔ orders/order_items: چند ماه آینده از قبل ساخته شوند، ماه‌های قدیمی‌تر از
+# RETENTION جدا شوند (0 = هرگز) و اگر ARCHIVE_DIR تنظیم شده باشد بایگانی (csv.gz) و حذف شوند
+ORDER_PARTITION_MONTHS_AHEAD = int(os.environ.get("ORDER_PARTITION_MONTHS_AHEAD", "3"))
+ORDER_PARTITION_RETENTION_MONTHS = int(os.environ.get("ORDER_PARTITION_RETENTION_MONTHS", "0"))
+ORDER_PARTITION_CHECK_INTERVAL = float(os.environ.get("ORDER_PARTITION_CHECK_INTERVAL", str(6 * 3600)))
+ORDER_ARCHIVE_DIR = os.environ.get("ORDER_ARCHIVE_DIR")
+# کلیدهای تکرار سفارش (order_keys) بعد از این تعداد روز پاک می‌شوند
+ORDER_KEY_TTL_DAYS = int(os.environ.get("ORDER_KEY_TTL_DAYS", "30"))
+EXPORT_DIR = os.environ.get("EXPORT_DIR") or tempfile.gettempdir()
+# رسید تصویری سفارش: png (send_photo)، pdf (send_document) یا خالی برای غیرفعال کردن.
+# رندر در RECEIPT_WORKERS پروسه؛ بیش از RECEIPT_MAX_PENDING رسید در صف رد می‌شود
+RECEIPT_FORMAT = os.environ.get("RECEIPT_FORMAT", "png")
+RECEIPT_WORKERS = int(os.environ.get("RECEIPT_WORKERS", "2"))
+RECEIPT_MAX_PENDING = int(os.environ.get("RECEIPT_MAX_PENDING", "32"))
+RECEIPT_CACHE_SIZE = int(os.environ.get("RECEIPT_CACHE_SIZE", "256"))
+RECEIPT_TITLE = os.environ.get("RECEIPT_TITLE", "رسید سفارش")
+# فونت TTF با حروف فارسی (مثلاً Vazirmatn)؛ شکل‌دهی درست متن فارسی به libraqm در Pillow نیاز دارد
+RECEIPT_FONT = os.environ.get("RECEIPT_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+# محتوای QR؛ {id} با کد سفارش جایگزین می‌شود
+RECEIPT_QR = os.environ.get("RECEIPT_QR", "order:{id}")
+PRODUCT_IMPORT_MAX_BYTES = int(os.environ.get("PRODUCT_IMPORT_MAX_BYTES", str(2 * 1024 * 1024)))
+# صف ارسال پیام: محدودیت کلی و هر چت (پیام در ثانیه) طبق محدودیت‌های تلگرام
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.environ.get("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_LINGER = float(os.environ.get("OUTBOX_LINGER", "0.05"))
+TELEGRAM_MAX_TEXT = 4096
+# کنترل پذیرش: سهمیهٔ هر چت برای هر کلاس هندلر به شکل «کلاس=نرخ در ثانیه/ظرفیت».
+# default برای همهٔ پیام‌ها و callbackها؛ expensive علاوه بر آن برای لیست‌ها، گزارش‌ها و جستجوها
+RATE_LIMITS = {cls: (float(rate), int(burst)) for cls, rate, burst in
+               re.findall(r'(\w+)=([\d.]+)/(\d+)', os.environ.get("RATE_LIMITS", "default=3/15,expensive=0.5/5"))}
+# حداکثر هندلر expensive همزمان در کل ربات و مدت صبر در صف برای گرفتن نوبت (ثانیه)
+EXPENSIVE_CONCURRENCY = int(os.environ.get("EXPENSIVE_CONCURRENCY", "4"))
+EXPENSIVE_WAIT = float(os.environ.get("EXPENSIVE_WAIT", "3"))
+# ذخیرهٔ سشن‌ها: memory (یک نمونه) یا postgres (ماندگار و مشترک بین چند نمونهٔ ربات)
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2"))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", str(24 * 3600)))
+# مهلت پیش‌فرض پاسخ در هر مرحلهٔ گفتگو (ثانیه)؛ بعد از آن وضعیت گفتگو از سشن پاک می‌شود
+CONVERSATION_TIMEOUT = float(os.environ.get("CONVERSATION_TIMEOUT", "600"))
+# متریک‌ها با فرمت Prometheus روی http://METRICS_HOST:METRICS_PORT/metrics (0 = غیرفعال)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# کوئری‌های کندتر از این مقدار (ms) همراه با SQL و پارامترها چاپ می‌شوند (0 = غیرفعال)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))
 
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# ---------- متریک‌ها ----------
+# رجیستری ساده با خروجی متنی Prometheus؛ برچسب‌ها به صورت tuple مرتب‌شده کلید می‌شوند
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}      # labels -> [شمارش هر bucket, مجموع, تعداد]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            st = self._values.get(key)
+            if st is None:
+                st = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                st[0][i] += 1
+            st[1] += value
+            st[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, n) in self._values.items():
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    out.append((self.name + '_bucket', key + (('le', repr(float(bound))),), cumulative))
+                out.append((self.name + '_bucket', key + (('le', '+Inf'),), n))
+                out.append((self.name + '_sum', key, total))
+                out.append((self.name + '_count', key, n))
+        return out
+
+class GaugeFunc:
+    # مقدار هنگام scrape از fn خوانده می‌شود: عدد یا لیستی از (برچسب‌ها, مقدار)
+    def __init__(self, name, help, fn, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            return [(self.name, (), value)]
+        return [(self.name, tuple(sorted(labels.items())), v) for labels, v in value]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn, kind='gauge'):
+        return self._add(GaugeFunc(name, help, fn, kind))
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            try:
+                samples = m.samples()
+            except Exception as e:
+                print(f"خطا در خواندن متریک {m.name}:", e)
+                continue
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Handler latency")
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Exceptions escaping handlers, by type")
+HANDLER_QUERIES = metrics.histogram("bot_handler_queries", "Database queries per handler call", COUNT_BUCKETS)
+HANDLER_DB_SECONDS = metrics.histogram("bot_handler_db_seconds", "Time spent executing queries per handler call")
+DB_QUERY_SECONDS = metrics.histogram("bot_db_query_seconds", "Single query latency, by calling handler")
+DB_ERRORS = metrics.counter("bot_db_errors_total", "Failed queries, by error type")
+DB_SLOW_QUERIES = metrics.counter("bot_db_slow_queries_total", "Queries slower than SLOW_QUERY_MS")
+DB_CHECKOUT_SECONDS = metrics.histogram("bot_db_checkout_seconds", "Time waiting for a pooled connection")
+DB_CHECKOUT_ERRORS = metrics.counter("bot_db_checkout_errors_total", "Failed connection checkouts, by error type")
+TELEGRAM_SECONDS = metrics.histogram("bot_telegram_request_seconds", "Bot API request latency, by method")
+TELEGRAM_ERRORS = metrics.counter("bot_telegram_errors_total", "Failed Bot API requests, by method and type")
+UPDATES_DUPLICATE = metrics.counter("bot_updates_duplicate_total", "Redelivered updates skipped by update_id")
+ORDERS_DUPLICATE = metrics.counter("bot_orders_duplicate_total", "Order submissions answered from an existing idempotency key")
+RECEIPTS = metrics.counter("bot_receipts_total", "Receipt requests, by result (rendered, cached, rejected, error)")
+ORDER_PARTITIONS = metrics.counter("bot_order_partitions_total", "Order partition maintenance, by action (created, failed, detached, archived)")
+ADMISSION_REJECTED = metrics.counter("bot_admission_rejected_total", "Requests rejected by admission control, by limit and handler class")
+ADMISSION_WAIT_SECONDS = metrics.histogram("bot_admission_wait_seconds", "Time expensive handlers waited for a concurrency slot")
+RECEIPT_SECONDS = metrics.histogram("bot_receipt_seconds", "Receipt render time from submit to result, including queueing")
+
+# هندلر در حال اجرا در هر thread؛ کوئری‌ها به نام آن ثبت می‌شوند
+_handler_ctx = threading.local()
+
+def current_handler():
+    return getattr(_handler_ctx, 'name', None) or '-'
+
+def run_instrumented(name, fn, *args, **kwargs):
+    if getattr(_handler_ctx, 'name', None) is not None:
+        # هندلری که هندلر دیگری را صدا می‌زند جزو همان هندلر بیرونی حساب می‌شود
+        return fn(*args, **kwargs)
+    _handler_ctx.name = name
+    _handler_ctx.queries = 0
+    _handler_ctx.db_seconds = 0.0
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        HANDLER_ERRORS.inc(handler=name, type=type(e).__name__)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+        HANDLER_QUERIES.observe(_handler_ctx.queries, handler=name)
+        HANDLER_DB_SECONDS.observe(_handler_ctx.db_seconds, handler=name)
+        _handler_ctx.name = None
+
+def record_query(query, vars, elapsed):
+    handler = current_handler()
+    if handler != '-':
+        _handler_ctx.queries += 1
+        _handler_ctx.db_seconds += elapsed
+    DB_QUERY_SECONDS.observe(elapsed, handler=handler)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        DB_SLOW_QUERIES.inc(handler=handler)
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        params = repr(vars)
+        if len(params) > 500:
+            params = params[:500] + '...'
+        print(f"کوئری کند ({elapsed * 1000:.1f}ms، {handler}): {' '.join(str(query).split())} params={params}")
+
+def timed_telegram_request(method, url, **kwargs):
+    # CUSTOM_REQUEST_SENDER: همان درخواست پیش‌فرض telebot، به‌علاوهٔ زمان‌سنجی هر متد
+    api_method = url.rsplit('/', 1)[-1]
+    start = time.perf_counter()
+    try:
+        resp = telebot.apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception as e:
+        TELEGRAM_ERRORS.inc(method=api_method, type=type(e).__name__)
+        raise
+    finally:
+        TELEGRAM_SECONDS.observe(time.perf_counter() - start, method=api_method)
+    if resp.status_code != 200:
+        TELEGRAM_ERRORS.inc(method=api_method, type=f"http_{resp.status_code}")
+    return resp
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = timed_telegram_request
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# هندلرها مستقیم در ترد UpdateDispatcher اجرا می‌شوند (threaded=False)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
 # نگهداری سشن‌های لاگین و دادهٔ موقتی کاربران
-# ساختار پیشنهادی:
-# user_sessions = { chat_id: { "logged_in": True/False, "temp": {...} } }
-user_sessions = {}
+# ساختار هر سشن:
+# { "logged_in": True/False, "temp": {...}, "conv": {...} (گفتگوی جاری، بخش «گفتگوها») }
+class MemorySessionStore:
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, flush_interval=SESSION_FLUSH_INTERVAL):
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._last_seen = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _new(self):
+        return {"logged_in": False, "temp": {}}
+
+    def _load(self, chat_id):
+        return None
+
+    def _mark_dirty(self, chat_id):
+        pass
+
+    def refresh(self, chat_id):
+        # ابتدای هر آپدیت صدا زده می‌شود؛ در حافظه منبع دیگری برای سشن نیست
+        pass
+
+    def get(self, chat_id):
+        with self._lock:
+            sess = self._sessions.get(chat_id)
+        if sess is None:
+            # بارگذاری از backend بیرون از قفل انجام می‌شود
+            loaded = self._load(chat_id) or self._new()
+            with self._lock:
+                sess = self._sessions.setdefault(chat_id, loaded)
+        with self._lock:
+            self._last_seen[chat_id] = time.monotonic()
+        return sess
+
+    def save(self, chat_id):
+        # بعد از هر تغییر سشن صدا زده می‌شود تا در flush بعدی نوشته شود؛ خواندن سشن را dirty نمی‌کند
+        with self._lock:
+            self._mark_dirty(chat_id)
+
+    def reset(self, chat_id):
+        with self._lock:
+            self._sessions[chat_id] = self._new()
+            self._last_seen[chat_id] = time.monotonic()
+            self._mark_dirty(chat_id)
+
+    def expire(self):
+        # سشن‌هایی که بیش از idle_ttl بیکار بوده‌اند از حافظه حذف می‌شوند و
+        # گفتگوهای نیمه‌کاره‌ای که مهلتشان گذشته از سشن پاک می‌شوند
+        cutoff = time.monotonic() - self.idle_ttl
+        now = time.time()
+        with self._lock:
+            stale = [cid for cid, seen in self._last_seen.items() if seen < cutoff]
+            for cid in stale:
+                self._sessions.pop(cid, None)
+                self._last_seen.pop(cid, None)
+            for cid, sess in self._sessions.items():
+                conv = sess.get('conv')
+                if conv and conv.get('expires', 0) < now:
+                    sess.pop('conv', None)
+                    self._mark_dirty(cid)
+        return len(stale)
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _run(self):
+        last_expire = time.monotonic()
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.monotonic() - last_expire >= 30:
+                    self.expire()
+                    last_expire = time.monotonic()
+            except Exception as e:
+                print("خطا در نگهداری سشن‌ها:", repr(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sessions", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop_event.set()
+        self.flush()
+
+class PostgresSessionStore(MemorySessionStore):
+    # سشن‌ها در حافظه کش می‌شوند و تغییرات هر flush_interval ثانیه یک‌جا
+    # (یک دستور برای همهٔ چت‌های تغییرکرده) در جدول bot_sessions نوشته می‌شوند.
+    # چند نمونهٔ ربات می‌توانند از یک جدول استفاده کنند: هر ردیف version دارد، refresh در ابتدای هر
+    # آپدیت سشن کش‌شده را اگر نمونهٔ دیگری تغییرش داده دوباره می‌خواند، و flush فقط وقتی می‌نویسد که
+    # version ردیف همان نسخه‌ای باشد که این نمونه خوانده است؛ نوشتن کهنه رد و سشن از کش حذف می‌شود.
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, flush_interval=SESSION_FLUSH_INTERVAL):
+        super().__init__(idle_ttl, flush_interval)
+        self._dirty = set()
+        self._flushing = set()
+        self._versions = {}     # chat_id -> version ردیفی که کش از آن ساخته شده (0 = ردیف ندارد)
+
+    def _mark_dirty(self, chat_id):
+        self._dirty.add(chat_id)
+
+    def _fetch(self, chat_id, unless_version=None):
+        # (data, version)؛ data برای ردیف منقضی None است. با unless_version فقط اگر ردیف تغییر کرده باشد
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT CASE WHEN updated_at > now() - %s * interval '1 second' THEN data END, version
+                FROM bot_sessions
+                WHERE chat_id = %s AND version IS DISTINCT FROM %s
+            """, (self.idle_ttl, chat_id, unless_version))
+            row = cur.fetchone()
+            cur.close()
+        return row
+
+    def _load(self, chat_id):
+        try:
+            row = self._fetch(chat_id)
+        except Error as e:
+            print("خطا در بارگذاری سشن:", e)
+            return None
+        with self._lock:
+            self._versions.setdefault(chat_id, row[1] if row else 0)
+        return row[0] if row else None
+
+    def refresh(self, chat_id):
+        with self._lock:
+            if chat_id not in self._sessions or chat_id in self._dirty or chat_id in self._flushing:
+                # سشن کش نشده (get آن را می‌خواند) یا تغییر نوشته‌نشده دارد (flush تداخل را تشخیص می‌دهد)
+                return
+            version = self._versions.get(chat_id, 0)
+        try:
+            row = self._fetch(chat_id, version)
+        except Error as e:
+            print("خطا در بارگذاری سشن:", e)
+            return
+        if row is None:
+            return
+        with self._lock:
+            if self._versions.get(chat_id, 0) == version and chat_id not in self._dirty and chat_id not in self._flushing:
+                self._sessions[chat_id] = row[0] or self._new()
+                self._versions[chat_id] = row[1]
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for cid in dirty:
+                sess = self._sessions.get(cid)
+                if sess is None:
+                    continue
+                try:
+                    rows.append((cid, json.dumps(sess, ensure_ascii=False, default=str), self._versions.get(cid, 0)))
+                except RuntimeError:
+                    # سشن حین سریال‌سازی در حال تغییر بود؛ دور بعد نوشته می‌شود
+                    self._dirty.add(cid)
+            self._flushing.update(r[0] for r in rows)
+        if not rows:
+            return
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO bot_sessions (chat_id, data, updated_at, version)
+                    SELECT chat_id, data, now(), version + 1
+                    FROM unnest(%s::bigint[], %s::jsonb[], %s::bigint[]) AS s(chat_id, data, version)
+                    ON CONFLICT (chat_id) DO UPDATE
+                    SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at, version = EXCLUDED.version
+                    WHERE bot_sessions.version = EXCLUDED.version - 1
+                    RETURNING chat_id, version
+                """, ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]))
+                written = dict(cur.fetchall())
+                conn.commit()
+                cur.close()
+        except Error as e:
+            print("خطا در ذخیرهٔ سشن‌ها:", e)
+            with self._lock:
+                self._flushing.difference_update(r[0] for r in rows)
+                self._dirty.update(r[0] for r in rows)
+            return
+        with self._lock:
+            self._flushing.difference_update(r[0] for r in rows)
+            for cid, _, _ in rows:
+                if cid in written:
+                    self._versions[cid] = written[cid]
+                else:
+                    # نمونهٔ دیگری زودتر این سشن را نوشته است؛ تغییر این نمونه کنار گذاشته و
+                    # سشن در get بعدی از جدول خوانده می‌شود
+                    print(f"سشن چت {cid} در نمونهٔ دیگری تغییر کرده است؛ تغییر محلی نوشته نشد.")
+                    self._sessions.pop(cid, None)
+                    self._versions.pop(cid, None)
+                    self._dirty.discard(cid)
+
+    def expire(self):
+        removed = super().expire()
+        with self._lock:
+            for cid in [cid for cid in self._versions if cid not in self._sessions]:
+                del self._versions[cid]
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM bot_sessions WHERE updated_at < now() - %s * interval '1 second'", (self.idle_ttl,))
+                conn.commit()
+                cur.close()
+        except Error as e:
+            print("خطا در حذف سشن‌های منقضی:", e)
+        return removed
+
+def make_session_store(backend=SESSION_BACKEND):
+    if backend == "postgres":
+        return PostgresSessionStore()
+    if backend != "memory":
+        print(f"SESSION_BACKEND نامعتبر ({backend}) — از memory استفاده می‌شود.")
+    return MemorySessionStore()
+
+session_store = make_session_store()
 
 def ensure_session(chat_id):
-    if chat_id not in user_sessions:
-        user_sessions[chat_id] = {"logged_in": False, "temp": {}}
-    return user_sessions[chat_id]
+    return session_store.get(chat_id)
+
+def save_session(chat_id):
+    session_store.save(chat_id)
 
 def check_login(chat_id):
     sess = ensure_session(chat_id)
     return sess.get("logged_in", False)
 
-def login_required(func):
-    @wraps(func)
-    def wrapper(message, *args, **kwargs):
-        if not check_login(message.chat.id):
-            bot.send_message(message.chat.id, "لطفاً ابتدا وارد سیستم شوید.", reply_markup=login_menu())
+# ---------- کنترل پذیرش ----------
+# هر پیام یا callback یک توکن از باکت default چت و هندلرهای کلاس دیگر (مثل expensive) یک توکن
+# هم از باکت همان کلاس برمی‌دارند؛ هندلرهای expensive علاوه بر این فقط با گرفتن یکی از
+# EXPENSIVE_CONCURRENCY نوبت همزمان اجرا می‌شوند و حداکثر EXPENSIVE_WAIT ثانیه در صف می‌مانند.
+# درخواست ردشده اجرا نمی‌شود و کاربر (حداکثر هر ADMISSION_NOTICE_INTERVAL ثانیه یک بار) مطلع می‌شود.
+EXPENSIVE = 'expensive'
+ADMISSION_NOTICE_INTERVAL = 5.0
+ADMISSION_MAX_BUCKETS = 10000
+
+class AdmissionControl:
+    def __init__(self, limits=RATE_LIMITS, concurrency=EXPENSIVE_CONCURRENCY, wait=EXPENSIVE_WAIT):
+        self.limits = limits
+        self.concurrency = concurrency
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._buckets = {}      # (chat_id, class) -> TokenBucket
+        self._noticed = {}      # chat_id -> زمان آخرین پیام رد
+        self.inflight = 0
+
+    def _take(self, chat_id, cls):
+        limit = self.limits.get(cls)
+        if limit is None:
+            return True
+        with self._lock:
+            bucket = self._buckets.get((chat_id, cls))
+            if bucket is None:
+                if len(self._buckets) >= ADMISSION_MAX_BUCKETS:
+                    self._prune()
+                bucket = self._buckets[(chat_id, cls)] = TokenBucket(*limit)
+        return bucket.take()
+
+    def _prune(self):
+        # باکت پر با باکت تازه فرقی ندارد
+        for key in [k for k, b in self._buckets.items() if b.full()]:
+            del self._buckets[key]
+        now = time.monotonic()
+        for chat_id in [c for c, t in self._noticed.items() if now - t > ADMISSION_NOTICE_INTERVAL]:
+            del self._noticed[chat_id]
+
+    def _reject(self, chat_id, limit, cls, reject, text):
+        ADMISSION_REJECTED.inc(limit=limit, cls=cls)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._noticed.get(chat_id, -ADMISSION_NOTICE_INTERVAL) < ADMISSION_NOTICE_INTERVAL:
+                return None
+            self._noticed[chat_id] = now
+        reject(text)
+        return None
+
+    def run(self, chat_id, cls, reject, fn, *args):
+        # reject(text): پاسخ به کاربر وقتی درخواست رد می‌شود (پیام یا answer_callback_query)
+        if not self._take(chat_id, 'default'):
+            return self._reject(chat_id, 'chat', cls, reject, "پیام‌ها خیلی سریع ارسال می‌شوند؛ چند لحظه صبر کنید.")
+        if cls != 'default' and not self._take(chat_id, cls):
+            return self._reject(chat_id, 'class', cls, reject, "این درخواست را کمی بعد دوباره امتحان کنید.")
+        if cls != EXPENSIVE:
+            return fn(*args)
+        start = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.wait)
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, cls=cls)
+        if not acquired:
+            return self._reject(chat_id, 'concurrency', cls, reject, "سرور مشغول است؛ لحظاتی بعد دوباره تلاش کنید.")
+        with self._lock:
+            self.inflight += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+            self._slots.release()
+
+admission = AdmissionControl()
+metrics.gauge("bot_admission_expensive_inflight", "Expensive handlers currently running", lambda: admission.inflight)
+
+# ---------- مسیریابی آپدیت‌ها ----------
+# به‌جای ده‌ها فیلتر lambda که telebot یکی‌یکی امتحان می‌کند، متن دکمه‌ها، دستورها و
+# پیشوند callback_data در dict نگه داشته می‌شوند؛ هزینهٔ مسیریابی به تعداد منوها بستگی ندارد.
+# login=True (پیش‌فرض) یعنی مسیر فقط برای کاربر واردشده اجرا می‌شود؛ limit کلاس هندلر در
+# کنترل پذیرش است (default یا expensive).
+class Router:
+    def __init__(self, admission=None):
+        self.admission = admission
+        self.texts = {}
+        self.commands = {}
+        self.callbacks = {}
+        self.patterns = []      # (regex, handler, login, limit) — فقط برای ورودی‌هایی که متن ثابت ندارند
+        self.fallback = None
+
+    def _add(self, table, key, handler, login, limit):
+        if key in table:
+            raise ValueError(f"مسیر تکراری: {key}")
+        table[key] = (handler, login, limit)
+
+    def text(self, *texts, login=True, limit='default'):
+        def decorator(handler):
+            for text in texts:
+                self._add(self.texts, text, handler, login, limit)
+            return handler
+        return decorator
+
+    def command(self, *commands, login=False, limit='default'):
+        def decorator(handler):
+            for command in commands:
+                self._add(self.commands, command, handler, login, limit)
+            return handler
+        return decorator
+
+    def callback(self, prefix, login=True, limit='default'):
+        # callback_data به شکل «prefix:...»
+        def decorator(handler):
+            self._add(self.callbacks, prefix, handler, login, limit)
+            return handler
+        return decorator
+
+    def pattern(self, regex, login=True, limit='default'):
+        def decorator(handler):
+            self.patterns.append((re.compile(regex), handler, login, limit))
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self.fallback = handler
+        return handler
+
+    def resolve(self, text):
+        route = self.texts.get(text)
+        if route is not None:
+            return route
+        if text.startswith('/'):
+            parts = text[1:].split(None, 1)
+            route = self.commands.get(parts[0].split('@', 1)[0] if parts else '')
+            if route is not None:
+                return route
+        for regex, handler, login, limit in self.patterns:
+            if regex.fullmatch(text):
+                return handler, login, limit
+        return (self.fallback, False, 'default') if self.fallback else None
+
+    def run(self, chat_id, limit, reject, name, handler, *args):
+        if self.admission is None:
+            return run_instrumented(name, handler, *args)
+        return self.admission.run(chat_id, limit, reject, run_instrumented, name, handler, *args)
+
+    def dispatch_message(self, message):
+        session_store.refresh(message.chat.id)
+        if handle_conversation(message) or message.content_type != 'text':
+            return
+        route = self.resolve(message.text or '')
+        if route is None:
             return
-        return func(message, *args, **kwargs)
-    return wrapper
+        handler, login, limit = route
+        chat_id = message.chat.id
+        if login and not check_login(chat_id):
+            send_message(chat_id, "لطفاً ابتدا وارد سیستم شوید.", reply_markup=login_menu())
+            return
+        self.run(chat_id, limit, lambda text: send_message(chat_id, text), handler.__name__, handler, message)
 
-def get_db_connection():
+    def dispatch_callback(self, call):
+        session_store.refresh(call.message.chat.id)
+        route = self.callbacks.get((call.data or '').split(':', 1)[0])
+        if route is None:
+            bot.answer_callback_query(call.id)
+            return
+        handler, login, limit = route
+        chat_id = call.message.chat.id
+        if login and not check_login(chat_id):
+            bot.answer_callback_query(call.id, "لطفاً ابتدا وارد سیستم شوید.")
+            return
+        self.run(chat_id, limit, lambda text: bot.answer_callback_query(call.id, text), handler.__name__, handler, call)
+
+router = Router(admission)
+# تنها هندلرهای ثبت‌شده در telebot؛ پیام در گفتگوی جاری پیش از مسیرها بررسی می‌شود
+bot.register_message_handler(router.dispatch_message, content_types=['text', 'document'])
+bot.register_callback_query_handler(router.dispatch_callback, func=None)
+
+# ---------- گفتگوها ----------
+# هر گفتگوی چندمرحله‌ای (افزودن محصول، ثبت سفارش، ...) یک Flow با stateهای اعلانی است.
+# وضعیت گفتگو فقط دادهٔ JSON در sess['conv'] است: {'flow', 'state', 'data', 'expires'}؛
+# پس همراه سشن ذخیره می‌شود (SESSION_BACKEND=postgres) و بعد از ری‌استارت ادامه پیدا می‌کند.
+# ورودی نامعتبر همان مرحله را دوباره می‌پرسد؛ 'انصراف' گفتگو را می‌بندد و بعد از timeout
+# گفتگو (و داده‌اش) از حافظه پاک می‌شود.
+CANCEL_WORDS = ('انصراف', 'لغو', '/cancel')
+
+class InvalidInput(ValueError):
+    # پیام آن به کاربر نشان داده و همان مرحله دوباره پرسیده می‌شود
+    pass
+
+class State:
+    def __init__(self, prompt, parse=None, handle=None, save=None, next=None, markup=None,
+                 timeout=None, document=False, limit='default'):
+        self.prompt = prompt        # متن، یا تابع (chat_id, data) که خودش پیام می‌فرستد
+        self.parse = parse          # (text, data) -> value؛ InvalidInput برای ورودی نامعتبر
+        self.handle = handle        # (chat_id, value, data) -> state بعدی یا None برای پایان
+        self.save = save            # کلیدی در data که value در آن ذخیره می‌شود
+        self.next = next            # state بعدی وقتی handle نداریم
+        self.markup = markup        # تابعی که کیبورد پیام prompt را می‌سازد
+        self.timeout = timeout
+        self.document = document    # مرحله‌ای که به‌جای متن فایل می‌گیرد
+        self.limit = limit          # کلاس هندلر در کنترل پذیرش
+
+class Flow:
+    def __init__(self, name, start, states, login=True, timeout=CONVERSATION_TIMEOUT):
+        self.name = name
+        self.start = start
+        self.states = states
+        self.login = login
+        self.timeout = timeout
+
+FLOWS = {}
+
+def register_flow(flow):
+    for name, st in flow.states.items():
+        if st.handle is None and st.next is not None and st.next not in flow.states:
+            raise ValueError(f"state ناشناخته در {flow.name}: {st.next}")
+    FLOWS[flow.name] = flow
+    return flow
+
+def start_flow(chat_id, name, data=None, state=None):
+    sess = ensure_session(chat_id)
+    sess['conv'] = {'flow': name, 'state': None, 'data': data or {}, 'expires': 0}
+    save_session(chat_id)
+    enter_state(chat_id, state or FLOWS[name].start)
+
+def enter_state(chat_id, state, error=None):
+    # error: پیام ورودی نامعتبر که همراه پرسش دوباره فرستاده می‌شود
+    conv = ensure_session(chat_id)['conv']
+    flow = FLOWS[conv['flow']]
+    st = flow.states[state]
+    conv['state'] = state
+    conv['expires'] = time.time() + (st.timeout or flow.timeout)
+    save_session(chat_id)
+    if callable(st.prompt):
+        if error:
+            send_message(chat_id, error)
+        st.prompt(chat_id, conv['data'])
+    else:
+        text = f"{error}\n{st.prompt}" if error else st.prompt
+        send_message(chat_id, text, reply_markup=st.markup() if st.markup else None)
+
+def end_flow(chat_id):
+    ensure_session(chat_id).pop('conv', None)
+    save_session(chat_id)
+
+def active_flow(chat_id, name):
+    # دادهٔ گفتگوی name اگر باز و منقضی‌نشده باشد (مهلتش هم تمدید می‌شود)؛ برای callbackهایی
+    # که بیرون از جریان پیام‌ها روی همان گفتگو کار می‌کنند
+    conv = ensure_session(chat_id).get('conv')
+    if not conv or conv['flow'] != name or conv['expires'] < time.time():
+        return None
+    flow = FLOWS[name]
+    conv['expires'] = time.time() + (flow.states[conv['state']].timeout or flow.timeout)
+    # callback معمولاً data را تغییر می‌دهد
+    save_session(chat_id)
+    return conv['data']
+
+def handle_conversation(message):
+    # True اگر پیام مصرف گفتگوی جاری شد؛ False یعنی مسیریابی عادی ادامه پیدا کند
+    chat_id = message.chat.id
+    sess = ensure_session(chat_id)
+    conv = sess.get('conv')
+    if not conv:
+        return False
+    flow = FLOWS.get(conv['flow'])
+    st = flow.states.get(conv['state']) if flow else None
+    text = (message.text or '').strip()
+    if text in CANCEL_WORDS:
+        sess.pop('conv', None)
+        save_session(chat_id)
+        send_message(chat_id, "لغو شد.", reply_markup=main_menu() if sess.get('logged_in') else login_menu())
+        return True
+    if (st is None or (flow.login and not sess.get('logged_in'))
+            or text.startswith('/') or text in router.texts):
+        # گفتگوی ناشناخته (مثلاً بعد از به‌روزرسانی کد)، دستور یا دکمهٔ منو: گفتگو رها می‌شود
+        sess.pop('conv', None)
+        save_session(chat_id)
+        return False
+    if conv['expires'] < time.time():
+        sess.pop('conv', None)
+        save_session(chat_id)
+        send_message(chat_id, "مهلت پاسخ به پرسش قبلی تمام شد.")
+        return False
+    router.run(chat_id, st.limit, lambda text: send_message(chat_id, text),
+               f"{flow.name}.{conv['state']}", _conversation_step, chat_id, message, st, conv)
+    return True
+
+def _conversation_step(chat_id, message, st, conv):
+    data = conv['data']
     try:
-        conn = psycopg2.connect(DB_URI)
+        if st.document:
+            if message.document is None:
+                raise InvalidInput("لطفاً فایل را بفرستید.")
+            value = message
+        else:
+            if message.text is None:
+                raise InvalidInput("لطفاً پاسخ را به صورت متن بفرستید.")
+            value = message.text.strip()
+            if st.parse:
+                value = st.parse(value, data)
+        if st.save:
+            data[st.save] = value
+        nxt = st.handle(chat_id, value, data) if st.handle else st.next
+    except InvalidInput as e:
+        error, nxt = str(e) or "ورودی نامعتبر است.", conv['state']
+    else:
+        error = None
+    sess = ensure_session(chat_id)
+    if sess.get('conv') is not conv:
+        # handle گفتگوی دیگری را شروع کرده است
+        return
+    if nxt is None:
+        sess.pop('conv', None)
+        save_session(chat_id)
+    else:
+        enter_state(chat_id, nxt, error)
+
+# اعتبارسنج‌های رایج
+def required_text(error="مقدار نامعتبر است."):
+    def parse(text, data):
+        if not text:
+            raise InvalidInput(error)
+        return text
+    return parse
+
+def int_value(error, minimum=0):
+    def parse(text, data):
+        text = text.translate(_PHONE_DIGITS)
+        if not text.isdigit() or int(text) < minimum:
+            raise InvalidInput(error)
+        return int(text)
+    return parse
+
+def parsed(fn, error):
+    # تجزیه‌گرهای موجود که ValueError می‌دهند
+    def parse(text, data):
+        try:
+            return fn(text)
+        except InvalidInput:
+            raise
+        except ValueError:
+            raise InvalidInput(error)
+    return parse
+
+def price_value(text, data):
+    try:
+        price = float(text.translate(_PHONE_DIGITS).replace(',', ''))
+    except ValueError:
+        price = -1
+    if price < 0:
+        raise InvalidInput("قیمت نامعتبر است. مقدار را به صورت عدد وارد کنید.")
+    return round(price, 2)
+
+def no_keyboard():
+    return types.ReplyKeyboardRemove()
+
+@router.text('انصراف', 'لغو')
+def cancel(m):
+    # انصراف بیرون از گفتگو (مثلاً از منوی «ثبت سفارش»)
+    send_message(m.chat.id, "لغو شد.", reply_markup=main_menu())
+
+# ---------- استخر اتصال‌ها ----------
+class PooledConnection(psycopg2.extensions.connection):
+    # close() در هندلرها اتصال را به استخر برمی‌گرداند و واقعاً نمی‌بندد
+    _pool = None
+    _released_at = 0.0
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.putconn(self)
+        else:
+            super().close()
+
+    def really_close(self):
+        psycopg2.extensions.connection.close(self)
+
+_query_stats = threading.local()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    # زمان و تعداد هر کوئری به نام هندلر جاری ثبت می‌شود؛ query_count() شمارش کل هر thread است
+    def _timed(self, fn, query, vars):
+        _query_stats.count = getattr(_query_stats, 'count', 0) + 1
+        start = time.perf_counter()
+        try:
+            return fn()
+        except Error as e:
+            DB_ERRORS.inc(type=type(e).__name__)
+            raise
+        finally:
+            record_query(query, vars, time.perf_counter() - start)
+
+    def execute(self, query, vars=None):
+        return self._timed(lambda: super(InstrumentedCursor, self).execute(query, vars), query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(lambda: super(InstrumentedCursor, self).executemany(query, vars_list), query, None)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(lambda: super(InstrumentedCursor, self).copy_expert(sql, file, size), sql, None)
+
+def query_count():
+    return getattr(_query_stats, 'count', 0)
+
+class PoolTimeout(PoolError):
+    pass
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, check_idle=30.0):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._size = 0      # تعداد اتصال‌های باز (بیکار + در حال استفاده)
+        self._in_use = 0
+        self._closed = False
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+        for _ in range(minconn):
+            conn = self._connect()
+            self._size += 1
+            self._idle.append(conn)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, cursor_factory=InstrumentedCursor)
+        conn._pool = self
+        conn._released_at = time.monotonic()
         return conn
+
+    def _discard(self, conn):
+        conn._pool = None
+        try:
+            conn.really_close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn._released_at < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("استخر اتصال بسته شده است.")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("همهٔ اتصال‌های پایگاه داده مشغول هستند.")
+                self._cond.wait(remaining)
+            self._in_use += 1
+        # اتصال جدید یا بررسی سلامت بیرون از قفل انجام می‌شود
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._healthy(conn):
+                self._discard(conn)
+                conn = self._connect()
+                with self._cond:
+                    self._reconnects += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        waited = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        broken = conn.closed
+        if not broken:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # تراکنش نیمه‌کاره (مثلاً return زودهنگام در هندلر) برگشت داده می‌شود
+                try:
+                    conn.rollback()
+                except Error:
+                    broken = True
+        with self._cond:
+            self._in_use -= 1
+            if broken or self._closed:
+                self._size -= 1
+            else:
+                conn._released_at = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+        if broken or self._closed:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "max": self.maxconn,
+                "checkouts": self._checkouts,
+                "wait_total": self._wait_total,
+                "wait_avg": self._wait_total / self._checkouts if self._checkouts else 0.0,
+                "wait_max": self._wait_max,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+            }
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(DB_URI, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
+    return _db_pool
+
+def checkout_connection():
+    start = time.perf_counter()
+    try:
+        return get_pool().getconn()
+    except Error as e:
+        DB_CHECKOUT_ERRORS.inc(type=type(e).__name__)
+        raise
+    finally:
+        DB_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+
+def _pool_samples():
+    if _db_pool is None:
+        return []
+    st = _db_pool.stats()
+    return [({'stat': k}, st[k]) for k in ('size', 'idle', 'in_use', 'max', 'checkouts', 'timeouts', 'reconnects')]
+
+metrics.gauge("bot_db_pool", "Connection pool state and counters", _pool_samples)
+
+def get_db_connection():
+    # اتصال از استخر گرفته می‌شود؛ conn.close() آن را به استخر برمی‌گرداند
+    try:
+        return checkout_connection()
     except Error as e:
         print("خطا در اتصال به پایگاه داده:", e)
         return None
 
-def create_tables():
-    conn = get_db_connection()
-    if conn is None:
-        print("اتصال DB برقرار نشد — جداول ساخته نشد.")
-        return
+@contextmanager
+def db_connection():
+    # with db_connection() as conn: ... — در صورت خطا PoolError/Error بالا می‌رود
+    conn = checkout_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS category (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR NOT NULL UNIQUE
-            );
-        """)
+        yield conn
+    finally:
+        conn.close()
+
+# ---------- مایگریشن‌ها ----------
+# هر مایگریشن فقط یک بار اجرا و در schema_migrations ثبت می‌شود. مراحل باید
+# idempotent باشند (IF NOT EXISTS) تا روی دیتابیس‌های قدیمی هم بدون خطا اجرا شوند.
+# مایگریشن‌های concurrent بیرون از تراکنش اجرا می‌شوند (لازمهٔ CREATE INDEX CONCURRENTLY).
+MIGRATION_LOCK_ID = 72173001
+
+def concurrent_index(name, definition, unique=False):
+    def step(cur):
+        # ساخت CONCURRENTLY ناموفق، ایندکس INVALID باقی می‌گذارد که IF NOT EXISTS آن را رد نمی‌کند
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS products (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR NOT NULL,
-                price NUMERIC(10,2) NOT NULL,
-                category_id INTEGER REFERENCES category(id) ON DELETE SET NULL
-            );
-        """)
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cur.fetchone():
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        cur.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+    return step
+
+# ---------- پارتیشن‌های سفارش ----------
+# orders و order_items بر اساس order_date پارتیشن ماهانه (RANGE) دارند و order_items همان
+# order_date سفارش را نگه می‌دارد (کلید خارجی مرکب (order_id, order_date))، پس کوئری‌هایی که
+# تاریخ را می‌دانند فقط پارتیشن همان ماه را می‌خوانند و هر ماه با آیتم‌هایش یک‌جا جدا می‌شود.
+# پارتیشن default فقط تور ایمنی است؛ PartitionManager ماه‌های آینده را از قبل می‌سازد.
+PARTITION_LOCK_ID = 72173002
+PARTITIONED_TABLES = ('orders', 'order_items')
+
+def month_start(d):
+    return datetime(d.year, d.month, 1)
+
+def add_months(d, n):
+    m = d.year * 12 + d.month - 1 + n
+    return datetime(m // 12, m % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+def create_order_partition(cur, month):
+    # پارتیشن یک ماه برای هر دو جدول؛ نام پارتیشن‌های تازه برگردانده می‌شود.
+    # اگر پارتیشن default ردیفی از این ماه داشته باشد (مثلاً مدیر پارتیشن‌ها عقب افتاده)، Postgres
+    # ساختن پارتیشن را رد می‌کند؛ آن ردیف‌ها اول بیرون کشیده و بعد از ساخت در پارتیشن تازه درج می‌شوند
+    names = [partition_name(table, month) for table in PARTITIONED_TABLES]
+    cur.execute("SELECT to_regclass(%s), to_regclass(%s)", names)
+    missing = [(table, name) for table, name, oid in zip(PARTITIONED_TABLES, names, cur.fetchone()) if oid is None]
+    if not missing:
+        return []
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    moved = []
+    # آیتم‌ها قبل از سفارش‌ها، وگرنه ON DELETE CASCADE آن‌ها را پاک می‌کند
+    for table, _ in sorted(missing, key=lambda t: t[0] != 'order_items'):
+        cur.execute(f"CREATE TEMP TABLE {table}_move ON COMMIT DROP AS SELECT * FROM {table}_default WITH NO DATA")
+        cur.execute(f"""
+            WITH d AS (
+                DELETE FROM {table}_default WHERE order_date >= %(start)s AND order_date < %(end)s RETURNING *
+            )
+            INSERT INTO {table}_move SELECT * FROM d
+        """, bounds)
+        if cur.rowcount:
+            moved.append((table, cur.rowcount))
+    for table, name in missing:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%(start)s) TO (%(end)s)", bounds)
+    for table, _ in missing:
+        cur.execute(f"INSERT INTO {table} SELECT * FROM {table}_move")
+        cur.execute(f"DROP TABLE {table}_move")
+    for table, count in moved:
+        print(f"{count} ردیف {table} از پارتیشن default به {partition_name(table, month)} منتقل شد.")
+    return [name for _, name in missing]
+
+def create_order_partitions(cur, first, last):
+    # ماه‌های first تا last (هر دو شامل)
+    created = []
+    month = month_start(first)
+    while month <= last:
+        created += create_order_partition(cur, month)
+        month = add_months(month, 1)
+    return created
+
+def order_partition_months(cur, table='orders'):
+    # ماه پارتیشن‌های ماهانهٔ متصل به table (بدون default)، به ترتیب زمان
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,))
+    months = []
+    for (name,) in cur.fetchall():
+        m = re.fullmatch(rf'{table}_(\d{{4}})_(\d{{2}})', name)
+        if m:
+            months.append(datetime(int(m.group(1)), int(m.group(2)), 1))
+    return sorted(months)
+
+def partition_order_tables(cur):
+    # تبدیل یک‌بارهٔ جدول‌های ساخته‌شده با مایگریشن 1: داده در جدول‌های پارتیشن‌شدهٔ جدید کپی و
+    # جدول‌های قدیمی حذف می‌شوند. دنباله‌های id همان قبلی‌ها می‌مانند تا کد سفارش‌ها عوض نشود.
+    # سفارش‌های بدون تاریخ 1970-01-01 می‌گیرند (پارتیشن default) و آیتم‌های بی‌سفارش کنار گذاشته می‌شوند
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'orders'::regclass")
+    if cur.fetchone()[0] == 'p':
+        return
+    cur.execute("SET LOCAL lock_timeout = '30s'")
+    cur.execute("ALTER TABLE orders RENAME TO orders_legacy")
+    cur.execute("ALTER TABLE order_items RENAME TO order_items_legacy")
+    cur.execute("ALTER INDEX orders_pkey RENAME TO orders_legacy_pkey")
+    cur.execute("ALTER INDEX order_items_pkey RENAME TO order_items_legacy_pkey")
+    cur.execute("""
+        CREATE TABLE orders (
+            id INTEGER NOT NULL DEFAULT nextval('orders_id_seq'),
+            customer_id INTEGER REFERENCES customers(id) ON DELETE SET NULL,
+            order_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            total NUMERIC(10,2) DEFAULT 0,
+            status VARCHAR(20) DEFAULT 'pending', -- pending, served, cancelled
+            PRIMARY KEY (id, order_date)
+        ) PARTITION BY RANGE (order_date)
+    """)
+    cur.execute("""
+        CREATE TABLE order_items (
+            id INTEGER NOT NULL DEFAULT nextval('order_items_id_seq'),
+            order_id INTEGER NOT NULL,
+            order_date TIMESTAMP NOT NULL,
+            product_id INTEGER REFERENCES products(id),
+            quantity INTEGER NOT NULL CHECK (quantity > 0),
+            price_at_order NUMERIC(10,2) NOT NULL,
+            PRIMARY KEY (id, order_date),
+            FOREIGN KEY (order_id, order_date) REFERENCES orders (id, order_date) ON DELETE CASCADE
+        ) PARTITION BY RANGE (order_date)
+    """)
+    for table in PARTITIONED_TABLES:
+        cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    cur.execute("SELECT min(order_date), max(order_date) FROM orders_legacy")
+    first, last = cur.fetchone()
+    now = datetime.now()
+    create_order_partitions(cur, min(first or now, now), add_months(max(last or now, now), ORDER_PARTITION_MONTHS_AHEAD))
+    cur.execute("""
+        INSERT INTO orders (id, customer_id, order_date, total, status)
+        SELECT id, customer_id, COALESCE(order_date, 'epoch'), total, status FROM orders_legacy
+    """)
+    cur.execute("""
+        INSERT INTO order_items (id, order_id, order_date, product_id, quantity, price_at_order)
+        SELECT i.id, i.order_id, COALESCE(o.order_date, 'epoch'), i.product_id, i.quantity, i.price_at_order
+        FROM order_items_legacy i JOIN orders_legacy o ON o.id = i.order_id
+    """)
+    # ایندکس یکتا روی جدول پارتیشن‌شده باید order_date را هم شامل شود و یکتایی سراسری کلید را
+    # تضمین نمی‌کند؛ کلیدهای تکرار در جدول کوچک جداگانه نگه داشته می‌شوند
+    cur.execute("""
+        CREATE TABLE order_keys (
+            key UUID PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            order_date TIMESTAMP NOT NULL
+        )
+    """)
+    cur.execute("""
+        INSERT INTO order_keys (key, order_id, order_date)
+        SELECT idempotency_key, id, COALESCE(order_date, 'epoch') FROM orders_legacy
+        WHERE idempotency_key IS NOT NULL
+    """)
+    # کلید خارجی به orders(id) دیگر ممکن نیست (id به‌تنهایی کلید یکتا نیست)؛ تاریخچه بعد از
+    # بایگانی ماه‌ها هم باید مستقل بماند
+    cur.execute("ALTER TABLE order_status_history DROP CONSTRAINT IF EXISTS order_status_history_order_id_fkey")
+    cur.execute("ALTER SEQUENCE orders_id_seq OWNED BY orders.id")
+    cur.execute("ALTER SEQUENCE order_items_id_seq OWNED BY order_items.id")
+    cur.execute("DROP TABLE order_items_legacy, orders_legacy")
+    cur.execute("CREATE INDEX orders_order_date_id_idx ON orders (order_date, id)")
+    cur.execute("CREATE INDEX orders_status_order_date_id_idx ON orders (status, order_date, id)")
+    cur.execute("CREATE INDEX order_items_order_id_idx ON order_items (order_id, order_date)")
+    cur.execute("CREATE INDEX order_items_product_id_idx ON order_items (product_id)")
+    cur.execute("CREATE INDEX order_keys_order_date_idx ON order_keys (order_date)")
+    cur.execute("ANALYZE orders")
+    cur.execute("ANALYZE order_items")
+
+def _drop_foreign_keys(cur, table):
+    # فقط قیدهای سطح بالا؛ قیدهای داخلی هر پارتیشن مقصد همراه آن‌ها حذف می‌شوند
+    cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f' AND conparentid = 0", (table,))
+    for (name,) in cur.fetchall():
+        cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+
+def _copy_to_gzip(cur, query, path):
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+
+class PartitionManager:
+    # هر interval ثانیه: ساخت پارتیشن ماه جاری تا months_ahead ماه بعد، پاک کردن کلیدهای تکرار
+    # قدیمی و جدا کردن ماه‌های خارج از retention. ماه جداشده جدول مستقلی می‌ماند، یا اگر
+    # archive_dir تنظیم شده باشد همراه تاریخچهٔ وضعیتش در csv.gz نوشته و حذف می‌شود.
+    # قفل advisory تضمین می‌کند فقط یک نمونهٔ ربات این کار را انجام دهد
+    def __init__(self, months_ahead=ORDER_PARTITION_MONTHS_AHEAD, retention=ORDER_PARTITION_RETENTION_MONTHS,
+                 archive_dir=ORDER_ARCHIVE_DIR, interval=ORDER_PARTITION_CHECK_INTERVAL, key_ttl_days=ORDER_KEY_TTL_DAYS):
+        self.months_ahead = months_ahead
+        self.retention = retention
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.key_ttl_days = key_ttl_days
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="partitions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.maintain()
+            except (Error, OSError) as e:
+                print("خطا در نگهداری پارتیشن‌های سفارش:", e)
+            self._stop_event.wait(self.interval)
+
+    def maintain(self, now=None):
+        month = month_start(now or datetime.now())
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    return
+                # DDL روی والد قفل کوتاه AccessExclusive می‌گیرد؛ پشت تراکنش‌های طولانی صف نمی‌کشد
+                cur.execute("SET LOCAL lock_timeout = '5s'")
+                # هر ماه در savepoint جدا: ماهی که ساخته نشود (مثلاً lock_timeout) بقیه را نگه نمی‌دارد
+                for i in range(self.months_ahead + 1):
+                    target = add_months(month, i)
+                    cur.execute("SAVEPOINT partition_month")
+                    try:
+                        created = create_order_partition(cur, target)
+                    except Error as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT partition_month")
+                        ORDER_PARTITIONS.inc(action='failed')
+                        print(f"ساخت پارتیشن سفارش‌های {target:%Y-%m} انجام نشد:", e)
+                        continue
+                    cur.execute("RELEASE SAVEPOINT partition_month")
+                    ORDER_PARTITIONS.inc(len(created), action='created')
+                cur.execute("DELETE FROM order_keys WHERE order_date < now() - %s * interval '1 day'", (self.key_ttl_days,))
+                if self.retention > 0:
+                    cutoff = add_months(month, -self.retention)
+                    for old in order_partition_months(cur):
+                        if old < cutoff:
+                            self._detach(cur, old)
+                conn.commit()
+            finally:
+                conn.rollback()
+                cur.close()
+
+    def _detach(self, cur, month):
+        orders_part, items_part = partition_name('orders', month), partition_name('order_items', month)
+        # اول آیتم‌ها، و کلید خارجی نسخهٔ جداشده حذف می‌شود تا جدا کردن سفارش‌ها مجاز باشد
+        cur.execute("SELECT to_regclass(%s)", (items_part,))
+        has_items = cur.fetchone()[0] is not None
+        if has_items:
+            cur.execute(f"ALTER TABLE order_items DETACH PARTITION {items_part}")
+            _drop_foreign_keys(cur, items_part)
+        cur.execute(f"ALTER TABLE orders DETACH PARTITION {orders_part}")
+        _drop_foreign_keys(cur, orders_part)
+        ORDER_PARTITIONS.inc(action='detached')
+        print(f"پارتیشن سفارش‌های {month:%Y-%m} جدا شد.")
+        if not self.archive_dir:
+            return
+        os.makedirs(self.archive_dir, exist_ok=True)
+        dumps = [(orders_part, f"SELECT * FROM {orders_part} ORDER BY order_date, id")]
+        if has_items:
+            dumps.append((items_part, f"SELECT * FROM {items_part} ORDER BY order_id, id"))
+        dumps.append((f"order_status_history_{month:%Y_%m}",
+                      f"SELECT h.* FROM order_status_history h WHERE h.order_id IN (SELECT id FROM {orders_part}) ORDER BY h.id"))
+        for name, query in dumps:
+            _copy_to_gzip(cur, query, os.path.join(self.archive_dir, f"{name}.csv.gz"))
+        cur.execute(f"DELETE FROM order_status_history WHERE order_id IN (SELECT id FROM {orders_part})")
+        cur.execute(f"DROP TABLE IF EXISTS {items_part}, {orders_part}")
+        ORDER_PARTITIONS.inc(action='archived')
+        print(f"پارتیشن سفارش‌های {month:%Y-%m} در {self.archive_dir} بایگانی شد.")
+
+partition_manager = PartitionManager()
+
+MIGRATIONS = [
+    {'version': 1, 'name': 'initial schema', 'steps': [
+        """
+        CREATE TABLE IF NOT EXISTS category (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR NOT NULL UNIQUE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            price NUMERIC(10,2) NOT NULL,
+            category_id INTEGER REFERENCES category(id) ON DELETE SET NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS customers (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            phone VARCHAR
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            customer_id INTEGER REFERENCES customers(id) ON DELETE SET NULL,
+            order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total NUMERIC(10,2) DEFAULT 0,
+            status VARCHAR(20) DEFAULT 'pending' -- pending, served, cancelled
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS order_items (
+            id SERIAL PRIMARY KEY,
+            order_id INTEGER REFERENCES orders(id) ON DELETE CASCADE,
+            product_id INTEGER REFERENCES products(id),
+            quantity INTEGER NOT NULL CHECK (quantity > 0),
+            price_at_order NUMERIC(10,2) NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_sessions (
+            chat_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """,
+    ]},
+    # category.name به خاطر UNIQUE از قبل ایندکس دارد
+    {'version': 2, 'name': 'performance indexes', 'concurrent': True, 'steps': [
+        concurrent_index("order_items_order_id_idx", "order_items (order_id)"),
+        concurrent_index("order_items_product_id_idx", "order_items (product_id)"),
+        concurrent_index("orders_order_date_id_idx", "orders (order_date, id)"),
+        concurrent_index("orders_status_order_date_id_idx", "orders (status, order_date, id)"),
+        concurrent_index("customers_name_idx", "customers (name)"),
+        concurrent_index("products_category_id_idx", "products (category_id)"),
+    ]},
+    # جمع‌های روزانه که save_order و تغییر وضعیت به‌صورت افزایشی به‌روز می‌کنند؛
+    # سفارش‌های لغوشده در آن‌ها حساب نمی‌شوند. product_id = 0 یعنی محصول نامشخص
+    {'version': 3, 'name': 'daily sales rollups', 'steps': [
+        """
+        CREATE TABLE IF NOT EXISTS daily_orders (
+            day DATE PRIMARY KEY,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC(14,2) NOT NULL DEFAULT 0
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_sales (
+            day DATE NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC(14,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        );
+        """,
+        """
+        INSERT INTO daily_orders (day, orders_count, revenue)
+        SELECT order_date::date, COUNT(*), SUM(total)
+        FROM orders
+        WHERE status <> 'cancelled' AND order_date IS NOT NULL
+        GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_sales (day, product_id, quantity, revenue)
+        SELECT o.order_date::date, COALESCE(oi.product_id, 0), SUM(oi.quantity), SUM(oi.quantity * oi.price_at_order)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE o.status <> 'cancelled' AND o.order_date IS NOT NULL
+        GROUP BY 1, 2
+        """,
+    ]},
+    # شمارهٔ تلفن نرمال‌شده (فقط رقم، با پیش‌شمارهٔ 0) برای جستجو و جلوگیری از مشتری تکراری.
+    # COLLATE "C" تا LIKE 'prefix%' از ایندکس btree استفاده کند. از شماره‌های تکراری موجود
+    # فقط قدیمی‌ترین مشتری phone_norm می‌گیرد تا ایندکس یکتا ساخته شود
+    {'version': 4, 'name': 'customer phone normalisation', 'steps': [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        'ALTER TABLE customers ADD COLUMN IF NOT EXISTS phone_norm VARCHAR COLLATE "C"',
+        """
+        UPDATE customers c
+        SET phone_norm = NULLIF(CASE
+                WHEN x.d LIKE '0098%' THEN '0' || substr(x.d, 5)
+                WHEN x.d LIKE '98%' AND length(x.d) = 12 THEN '0' || substr(x.d, 3)
+                WHEN x.d LIKE '9%' AND length(x.d) = 10 THEN '0' || x.d
+                ELSE x.d END, '')
+        FROM (
+            SELECT id, regexp_replace(translate(COALESCE(phone, ''), '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789'), '[^0-9]', '', 'g') AS d
+            FROM customers
+        ) x
+        WHERE c.id = x.id
+        """,
+        """
+        UPDATE customers c SET phone_norm = NULL
+        WHERE EXISTS (SELECT 1 FROM customers d WHERE d.phone_norm = c.phone_norm AND d.id < c.id)
+        """,
+    ]},
+    {'version': 5, 'name': 'customer search indexes', 'concurrent': True, 'steps': [
+        concurrent_index("customers_name_trgm_idx", "customers USING gin (name gin_trgm_ops)"),
+        concurrent_index("customers_phone_norm_key", "customers (phone_norm) WHERE phone_norm IS NOT NULL", unique=True),
+    ]},
+    {'version': 6, 'name': 'order status history', 'steps': [
+        """
+        CREATE TABLE IF NOT EXISTS order_status_history (
+            id BIGSERIAL PRIMARY KEY,
+            order_id INTEGER NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+            old_status VARCHAR(20) NOT NULL,
+            new_status VARCHAR(20) NOT NULL,
+            changed_by BIGINT,
+            changed_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS order_status_history_order_id_idx ON order_status_history (order_id, changed_at)",
+    ]},
+    # کلید یکتای هر سفارش در حال ساخت؛ ثبت دوبارهٔ همان سفارش (done تکراری، آپدیت تحویل‌شدهٔ دوباره)
+    # ردیف جدیدی نمی‌سازد. سفارش‌های قدیمی و ساخته‌شده بیرون از ربات کلید ندارند (NULL)
+    {'version': 7, 'name': 'order idempotency key', 'concurrent': True, 'steps': [
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key UUID",
+        concurrent_index("orders_idempotency_key_key", "orders (idempotency_key)", unique=True),
+    ]},
+    # پارتیشن ماهانهٔ orders/order_items (PostgreSQL 12+)؛ idempotency_key به order_keys منتقل می‌شود
+    {'version': 8, 'name': 'monthly order partitions', 'steps': [
+        partition_order_tables,
+    ]},
+    # نسخهٔ ردیف سشن برای تشخیص نوشتن همزمان چند نمونهٔ ربات
+    {'version': 9, 'name': 'session versions', 'steps': [
+        "ALTER TABLE bot_sessions ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0",
+    ]},
+]
+
+def _run_migration_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step)
+
+def migrate():
+    # اتصال اختصاصی، چون autocommit در طول اجرا تغییر می‌کند
+    try:
+        conn = psycopg2.connect(DB_URI)
+    except Error as e:
+        print("اتصال DB برقرار نشد — مایگریشن‌ها اجرا نشدند:", e)
+        return False
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        # چند نمونهٔ ربات همزمان مایگریشن اجرا نکنند
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS customers (
-                id SERIAL PRIMARY KEY,
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
                 name VARCHAR NOT NULL,
-                phone VARCHAR
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id SERIAL PRIMARY KEY,
-                customer_id INTEGER REFERENCES customers(id) ON DELETE SET NULL,
-                order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total NUMERIC(10,2) DEFAULT 0,
-                status VARCHAR(20) DEFAULT 'pending' -- pending, served, cancelled
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS order_items (
-                id SERIAL PRIMARY KEY,
-                order_id INTEGER REFERENCES orders(id) ON DELETE CASCADE,
-                product_id INTEGER REFERENCES products(id),
-                quantity INTEGER NOT NULL CHECK (quantity > 0),
-                price_at_order NUMERIC(10,2) NOT NULL
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
             );
         """)
-        conn.commit()
-        cur.close()
-        print("جداول ساخته یا بررسی شدند.")
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {r[0] for r in cur.fetchall()}
+        for m in sorted(MIGRATIONS, key=lambda m: m['version']):
+            if m['version'] in applied:
+                continue
+            print(f"اجرای مایگریشن {m['version']}: {m['name']}")
+            if not m.get('concurrent'):
+                conn.autocommit = False
+            for step in m['steps']:
+                _run_migration_step(cur, step)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (m['version'], m['name']))
+            if not m.get('concurrent'):
+                conn.commit()
+                conn.autocommit = True
+        print("پایگاه داده به‌روز است.")
+        return True
     except Error as e:
-        print("خطا در ایجاد جداول:", e)
+        print("خطا در اجرای مایگریشن‌ها:", e)
+        if not conn.autocommit:
+            conn.rollback()
+            conn.autocommit = True
+        return False
     finally:
-        if conn:
-            conn.close()
+        try:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        except Error:
+            pass
+        conn.close()
+
+# ---------- بررسی استفاده از ایندکس ----------
+class _SqlRecorder:
+    # کرسر ساختگی برای گرفتن SQL تولیدشده توسط توابعی مثل fetch_orders_page
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, sql, params=None):
+        self.queries.append((sql, params))
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+def index_check_queries():
+    # همان ثابت‌های SQL هندلرها؛ کوئری‌هایی که در توابع ساخته می‌شوند با _SqlRecorder گرفته می‌شوند
+    now = datetime.now()
+    queries = [
+        ("search_order_by_id (orders)", ORDER_BY_ID_SQL, (1,)),
+        ("search_order_by_id (items)", ORDER_ITEMS_SQL, (1, now)),
+        ("add_product (category by id)", CATEGORY_BY_ID_SQL, (1,)),
+        ("add_product_insert (category by name)", CATEGORY_BY_NAME_SQL, ("x",)),
+        ("edit_product_select", PRODUCT_BY_ID_SQL, (1,)),
+        ("select_customer_process (by id)", CUSTOMER_BY_ID_SQL, (1,)),
+        ("select_customer_process (list)", CUSTOMER_LIST_SQL, (CUSTOMER_SEARCH_LIMIT,)),
+        # بررسی FK که PostgreSQL هنگام DELETE FROM products (callback_delete_product) اجرا می‌کند
+        ("callback_delete_product (FK check)", "SELECT 1 FROM order_items WHERE product_id = %s", (1,)),
+        ("bulk_status_command (count)", PENDING_OLDER_THAN_COUNT_SQL, (30,)),
+        ("menu_cache (products)", MENU_PRODUCTS_SQL, None),
+        ("menu_cache (categories)", MENU_CATEGORIES_SQL, None),
+        ("menu_cache (products by ids)", PRODUCTS_BY_IDS_SQL, ([1, 2],)),
+        ("fetch_receipt (items)", RECEIPT_ITEMS_SQL, (1, now)),
+    ]
+    recorded = [
+        ("select_customer_process (search)", lambda rec: (search_customers(rec, "علی"), search_customers(rec, "0912345"))),
+        ("list_orders", lambda rec: (fetch_orders_page(rec, 'a', 'a'), fetch_orders_page(rec, 'p', 'w', 'n', (now, 1)))),
+        ("fetch_receipt (order)", lambda rec: (fetch_receipt(rec, 1), fetch_receipt(rec, 1, now))),
+        ("fetch_kitchen_orders", lambda rec: (fetch_kitchen_orders(rec), fetch_kitchen_orders(rec, [1, 2]))),
+        ("set_order_status", lambda rec: set_order_status(rec, 1, 'served', expected='pending')),
+        ("bulk_status_apply (older than)",
+         lambda rec: transition_orders(rec, 'served', older_than=timedelta(minutes=30), from_status='pending')),
+    ]
+    for name, run in recorded:
+        rec = _SqlRecorder()
+        run(rec)
+        for sql, params in rec.queries:
+            queries.append((name, sql, params))
+    return queries
+
+def _plan_seq_scans(node, found):
+    if node.get("Node Type") == "Seq Scan":
+        found.append(node.get("Relation Name"))
+    for child in node.get("Plans", []):
+        _plan_seq_scans(child, found)
+    return found
+
+def _plan_indexes(node, found):
+    if "Index Name" in node:
+        found.append(node["Index Name"])
+    for child in node.get("Plans", []):
+        _plan_indexes(child, found)
+    return found
+
+def check_query_plans():
+    # با enable_seqscan=off بررسی می‌شود که برای هر کوئری ایندکس قابل‌استفاده‌ای وجود دارد؛
+    # روی جدول‌های کوچک planner در حالت عادی ممکن است Seq Scan را ترجیح دهد
+    ok = True
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, sql, params in index_check_queries():
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0][0]["Plan"]
+            seq = _plan_seq_scans(plan, [])
+            if seq:
+                ok = False
+                print(f"✗ {name}: Seq Scan روی {', '.join(seq)}")
+            else:
+                print(f"✓ {name}: {', '.join(_plan_indexes(plan, [])) or '-'}")
+        conn.rollback()
+    return ok
+
+# ---------- LISTEN/NOTIFY ----------
+class PgListener(threading.Thread):
+    # یک اتصال اختصاصی (خارج از استخر) که روی کانال‌های NOTIFY گوش می‌دهد
+    def __init__(self, dsn):
+        super().__init__(name="pg-listener", daemon=True)
+        self.dsn = dsn
+        self._callbacks = {}   # channel -> [callback(payload)]
+        self._stop_event = threading.Event()
+
+    def subscribe(self, channel, callback):
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, channel, payload):
+        for cb in self._callbacks.get(channel, []):
+            try:
+                cb(payload)
+            except Exception as e:
+                print(f"خطا در پردازش NOTIFY {channel}:", repr(e))
+
+    def run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                cur = conn.cursor()
+                for channel in self._callbacks:
+                    cur.execute(f"LISTEN {channel}")
+                # ممکن است در زمان قطع اتصال اعلانی از دست رفته باشد
+                for channel in self._callbacks:
+                    self._dispatch(channel, None)
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        self._dispatch(n.channel, n.payload)
+            except Error as e:
+                print("خطا در اتصال LISTEN:", e)
+                self._stop_event.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+pg_listener = PgListener(DB_URI)
+
+# ---------- کش منو ----------
+# کوئری‌ها ثابت ماژول‌اند تا index_check_queries همان SQL را بررسی کند
+MENU_PRODUCTS_SQL = """
+    SELECT p.id, p.name, p.price, p.category_id, c.name
+    FROM products p
+    LEFT JOIN category c ON p.category_id = c.id
+    ORDER BY p.id
+"""
+MENU_CATEGORIES_SQL = "SELECT id, name FROM category ORDER BY name"
+PRODUCTS_BY_IDS_SQL = "SELECT id, name, price FROM products WHERE id = ANY(%s)"
+
+class MenuCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._data = None
+        self._loaded_at = 0.0
+        self._generation = 0
+
+    def invalidate(self, payload=None):
+        with self._lock:
+            self._generation += 1
+            self._data = None
+
+    def _fresh(self):
+        return self._data is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _get(self):
+        with self._lock:
+            if self._fresh():
+                return self._data
+        # فقط یک ترد منو را از DB بارگذاری می‌کند و بقیه منتظر نتیجه می‌مانند
+        with self._load_lock:
+            with self._lock:
+                if self._fresh():
+                    return self._data
+                generation = self._generation
+            data = self._load()
+            with self._lock:
+                # اگر حین بارگذاری تغییری ثبت شده باشد، دادهٔ قدیمی کش نمی‌شود
+                if generation == self._generation:
+                    self._data = data
+                    self._loaded_at = time.monotonic()
+            return data
+
+    def _load(self):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(MENU_PRODUCTS_SQL)
+            products = {}
+            for r in cur.fetchall():
+                products[r[0]] = {'id': r[0], 'name': r[1], 'price': float(r[2]), 'category_id': r[3], 'category': r[4]}
+            cur.execute(MENU_CATEGORIES_SQL)
+            categories = [{'id': r[0], 'name': r[1]} for r in cur.fetchall()]
+            cur.close()
+        # شناسهٔ محصولات هر دسته به ترتیب نام (0 = بدون دسته)، برای صفحه‌بندی انتخابگر
+        by_category = {}
+        for p in sorted(products.values(), key=lambda p: p['name']):
+            by_category.setdefault(p['category_id'] or 0, []).append(p['id'])
+        return {'products': products, 'categories': categories, 'by_category': by_category, 'keyboards': {}}
+
+    def products(self):
+        return list(self._get()['products'].values())
+
+    def product(self, pid):
+        return self.products_by_ids([pid]).get(pid)
+
+    def products_by_ids(self, pids):
+        # همه از کش؛ شناسه‌های پیدانشده (مثلاً محصولی که تازه در نمونهٔ دیگری اضافه شده
+        # و هنوز NOTIFY آن نرسیده) با یک کوئری ANY بررسی می‌شوند
+        cached = self._get()['products']
+        found = {pid: cached[pid] for pid in pids if pid in cached}
+        missing = [pid for pid in pids if pid not in found]
+        if missing:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(PRODUCTS_BY_IDS_SQL, (missing,))
+                for r in cur.fetchall():
+                    found[r[0]] = {'id': r[0], 'name': r[1], 'price': float(r[2])}
+                cur.close()
+        return found
+
+    def categories(self):
+        return self._get()['categories']
+
+    def keyboard(self, key, build):
+        # JSON کیبوردهای کاتالوگ کنار همان دادهٔ منو نگه داشته می‌شود؛ invalidate (تغییر محصول
+        # یا دسته) آن‌ها را هم دور می‌ریزد و هر کیبورد در اولین استفادهٔ بعدی دوباره ساخته می‌شود
+        data = self._get()
+        markup = data['keyboards'].get(key)
+        if markup is None:
+            markup = data['keyboards'][key] = build(data)
+        return markup
+
+menu_cache = MenuCache(MENU_CACHE_TTL)
+pg_listener.subscribe(MENU_CHANNEL, menu_cache.invalidate)
+
+def notify_menu_changed(cur):
+    # NOTIFY تا commit تراکنش ارسال نمی‌شود؛ بقیهٔ نمونه‌ها کش خود را خالی می‌کنند
+    cur.execute(f"NOTIFY {MENU_CHANNEL}")
+
+# ---------- ارسال پیام ----------
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        # چند ثانیه تا در دسترس بودن یک توکن (0 یعنی همین حالا)
+        with self._lock:
+            self._refill(time.monotonic())
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.capacity
+
+def split_text(text, limit=TELEGRAM_MAX_TEXT):
+    # تقسیم متن بلند روی مرز خطوط؛ خطی که خودش از limit بلندتر است بریده می‌شود
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            chunks.append(current)
+            current = line
+    if current:
+        chunks.append(current)
+    return chunks
+
+OUTBOX_MAX_BUCKETS = 10000
+
+class Outbox:
+    # صف پیام‌های خروجی به تفکیک چت:
+    # - پیام‌های پشت‌سرهم یک چت (بدون کیبورد در میانه) در یک درخواست ادغام می‌شوند
+    # - متن‌های بلندتر از ۴۰۹۶ کاراکتر روی مرز خطوط تقسیم می‌شوند
+    # - محدودیت کلی و هر چت رعایت و خطای 429 با retry_after دوباره تلاش می‌شود
+    def __init__(self, send, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST, linger=OUTBOX_LINGER):
+        self._send = send
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.linger = linger
+        self._cond = threading.Condition()
+        self._queues = {}     # chat_id -> deque of [text, kwargs, enqueued_at]
+        self._forced = set()  # چت‌هایی که بدون صبر linger ارسال می‌شوند
+        self._busy = set()
+        self._buckets = {}
+        self._blocked = {}    # chat_id -> زمان پایان retry_after
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._global_blocked = 0.0
+        self._threads = []
+        self._stopping = False
+        self.stats = {"requests": 0, "messages": 0, "merged": 0, "split": 0, "retries": 0, "errors": 0}
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        if reply_markup is not None:
+            kwargs['reply_markup'] = reply_markup
+        chunks = split_text(str(text))
+        items = [[chunk, {}, 0.0] for chunk in chunks]
+        items[-1][1] = kwargs
+        with self._cond:
+            self.stats["messages"] += 1
+            self.stats["split"] += len(chunks) - 1
+            if not self._threads:
+                direct = True
+            else:
+                direct = False
+                now = time.monotonic()
+                q = self._queues.setdefault(chat_id, deque())
+                for it in items:
+                    it[2] = now
+                    q.append(it)
+                self._cond.notify()
+        if direct:
+            # بدون ترد ارسال (مثلاً در اسکریپت‌ها): ارسال همزمان
+            for text, kw, _ in items:
+                self._deliver(chat_id, text, kw)
+
+    def flush(self, chat_id=None):
+        with self._cond:
+            if chat_id is None:
+                self._forced.update(self._queues)
+            elif chat_id in self._queues:
+                self._forced.add(chat_id)
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.flush()
+        with self._cond:
+            while self._queues or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.5)
+        return True
+
+    def _bucket(self, chat_id):
+        b = self._buckets.get(chat_id)
+        if b is None:
+            if len(self._buckets) >= OUTBOX_MAX_BUCKETS:
+                self._prune()
+            b = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    def _prune(self):
+        # باکت پرِ چتی که پیامی در صف ندارد با باکت تازه فرقی ندارد
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._queues and b.full()]:
+            del self._buckets[chat_id]
+
+    def _pick(self):
+        # یک چت آمادهٔ ارسال یا مدت انتظار تا آماده شدن اولین چت
+        now = time.monotonic()
+        wait = 1.0
+        if now < self._global_blocked:
+            return None, self._global_blocked - now
+        for chat_id, q in self._queues.items():
+            if chat_id in self._busy:
+                continue
+            delay = 0.0
+            if chat_id not in self._forced:
+                delay = max(delay, self.linger - (now - q[0][2]))
+            delay = max(delay, self._blocked.get(chat_id, 0) - now, self._bucket(chat_id).wait_time())
+            if delay <= 0:
+                global_wait = self._global.wait_time()
+                if global_wait > 0:
+                    return None, global_wait
+                return chat_id, 0
+            wait = min(wait, delay)
+        return None, wait
+
+    def _take_batch(self, q):
+        # ادغام پیام‌های متوالی تا وقتی کیبوردی در میانه نباشد و طول از حد نگذرد
+        text, kwargs, _ = q.popleft()
+        merged = 0
+        while q and not kwargs and len(text) + 1 + len(q[0][0]) <= TELEGRAM_MAX_TEXT:
+            nxt, kwargs, _ = q.popleft()
+            text += "\n" + nxt
+            merged += 1
+        return text, kwargs, merged
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    chat_id, wait = self._pick() if self._queues else (None, None)
+                    if chat_id is not None:
+                        break
+                    self._cond.wait(wait)
+                q = self._queues[chat_id]
+                self._bucket(chat_id).take()
+                self._global.take()
+                text, kwargs, merged = self._take_batch(q)
+                self.stats["merged"] += merged
+                self._busy.add(chat_id)
+            retry_after = self._deliver(chat_id, text, kwargs)
+            with self._cond:
+                self._busy.discard(chat_id)
+                if retry_after:
+                    self.stats["retries"] += 1
+                    self._blocked[chat_id] = time.monotonic() + retry_after
+                    q.appendleft([text, kwargs, 0.0])
+                    if retry_after > 1:
+                        # محدودیت کلی ربات؛ همهٔ ارسال‌ها متوقف می‌شوند
+                        self._global_blocked = time.monotonic() + retry_after
+                elif not q:
+                    del self._queues[chat_id]
+                    self._forced.discard(chat_id)
+                    self._blocked.pop(chat_id, None)
+                self._cond.notify_all()
+
+    def _deliver(self, chat_id, text, kwargs):
+        # None در صورت موفقیت یا شکست نهایی؛ عدد در صورت نیاز به تلاش مجدد (ثانیه)
+        with self._cond:
+            self.stats["requests"] += 1
+        try:
+            self._send(chat_id, text, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                params = (e.result_json or {}).get('parameters') or {}
+                return float(params.get('retry_after', 1))
+            print(f"خطا در ارسال پیام به {chat_id}:", e)
+            with self._cond:
+                self.stats["errors"] += 1
+        except Exception as e:
+            print(f"خطا در ارسال پیام به {chat_id}:", repr(e))
+            with self._cond:
+                self.stats["errors"] += 1
+        return None
+
+outbox = Outbox(bot.send_message)
+metrics.gauge("bot_outbox_events_total", "Outbox counters (requests, messages, merged, split, retries, errors)",
+              lambda: [({'event': k}, v) for k, v in outbox.stats.items()], kind='counter')
+
+def send_message(chat_id, text, reply_markup=None, **kwargs):
+    outbox.send_message(chat_id, text, reply_markup=reply_markup, **kwargs)
+
+# ---------- پردازش همزمان آپدیت‌ها ----------
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+class RecentUpdates:
+    # update_idهای دیده‌شده در پنجرهٔ ttl ثانیه، حداکثر size عدد (قدیمی‌ترها اول حذف می‌شوند)
+    def __init__(self, size=UPDATE_DEDUP_SIZE, ttl=UPDATE_DEDUP_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._seen = OrderedDict()  # update_id -> زمان دریافت، به ترتیب ورود
+        self._lock = threading.Lock()
+
+    def check(self, update_id):
+        # True اگر آپدیت تازه است (و ثبت می‌شود)، False اگر تکراری است
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest, seen_at = next(iter(self._seen.items()))
+                if seen_at > now - self.ttl and len(self._seen) < self.size:
+                    break
+                self._seen.popitem(last=False)
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = now
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+class UpdateDispatcher:
+    # آپدیت‌های چت‌های مختلف موازی و آپدیت‌های یک چت به ترتیب ورود پردازش می‌شوند
+    # (تا مراحل یک گفتگو با هم تداخل نکنند)
+    def __init__(self, handle, workers=8, max_pending=None, recent=None):
+        self.handle = handle
+        self.workers = workers
+        self.max_pending = max_pending
+        self.recent = recent if recent is not None else RecentUpdates()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self._cond = threading.Condition()
+        self._queues = {}   # chat_id -> deque آپدیت‌های در انتظار
+        self._pending = 0
+
+    def submit(self, key, update):
+        # اگر صف پر باشد False برمی‌گردد و فراخواننده آپدیت را رد می‌کند؛ آپدیت تکراری
+        # (تحویل دوبارهٔ تلگرام) پذیرفته و بدون اجرا کنار گذاشته می‌شود
+        with self._cond:
+            if self.max_pending is not None and self._pending >= self.max_pending:
+                return False
+            if not self.recent.check(update.update_id):
+                UPDATES_DUPLICATE.inc()
+                return True
+            self._pending += 1
+            q = self._queues.get(key)
+            if q is not None:
+                # چت در حال پردازش است؛ بعد از آپدیت فعلی نوبتش می‌رسد
+                q.append(update)
+                return True
+            self._queues[key] = deque([update])
+        self._executor.submit(self._run, key)
+        return True
+
+    def _run(self, key):
+        with self._cond:
+            update = self._queues[key][0]
+        try:
+            self.handle(update)
+        except Exception as e:
+            print("خطا در پردازش آپدیت:", repr(e))
+        with self._cond:
+            q = self._queues[key]
+            q.popleft()
+            self._pending -= 1
+            more = bool(q)
+            if not more:
+                del self._queues[key]
+            self._cond.notify_all()
+        if more:
+            # برای انصاف بین چت‌ها، آپدیت بعدی این چت دوباره در صف استخر قرار می‌گیرد
+            self._executor.submit(self._run, key)
+
+    def pending(self):
+        with self._cond:
+            return self._pending
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=None):
+        self.join(timeout)
+        self._executor.shutdown(wait=False)
+
+def process_update(update):
+    try:
+        bot.process_new_updates([update])
+    finally:
+        # پیام‌های این آپدیت بدون صبر linger (و ادغام‌شده) ارسال می‌شوند
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            outbox.flush(chat_id)
+
+def run_polling(workers=BOT_WORKERS, poll_timeout=20):
+    dispatcher = UpdateDispatcher(process_update, workers)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, timeout=poll_timeout, long_polling_timeout=poll_timeout)
+            except Exception as e:
+                print("خطا در دریافت آپدیت‌ها:", repr(e))
+                time.sleep(1)
+                continue
+            for u in updates:
+                offset = u.update_id + 1
+                key = update_chat_id(u)
+                dispatcher.submit(key if key is not None else u.update_id, u)
+    except KeyboardInterrupt:
+        print("در حال توقف؛ منتظر پایان آپدیت‌های در جریان ...")
+    finally:
+        dispatcher.shutdown(timeout=30)
+
+# ---------- وب‌هوک ----------
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive تا تلگرام (و load generator) برای هر آپدیت اتصال جدید باز نکند
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        if code != 200:
+            # ممکن است بدنهٔ درخواست خوانده نشده باشد؛ اتصال بسته می‌شود
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self._reply(404)
+            return
+        if server.secret:
+            # هدرها latin-1 خوانده می‌شوند؛ compare_digest روی str غیر ASCII خطای TypeError می‌دهد
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("latin-1", "replace")
+            if not hmac.compare_digest(token, server.secret.encode()):
+                self._reply(403)
+                return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self._reply(400)
+            return
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self._reply(413 if length > 0 else 400)
+            return
+        body = self.rfile.read(length)
+        if server.draining:
+            self._reply(503)
+            return
+        try:
+            update = types.Update.de_json(body.decode("utf-8"))
+        except Exception:
+            self._reply(400)
+            return
+        key = update_chat_id(update)
+        if not server.dispatcher.submit(key if key is not None else update.update_id, update):
+            # صف پر است؛ تلگرام آپدیت را بعداً دوباره می‌فرستد
+            server.shed += 1
+            self._reply(503)
+            return
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        super().__init__(address, WebhookRequestHandler)
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.draining = False
+        self.shed = 0
+
+def run_webhook(workers=BOT_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+    dispatcher = UpdateDispatcher(process_update, workers, max_pending=queue_size)
+    server = WebhookServer((WEBHOOK_HOST, WEBHOOK_PORT), dispatcher)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    thread = threading.Thread(target=server.serve_forever, name="webhook", daemon=True)
+    thread.start()
+    print(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    stop.wait()
+    # تخلیهٔ منظم: آپدیت جدید پذیرفته نمی‌شود و آپدیت‌های صف‌شده تمام می‌شوند
+    print("در حال توقف؛ تخلیهٔ صف آپدیت‌ها ...")
+    server.draining = True
+    server.shutdown()
+    server.server_close()
+    dispatcher.shutdown(timeout=30)
 
 # ---------- کیبوردها ----------
 def login_menu():
@@ -117,10 +2327,22 @@ def main_menu():
         types.KeyboardButton('دسته‌بندی‌ها'),
         types.KeyboardButton('ثبت سفارش'),
         types.KeyboardButton('مشاهده سفارش‌ها'),
+        types.KeyboardButton('گزارش‌ها'),
         types.KeyboardButton('خروج از سیستم')
     )
     return markup
 
+def reports_menu():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(
+        types.KeyboardButton('فروش امروز'),
+        types.KeyboardButton('فروش هفتگی'),
+        types.KeyboardButton('پرفروش‌ترین محصولات'),
+        types.KeyboardButton('فروش دسته‌ها'),
+        types.KeyboardButton('بازگشت')
+    )
+    return markup
+
 def products_menu():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     markup.add(
@@ -128,6 +2350,7 @@ def products_menu():
         types.KeyboardButton('اضافه کردن محصول'),
         types.KeyboardButton('ویرایش محصول'),
         types.KeyboardButton('حذف محصول'),
+        types.KeyboardButton('ورود CSV محصولات'),
         types.KeyboardButton('بازگشت')
     )
     return markup
@@ -154,986 +2377,2086 @@ def order_status_menu():
     return markup
 
 # ---------- لاگین ----------
-@bot.message_handler(commands=['start', 'login'])
+@router.command('start', 'login')
 def cmd_start(message):
     chat_id = message.chat.id
     sess = ensure_session(chat_id)
     if sess.get("logged_in"):
-        bot.send_message(chat_id, "شما از قبل وارد شده‌اید.", reply_markup=main_menu())
+        send_message(chat_id, "شما از قبل وارد شده‌اید.", reply_markup=main_menu())
         return
     text = "به ربات صندوق کافه خوش آمدید!\nلطفاً وارد شوید."
-    bot.send_message(chat_id, text, reply_markup=login_menu())
+    send_message(chat_id, text, reply_markup=login_menu())
 
-@bot.message_handler(func=lambda m: m.text == 'ورود به سیستم')
+@router.text('ورود به سیستم', login=False)
 def ask_username(m):
-    chat_id = m.chat.id
-    msg = bot.send_message(chat_id, "نام کاربری را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, process_username)
-
-def process_username(message):
-    chat_id = message.chat.id
-    username = message.text.strip()
-    sess = ensure_session(chat_id)
-    sess['temp']['username'] = username
-    msg = bot.send_message(chat_id, "رمز عبور را وارد کنید:")
-    bot.register_next_step_handler(msg, process_password)
+    start_flow(m.chat.id, 'login')
 
-def process_password(message):
-    chat_id = message.chat.id
-    password = message.text.strip()
+def process_password(chat_id, password, data):
     sess = ensure_session(chat_id)
-    username = sess['temp'].get('username')
-    if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+    if data['username'] == ADMIN_USERNAME and password == ADMIN_PASSWORD:
         sess['logged_in'] = True
-        sess['temp'] = {}
-        bot.send_message(chat_id, "ورود با موفقیت انجام شد.", reply_markup=main_menu())
+        save_session(chat_id)
+        send_message(chat_id, "ورود با موفقیت انجام شد.", reply_markup=main_menu())
     else:
-        sess['temp'] = {}
-        bot.send_message(chat_id, "نام کاربری یا رمز عبور اشتباه است.", reply_markup=login_menu())
+        send_message(chat_id, "نام کاربری یا رمز عبور اشتباه است.", reply_markup=login_menu())
+
+register_flow(Flow('login', 'username', {
+    'username': State("نام کاربری را وارد کنید:", parse=required_text(), save='username', next='password', markup=no_keyboard),
+    'password': State("رمز عبور را وارد کنید:", handle=process_password),
+}, login=False))
 
-@bot.message_handler(func=lambda m: m.text == 'خروج از سیستم')
-@login_required
+@router.text('خروج از سیستم')
 def logout(m):
     chat_id = m.chat.id
-    if chat_id in user_sessions:
-        user_sessions[chat_id] = {"logged_in": False, "temp": {}}
-    bot.send_message(chat_id, "از سیستم خارج شدید.", reply_markup=login_menu())
+    session_store.reset(chat_id)
+    send_message(chat_id, "از سیستم خارج شدید.", reply_markup=login_menu())
 
 # ---------- محصولات ----------
-@bot.message_handler(func=lambda m: m.text == 'محصولات')
-@login_required
+@router.text('محصولات')
 def products_root(m):
-    bot.send_message(m.chat.id, "مدیریت محصولات:", reply_markup=products_menu())
+    send_message(m.chat.id, "مدیریت محصولات:", reply_markup=products_menu())
+
+@router.text('لیست محصولات', limit=EXPENSIVE)
+def list_products(m):
+    try:
+        rows = menu_cache.products()
+    except Error as e:
+        send_message(m.chat.id, f"خطا: {e}")
+        return
+    if not rows:
+        send_message(m.chat.id, "هیچ محصولی ثبت نشده است.")
+        return
+    text = "لیست محصولات:\n\n"
+    for p in rows:
+        cat = p['category'] if p['category'] else "بدون دسته"
+        text += f"کد: {p['id']} — {p['name']} — {p['price']:.2f} تومان — دسته: {cat}\n"
+    send_message(m.chat.id, text)
+
+CATEGORY_BY_ID_SQL = "SELECT id FROM category WHERE id = %s"
+CATEGORY_BY_NAME_SQL = "SELECT id FROM category WHERE name = %s"
+PRODUCT_BY_ID_SQL = "SELECT id, name, price, category_id FROM products WHERE id = %s"
+
+@router.text('اضافه کردن محصول')
+def add_product_start(m):
+    start_flow(m.chat.id, 'add_product')
+
+def category_prompt(header):
+    # پیام انتخاب دسته همراه با لیست دسته‌ها از کش منو
+    def prompt(chat_id, data):
+        try:
+            cats = menu_cache.categories()
+        except Error as e:
+            send_message(chat_id, f"خطا: {e}")
+            cats = []
+        text = header + "\n"
+        for c in cats:
+            text += f"{c['id']} — {c['name']}\n"
+        send_message(chat_id, text)
+    return prompt
+
+def add_product_category(chat_id, cat_id, data):
+    if cat_id == 0:
+        # اجازهٔ وارد کردن نام دسته جدید یا خالی
+        return 'new_category'
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال به DB.")
+        return None
+    try:
+        cur = conn.cursor()
+        cur.execute(CATEGORY_BY_ID_SQL, (cat_id,))
+        if cur.fetchone() is None:
+            raise InvalidInput("دسته‌ای با این شناسه یافت نشد.")
+        cur.execute("""
+            INSERT INTO products (name, price, category_id)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (data['name'], data['price'], cat_id))
+        prod_id = cur.fetchone()[0]
+        notify_menu_changed(cur)
+        conn.commit()
+        menu_cache.invalidate()
+        send_message(chat_id, f"محصول ثبت شد. کد محصول: {prod_id}", reply_markup=main_menu())
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا در ثبت محصول: {e}")
+    finally:
+        if conn: conn.close()
+
+def add_product_insert(chat_id, cat_name, data):
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال به DB.")
+        return None
+    try:
+        cur = conn.cursor()
+        if cat_name == 'بدون':
+            category_id = None
+        else:
+            # ایجاد یا بازیابی دسته
+            cur.execute(CATEGORY_BY_NAME_SQL, (cat_name,))
+            row = cur.fetchone()
+            if row:
+                category_id = row[0]
+            else:
+                cur.execute("INSERT INTO category (name) VALUES (%s) RETURNING id", (cat_name,))
+                category_id = cur.fetchone()[0]
+        cur.execute("""
+            INSERT INTO products (name, price, category_id)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (data['name'], data['price'], category_id))
+        prod_id = cur.fetchone()[0]
+        notify_menu_changed(cur)
+        conn.commit()
+        menu_cache.invalidate()
+        send_message(chat_id, f"محصول با موفقیت ثبت شد. کد محصول: {prod_id}", reply_markup=main_menu())
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا در ثبت: {e}")
+    finally:
+        if conn: conn.close()
+
+register_flow(Flow('add_product', 'name', {
+    'name': State("نام محصول را وارد کنید:", parse=required_text("نام نامعتبر است."), save='name', next='price', markup=no_keyboard),
+    'price': State("قیمت محصول را وارد کنید (به تومان):", parse=price_value, save='price', next='category'),
+    'category': State(category_prompt("شناسه دسته را انتخاب کنید یا 0 برای عدم انتخاب/ایجاد دسته جدید وارد کنید:"),
+                      parse=int_value("شناسه دسته باید عدد باشد."), handle=add_product_category),
+    'new_category': State("نام دسته جدید را وارد کنید (یا 'بدون' برای بدون دسته):",
+                          parse=required_text("نام نامعتبر است."), handle=add_product_insert),
+}))
+
+@router.text('ویرایش محصول')
+def edit_product_start(m):
+    start_flow(m.chat.id, 'edit_product')
+
+def edit_product_select(chat_id, pid, data):
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
+    try:
+        cur = conn.cursor()
+        cur.execute(PRODUCT_BY_ID_SQL, (pid,))
+        row = cur.fetchone()
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+        return None
+    finally:
+        if conn: conn.close()
+    if not row:
+        raise InvalidInput("محصول یافت نشد.")
+    data.update({'id': row[0], 'name': row[1], 'price': float(row[2]), 'category_id': row[3]})
+    return 'field'
+
+EDIT_PRODUCT_FIELDS = {'ویرایش نام': 'edit_name', 'ویرایش قیمت': 'edit_price', 'ویرایش دسته': 'edit_category'}
+
+def edit_product_field_prompt(chat_id, data):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(*EDIT_PRODUCT_FIELDS, 'بازگشت')
+    send_message(chat_id, f"محصول انتخاب شد: {data['name']} — {data['price']:.2f}", reply_markup=markup)
+
+def parse_edit_field(text, data):
+    if text not in EDIT_PRODUCT_FIELDS:
+        raise InvalidInput("یکی از گزینه‌های ویرایش را انتخاب کنید.")
+    return EDIT_PRODUCT_FIELDS[text]
+
+def update_product(chat_id, pid, column, value, done_text):
+    # column فقط از همین فایل می‌آید (name/price/category_id)
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال DB.")
+        return
+    try:
+        cur = conn.cursor()
+        if column == 'category_id' and value is not None:
+            cur.execute(CATEGORY_BY_ID_SQL, (value,))
+            if cur.fetchone() is None:
+                raise InvalidInput("دسته‌ای با این شناسه یافت نشد.")
+        cur.execute(f"UPDATE products SET {column} = %s WHERE id = %s", (value, pid))
+        notify_menu_changed(cur)
+        conn.commit()
+        menu_cache.invalidate()
+        send_message(chat_id, done_text, reply_markup=main_menu())
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+    finally:
+        if conn: conn.close()
+
+def perform_edit_name(chat_id, new_name, data):
+    update_product(chat_id, data['id'], 'name', new_name, "نام محصول با موفقیت ویرایش شد.")
+
+def perform_edit_price(chat_id, price, data):
+    update_product(chat_id, data['id'], 'price', price, "قیمت محصول با موفقیت به‌روزرسانی شد.")
+
+def perform_edit_category(chat_id, cat_id, data):
+    update_product(chat_id, data['id'], 'category_id', cat_id or None, "دسته محصول به‌روزرسانی شد.")
+
+register_flow(Flow('edit_product', 'select', {
+    'select': State("کد محصولی که می‌خواهید ویرایش کنید را وارد کنید:", parse=int_value("کد محصول باید عدد باشد."),
+                    handle=edit_product_select, markup=no_keyboard),
+    'field': State(edit_product_field_prompt, parse=parse_edit_field, handle=lambda chat_id, state, data: state),
+    'edit_name': State("نام جدید را وارد کنید:", parse=required_text("نام نامعتبر است."), handle=perform_edit_name, markup=no_keyboard),
+    'edit_price': State("قیمت جدید را وارد کنید:", parse=price_value, handle=perform_edit_price, markup=no_keyboard),
+    'edit_category': State(category_prompt("شناسه دسته را وارد کنید یا 0 برای بدون دسته:"),
+                           parse=int_value("شناسه دسته باید عدد باشد."), handle=perform_edit_category, markup=no_keyboard),
+}))
+
+@router.text('حذف محصول')
+def delete_product_start(m):
+    start_flow(m.chat.id, 'delete_product')
+
+def delete_product_confirm(chat_id, pid, data):
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال DB.")
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM products WHERE id = %s", (pid,))
+        row = cur.fetchone()
+        if not row:
+            raise InvalidInput("محصول یافت نشد.")
+        name = row[0]
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("حذف کن", callback_data=f"delprod:{pid}"))
+        markup.add(types.InlineKeyboardButton("انصراف", callback_data="cancel"))
+        send_message(chat_id, f"آیا می‌خواهید محصول '{name}' حذف شود؟", reply_markup=markup)
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+    finally:
+        if conn: conn.close()
+
+register_flow(Flow('delete_product', 'id', {
+    'id': State("کد محصول برای حذف را وارد کنید:", parse=int_value("کد محصول باید عدد باشد."),
+                handle=delete_product_confirm, markup=no_keyboard),
+}))
 
-@bot.message_handler(func=lambda m: m.text == 'لیست محصولات')
-@login_required
-def list_products(m):
+@router.callback('delprod')
+def callback_delete_product(call):
+    chat_id = call.message.chat.id
+    pid = int(call.data.split(":",1)[1])
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(m.chat.id, "خطا در اتصال به پایگاه داده.")
+        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.name, p.price, c.name
-            FROM products p
-            LEFT JOIN category c ON p.category_id = c.id
-            ORDER BY p.id
-        """)
-        rows = cur.fetchall()
-        if not rows:
-            bot.send_message(m.chat.id, "هیچ محصولی ثبت نشده است.")
-            return
-        text = "لیست محصولات:\n\n"
-        for r in rows:
-            cat = r[3] if r[3] else "بدون دسته"
-            text += f"کد: {r[0]} — {r[1]} — {r[2]:.2f} تومان — دسته: {cat}\n"
-        bot.send_message(m.chat.id, text)
+        cur.execute("DELETE FROM products WHERE id = %s", (pid,))
+        notify_menu_changed(cur)
+        conn.commit()
+        menu_cache.invalidate()
+        bot.edit_message_text("محصول حذف شد.", chat_id, call.message.message_id)
         cur.close()
     except Error as e:
-        bot.send_message(m.chat.id, f"خطا: {e}")
+        bot.answer_callback_query(call.id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'اضافه کردن محصول')
-@login_required
-def add_product_start(m):
-    msg = bot.send_message(m.chat.id, "نام محصول را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, add_product_name)
+# ---------- ورود CSV محصولات ----------
+# ستون‌ها: نام، قیمت، نام دسته (اختیاری). محصولات بر اساس نام تطبیق داده می‌شوند:
+# محصول موجود قیمت/دسته‌اش به‌روز و محصول جدید اضافه می‌شود. دستهٔ خالی دستهٔ فعلی را نگه می‌دارد.
+_IMPORT_HEADER_NAMES = ('name', 'نام')
 
-def add_product_name(message):
-    chat_id = message.chat.id
-    name = message.text.strip()
-    if not name:
-        bot.send_message(chat_id, "نام نامعتبر است.")
-        return
-    sess = ensure_session(chat_id)
-    sess['temp']['new_product'] = {'name': name}
-    bot.send_message(chat_id, "قیمت محصول را وارد کنید (به تومان):")
-    bot.register_next_step_handler(bot.send_message(chat_id, "قیمت:"), add_product_price)  # workaround to show prompt and wait
-    # Actually register next handler properly:
-def add_product_price(message):
-    chat_id = message.chat.id
-    sess = ensure_session(chat_id)
-    if 'new_product' not in sess['temp']:
-        bot.send_message(chat_id, "خطا در روند اضافه کردن محصول.")
-        return
+def parse_import_rows(data):
+    # تجزیهٔ CSV در پایتون تا سطر خراب (تعداد ستون نادرست، سطر خالی) فقط همان سطر را رد کند و
+    # کل COPY را نگه ندارد. [(line, name, price, category, reject), ...] — line شمارهٔ سطر فایل با احتساب سرتیتر
+    rows = []
+    reader = csv.reader(io.StringIO(data.lstrip('\ufeff')))
+    line = 1
+    for record in reader:
+        if reader.line_num == 1 and record and record[0].strip().lower() in _IMPORT_HEADER_NAMES:
+            line = reader.line_num + 1
+            continue
+        if not record or not any(field.strip() for field in record):
+            rows.append((line, None, None, None, 'سطر خالی'))
+        elif not 2 <= len(record) <= 3:
+            rows.append((line, None, None, None, f'{len(record)} ستون (باید ۲ یا ۳ باشد)'))
+        else:
+            rows.append((line, record[0], record[1], record[2] if len(record) > 2 else None, None))
+        line = reader.line_num + 1
+    return rows
+
+def import_products_csv(conn, data):
+    # data: متن CSV — (inserted, updated, unchanged, [(line, reason), ...]) برگردانده می‌شود
+    buf = io.StringIO()
+    csv.writer(buf).writerows(parse_import_rows(data))
+    buf.seek(0)
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE product_import (
+            line INTEGER,
+            name TEXT,
+            price TEXT,
+            category TEXT,
+            price_num NUMERIC(10,2),
+            reject TEXT
+        ) ON COMMIT DROP
+    """)
+    cur.copy_expert("COPY product_import (line, name, price, category, reject) FROM STDIN WITH (FORMAT csv)", buf)
+    # اعتبارسنجی در خود پایگاه داده؛ ارقام فارسی/عربی و جداکنندهٔ هزارگان پذیرفته می‌شوند
+    cur.execute("""
+        UPDATE product_import SET
+            name = nullif(btrim(name), ''),
+            category = nullif(btrim(category), ''),
+            price = translate(btrim(price), '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩٫,٬', '01234567890123456789.')
+    """)
+    cur.execute("""
+        UPDATE product_import SET reject = CASE
+            WHEN name IS NULL THEN 'نام خالی'
+            WHEN price IS NULL OR price !~ '^[0-9]{1,8}([.][0-9]{1,2})?$' THEN 'قیمت نامعتبر'
+        END
+        WHERE reject IS NULL
+    """)
+    cur.execute("UPDATE product_import SET price_num = price::numeric WHERE reject IS NULL")
+    # اگر نامی چند بار تکرار شده باشد آخرین سطر معتبر است
+    cur.execute("""
+        UPDATE product_import s SET reject = 'تکراری (سطر ' || d.last_line || ' استفاده شد)'
+        FROM (
+            SELECT name, max(line) AS last_line FROM product_import
+            WHERE reject IS NULL GROUP BY name HAVING count(*) > 1
+        ) d
+        WHERE s.reject IS NULL AND s.name = d.name AND s.line < d.last_line
+    """)
+    cur.execute("""
+        INSERT INTO category (name)
+        SELECT DISTINCT category FROM product_import WHERE reject IS NULL AND category IS NOT NULL
+        ON CONFLICT (name) DO NOTHING
+    """)
+    # products.name یکتا نیست؛ قفل جلوی درج هم‌زمان همان نام از ربات یا ورود دیگری را می‌گیرد
+    cur.execute("LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("""
+        WITH src AS (
+            SELECT s.name, s.price_num, c.id AS category_id
+            FROM product_import s LEFT JOIN category c ON c.name = s.category
+            WHERE s.reject IS NULL
+        ), upd AS (
+            UPDATE products p
+            SET price = src.price_num, category_id = COALESCE(src.category_id, p.category_id)
+            FROM src
+            WHERE p.name = src.name
+              AND (p.price, p.category_id) IS DISTINCT FROM (src.price_num, COALESCE(src.category_id, p.category_id))
+            RETURNING p.name
+        ), ins AS (
+            INSERT INTO products (name, price, category_id)
+            SELECT src.name, src.price_num, src.category_id FROM src
+            WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.name = src.name)
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM src),
+               (SELECT count(DISTINCT name) FROM upd),
+               (SELECT count(*) FROM ins)
+    """)
+    valid, updated, inserted = cur.fetchone()
+    cur.execute("SELECT line, reject FROM product_import WHERE reject IS NOT NULL ORDER BY line")
+    rejected = cur.fetchall()
+    cur.close()
+    return inserted, updated, valid - updated - inserted, rejected
+
+@router.text('ورود CSV محصولات')
+def import_products_start(m):
+    start_flow(m.chat.id, 'import_products')
+
+def import_products_process(chat_id, message, data):
+    doc = message.document
+    if doc.file_size and doc.file_size > PRODUCT_IMPORT_MAX_BYTES:
+        raise InvalidInput("حجم فایل بیش از حد مجاز است.")
     try:
-        price = float(message.text.strip())
-        if price < 0:
-            raise ValueError()
-    except:
-        bot.send_message(chat_id, "قیمت نامعتبر است. مقدار را به صورت عدد وارد کنید.")
+        content = bot.download_file(bot.get_file(doc.file_id).file_path).decode('utf-8-sig')
+    except telebot.apihelper.ApiException as e:
+        send_message(chat_id, f"خطا در دریافت فایل: {e}", reply_markup=main_menu())
         return
-    sess['temp']['new_product']['price'] = round(price, 2)
-    # نمایش دسته‌ها برای انتخاب
+    except UnicodeDecodeError:
+        raise InvalidInput("فایل باید با کدگذاری UTF-8 باشد.")
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, name FROM category ORDER BY name")
-        cats = cur.fetchall()
-        text = "شناسه دسته را انتخاب کنید یا 0 برای عدم انتخاب/ایجاد دسته جدید وارد کنید:\n"
-        for c in cats:
-            text += f"{c[0]} — {c[1]}\n"
-        bot.send_message(chat_id, text)
-        msg = bot.send_message(chat_id, "شناسه دسته (یا 0):")
-        bot.register_next_step_handler(msg, add_product_category)
-        cur.close()
+        inserted, updated, unchanged, rejected = import_products_csv(conn, content)
+        if inserted or updated:
+            notify_menu_changed(conn.cursor())
+        conn.commit()
+        if inserted or updated:
+            menu_cache.invalidate()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        conn.rollback()
+        send_message(chat_id, f"خطا در ورود فایل (هیچ تغییری اعمال نشد): {e}", reply_markup=main_menu())
+        return
     finally:
-        if conn: conn.close()
+        conn.close()
+    text = f"ورود محصولات انجام شد.\nجدید: {inserted}\nبه‌روزشده: {updated}\nبدون تغییر: {unchanged}\nردشده: {len(rejected)}"
+    for line, reason in rejected[:20]:
+        text += f"\nسطر {line}: {reason}"
+    if len(rejected) > 20:
+        text += f"\n... و {len(rejected) - 20} سطر دیگر"
+    send_message(chat_id, text, reply_markup=main_menu())
 
-def add_product_category(message):
-    chat_id = message.chat.id
-    sess = ensure_session(chat_id)
-    newp = sess['temp'].get('new_product')
-    if not newp:
-        bot.send_message(chat_id, "خطا در روند اضافه کردن محصول.")
-        return
-    cat_text = message.text.strip()
+register_flow(Flow('import_products', 'file', {
+    'file': State("فایل CSV محصولات را بفرستید (ستون‌ها: نام، قیمت، دسته):", document=True,
+                  handle=import_products_process, markup=no_keyboard, limit=EXPENSIVE),
+}))
+
+# ---------- دسته‌بندی‌ها ----------
+@router.text('دسته‌بندی‌ها')
+def categories_root(m):
+    send_message(m.chat.id, "مدیریت دسته‌بندی‌ها:", reply_markup=categories_menu())
+
+@router.text('لیست کتگوری‌ها', limit=EXPENSIVE)
+def list_categories(m):
     try:
-        cat_id = int(cat_text)
-    except:
-        bot.send_message(chat_id, "شناسه دسته باید عدد باشد.")
+        rows = menu_cache.categories()
+    except Error as e:
+        send_message(m.chat.id, f"خطا: {e}")
         return
-
-    if cat_id == 0:
-        # اجازهٔ وارد کردن نام دسته جدید یا خالی
-        msg = bot.send_message(chat_id, "نام دسته جدید را وارد کنید (یا 'بدون' برای بدون دسته):")
-        bot.register_next_step_handler(msg, add_product_insert, cat_id)
+    if not rows:
+        send_message(m.chat.id, "هیچ دسته‌ای ثبت نشده است.")
         return
-    # در صورت انتخاب دستهٔ موجود، چک و وارد DB
+    text = "دسته‌ها:\n"
+    for r in rows:
+        text += f"{r['id']} — {r['name']}\n"
+    send_message(m.chat.id, text)
+
+@router.text('اضافه کردن کتگوری')
+def add_category_start(m):
+    start_flow(m.chat.id, 'add_category')
+
+def add_category_insert(chat_id, name, data):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id FROM category WHERE id = %s", (cat_id,))
-        if cur.fetchone() is None:
-            bot.send_message(chat_id, "دسته‌ای با این شناسه یافت نشد.")
-            return
-        cur.execute("""
-            INSERT INTO products (name, price, category_id)
-            VALUES (%s, %s, %s) RETURNING id
-        """, (newp['name'], newp['price'], cat_id))
-        prod_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO category (name) VALUES (%s) RETURNING id", (name,))
+        cid = cur.fetchone()[0]
+        notify_menu_changed(cur)
         conn.commit()
-        bot.send_message(chat_id, f"محصول ثبت شد. کد محصول: {prod_id}", reply_markup=main_menu())
-        sess['temp'].pop('new_product', None)
+        menu_cache.invalidate()
+        send_message(chat_id, f"دسته ثبت شد. کد: {cid}", reply_markup=categories_menu())
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا در ثبت محصول: {e}")
+        send_message(chat_id, f"خطا در ثبت دسته: {e}")
     finally:
         if conn: conn.close()
 
-def add_product_insert(message, prev_cat_id):
-    # prev_cat_id not used here except to indicate 0 case
-    chat_id = message.chat.id
-    sess = ensure_session(chat_id)
-    newp = sess['temp'].get('new_product')
-    if not newp:
-        bot.send_message(chat_id, "خطا در روند اضافه کردن محصول.")
-        return
-    cat_name = message.text.strip()
-    if cat_name.lower() == 'بدون':
-        category_id = None
-    else:
-        # ایجاد یا بازیابی دسته
-        conn = get_db_connection()
-        if conn is None:
-            bot.send_message(chat_id, "خطا در اتصال به DB.")
-            return
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM category WHERE name = %s", (cat_name,))
-            row = cur.fetchone()
-            if row:
-                category_id = row[0]
-            else:
-                cur.execute("INSERT INTO category (name) VALUES (%s) RETURNING id", (cat_name,))
-                category_id = cur.fetchone()[0]
-            cur.execute("""
-                INSERT INTO products (name, price, category_id)
-                VALUES (%s, %s, %s) RETURNING id
-            """, (newp['name'], newp['price'], category_id))
-            prod_id = cur.fetchone()[0]
-            conn.commit()
-            bot.send_message(chat_id, f"محصول با موفقیت ثبت شد. کد محصول: {prod_id}", reply_markup=main_menu())
-            sess['temp'].pop('new_product', None)
-            cur.close()
-        except Error as e:
-            bot.send_message(chat_id, f"خطا در ثبت: {e}")
-        finally:
-            if conn: conn.close()
+register_flow(Flow('add_category', 'name', {
+    'name': State("نام دسته جدید را وارد کنید:", parse=required_text("نام نامعتبر است."),
+                  handle=add_category_insert, markup=no_keyboard),
+}))
 
-@bot.message_handler(func=lambda m: m.text == 'ویرایش محصول')
-@login_required
-def edit_product_start(m):
-    msg = bot.send_message(m.chat.id, "کد محصولی که می‌خواهید ویرایش کنید را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, edit_product_select)
+def fetch_category_name(chat_id, cid):
+    # None یعنی خطای DB (پیامش فرستاده شده)؛ دستهٔ ناموجود InvalidInput می‌دهد
+    conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM category WHERE id = %s", (cid,))
+        row = cur.fetchone()
+        cur.close()
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+        return None
+    finally:
+        conn.close()
+    if not row:
+        raise InvalidInput("دسته یافت نشد.")
+    return row[0]
 
-def edit_product_select(message):
-    chat_id = message.chat.id
-    pid_text = message.text.strip()
-    if not pid_text.isdigit():
-        bot.send_message(chat_id, "کد محصول باید عدد باشد.")
-        return
-    pid = int(pid_text)
+@router.text('ویرایش کتگوری')
+def edit_category_start(m):
+    start_flow(m.chat.id, 'edit_category')
+
+def edit_category_select(chat_id, cid, data):
+    name = fetch_category_name(chat_id, cid)
+    if name is None:
+        return None
+    data.update({'id': cid, 'name': name})
+    return 'name'
+
+def perform_edit_category_name(chat_id, new_name, data):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name, price, category_id FROM products WHERE id = %s", (pid,))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(chat_id, "محصول یافت نشد.")
-            return
-        sess = ensure_session(chat_id)
-        sess['temp']['edit_product'] = {'id': row[0], 'name': row[1], 'price': float(row[2]), 'category_id': row[3]}
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        markup.add('ویرایش نام', 'ویرایش قیمت', 'ویرایش دسته', 'بازگشت')
-        bot.send_message(chat_id, f"محصول انتخاب شد: {row[1]} — {row[2]:.2f}", reply_markup=markup)
+        cur.execute("UPDATE category SET name = %s WHERE id = %s", (new_name, data['id']))
+        notify_menu_changed(cur)
+        conn.commit()
+        menu_cache.invalidate()
+        send_message(chat_id, "دسته با موفقیت ویرایش شد.", reply_markup=categories_menu())
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text in ['ویرایش نام', 'ویرایش قیمت', 'ویرایش دسته'])
-@login_required
-def edit_product_field(m):
-    chat_id = m.chat.id
-    text = m.text
-    sess = ensure_session(chat_id)
-    if 'edit_product' not in sess['temp']:
-        bot.send_message(chat_id, "هیچ محصولی برای ویرایش انتخاب نشده است.")
-        return
-    if text == 'ویرایش نام':
-        msg = bot.send_message(chat_id, "نام جدید را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, perform_edit_name)
-    elif text == 'ویرایش قیمت':
-        msg = bot.send_message(chat_id, "قیمت جدید را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, perform_edit_price)
-    elif text == 'ویرایش دسته':
-        # نمایش دسته‌ها
-        conn = get_db_connection()
-        if conn is None:
-            bot.send_message(chat_id, "خطا در اتصال DB.")
-            return
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id, name FROM category ORDER BY name")
-            cats = cur.fetchall()
-            textc = "شناسه دسته را وارد کنید یا 0 برای بدون دسته:\n"
-            for c in cats:
-                textc += f"{c[0]} — {c[1]}\n"
-            bot.send_message(chat_id, textc)
-            msg = bot.send_message(chat_id, "شناسه دسته:")
-            bot.register_next_step_handler(msg, perform_edit_category)
-            cur.close()
-        except Error as e:
-            bot.send_message(chat_id, f"خطا: {e}")
-        finally:
-            if conn: conn.close()
+register_flow(Flow('edit_category', 'select', {
+    'select': State("کد دسته‌ای که می‌خواهید ویرایش کنید را وارد کنید:", parse=int_value("کد دسته باید عدد باشد."),
+                    handle=edit_category_select, markup=no_keyboard),
+    'name': State(lambda chat_id, data: send_message(chat_id, f"نام فعلی: {data['name']}\nنام جدید را وارد کنید:"),
+                  parse=required_text("نام نامعتبر است."), handle=perform_edit_category_name),
+}))
 
-def perform_edit_name(message):
-    chat_id = message.chat.id
-    new_name = message.text.strip()
-    sess = ensure_session(chat_id)
-    pid = sess['temp']['edit_product']['id']
-    if not new_name:
-        bot.send_message(chat_id, "نام نامعتبر است.")
+@router.text('حذف کتگوری')
+def delete_category_start(m):
+    start_flow(m.chat.id, 'delete_category')
+
+def delete_category_confirm(chat_id, cid, data):
+    name = fetch_category_name(chat_id, cid)
+    if name is None:
         return
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("حذف", callback_data=f"delcat:{cid}"))
+    markup.add(types.InlineKeyboardButton("انصراف", callback_data="cancel"))
+    send_message(chat_id, f"آیا می‌خواهید دسته '{name}' حذف شود؟", reply_markup=markup)
+
+register_flow(Flow('delete_category', 'id', {
+    'id': State("کد دسته برای حذف را وارد کنید (توجه: محصولات مرتبط دسته‌شان NULL خواهد شد):",
+                parse=int_value("کد دسته باید عدد باشد."), handle=delete_category_confirm, markup=no_keyboard),
+}))
+
+@router.callback('delcat')
+def callback_delete_category(call):
+    cid = int(call.data.split(":",1)[1])
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("UPDATE products SET name = %s WHERE id = %s", (new_name, pid))
+        # حذف دسته — محصولات مرتبط category_id = NULL خواهد شد بخاطر ON DELETE SET NULL (یا می‌توانیم دستی انجام دهیم)
+        cur.execute("DELETE FROM category WHERE id = %s", (cid,))
+        notify_menu_changed(cur)
         conn.commit()
-        bot.send_message(chat_id, "نام محصول با موفقیت ویرایش شد.", reply_markup=main_menu())
-        sess['temp'].pop('edit_product', None)
+        menu_cache.invalidate()
+        bot.edit_message_text("دسته حذف شد.", call.message.chat.id, call.message.message_id)
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        bot.answer_callback_query(call.id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-def perform_edit_price(message):
-    chat_id = message.chat.id
-    try:
-        price = float(message.text.strip())
-        if price < 0:
-            raise ValueError()
-    except:
-        bot.send_message(chat_id, "قیمت نامعتبر است.")
-        return
-    sess = ensure_session(chat_id)
-    pid = sess['temp']['edit_product']['id']
+# ---------- سفارش‌گیری ----------
+@router.text('ثبت سفارش')
+def start_order(m):
+    chat_id = m.chat.id
+    # گزینه: انتخاب مشتری یا افزودن مشتری جدید
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add('انتخاب مشتری', 'اضافه کردن مشتری', 'انصراف')
+    send_message(chat_id, "می‌خواهید با کدام مشتری سفارش ثبت شود؟", reply_markup=markup)
+
+@router.text('اضافه کردن مشتری')
+def add_customer_start(m):
+    start_flow(m.chat.id, 'add_customer')
+
+_PHONE_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+
+def normalize_phone(text):
+    # «+98 912-345 6789»، «۰۹۱۲۳۴۵۶۷۸۹» و «9123456789» همه به 09123456789 تبدیل می‌شوند
+    if not text:
+        return None
+    digits = ''.join(ch for ch in text.translate(_PHONE_DIGITS) if '0' <= ch <= '9')
+    if digits.startswith('0098'):
+        digits = '0' + digits[4:]
+    elif digits.startswith('98') and len(digits) == 12:
+        digits = '0' + digits[2:]
+    elif digits.startswith('9') and len(digits) == 10:
+        digits = '0' + digits
+    return digits or None
+
+def add_customer_insert(chat_id, phone, data):
+    phone_norm = normalize_phone(phone)
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("UPDATE products SET price = %s WHERE id = %s", (round(price,2), pid))
+        # مشتری با شمارهٔ تکراری دوباره ساخته نمی‌شود؛ همان رکورد قبلی برگردانده می‌شود
+        cur.execute("""
+            INSERT INTO customers (name, phone, phone_norm) VALUES (%s, %s, %s)
+            ON CONFLICT (phone_norm) WHERE phone_norm IS NOT NULL
+            DO UPDATE SET phone_norm = customers.phone_norm
+            RETURNING id, name, (xmax = 0) AS inserted
+        """, (data['name'], phone if phone_norm else None, phone_norm))
+        cid, name, inserted = cur.fetchone()
         conn.commit()
-        bot.send_message(chat_id, "قیمت محصول با موفقیت به‌روزرسانی شد.", reply_markup=main_menu())
-        sess['temp'].pop('edit_product', None)
+        if inserted:
+            text = f"مشتری ثبت شد. کد مشتری: {cid}"
+        else:
+            text = f"مشتری با این شماره از قبل ثبت شده است: {name} (کد {cid})"
+        send_message(chat_id, text + "\nحال می‌توانید سفارش را ادامه دهید.", reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add('انتخاب مشتری'))
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-def perform_edit_category(message):
-    chat_id = message.chat.id
-    cat_text = message.text.strip()
-    try:
-        cat_id = int(cat_text)
-    except:
-        bot.send_message(chat_id, "شناسه دسته باید عدد باشد.")
-        return
-    sess = ensure_session(chat_id)
-    pid = sess['temp']['edit_product']['id']
-    if cat_id == 0:
-        new_cat = None
-    else:
-        conn = get_db_connection()
-        if conn is None:
-            bot.send_message(chat_id, "خطا در اتصال DB.")
-            return
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM category WHERE id = %s", (cat_id,))
-            if cur.fetchone() is None:
-                bot.send_message(chat_id, "دسته‌ای با این شناسه یافت نشد.")
-                return
-            cur.close()
-            new_cat = cat_id
-        except Error as e:
-            bot.send_message(chat_id, f"خطا: {e}")
-            return
-        finally:
-            if conn: conn.close()
+register_flow(Flow('add_customer', 'name', {
+    'name': State("نام مشتری را وارد کنید:", parse=required_text("نام نامعتبر است."), save='name', next='phone', markup=no_keyboard),
+    'phone': State("شماره تلفن را وارد کنید (اختیاری):", handle=add_customer_insert),
+}))
+
+CUSTOMER_SEARCH_LIMIT = int(os.environ.get("CUSTOMER_SEARCH_LIMIT", "10"))
+
+def _like_prefix(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search_customers(cur, query, limit=CUSTOMER_SEARCH_LIMIT):
+    # عدد با ۷ رقم یا بیشتر: جستجوی پیشوند تلفن؛ در غیر این صورت پیشوند نام و
+    # سپس شباهت trigram — هر دو روی ایندکس، فقط limit ردیف برتر
+    phone = normalize_phone(query)
+    if phone and len(phone) >= 7 and not any(ch.isalpha() for ch in query):
+        cur.execute("""
+            SELECT id, name, phone FROM customers
+            WHERE phone_norm LIKE %s
+            ORDER BY phone_norm
+            LIMIT %s
+        """, (phone + '%', limit))
+        return cur.fetchall()
+    cur.execute("""
+        SELECT id, name, phone FROM customers
+        WHERE name ILIKE %(prefix)s OR name %% %(q)s
+        ORDER BY (name ILIKE %(prefix)s) DESC, similarity(name, %(q)s) DESC, name
+        LIMIT %(limit)s
+    """, {'prefix': _like_prefix(query), 'q': query, 'limit': limit})
+    return cur.fetchall()
+
+def customers_markup(rows):
+    markup = types.InlineKeyboardMarkup()
+    for r in rows:
+        markup.add(types.InlineKeyboardButton(f"{r[1]} — {r[2] or '-'} (کد {r[0]})", callback_data=f"selcust:{r[0]}"))
+    return markup
+
+def begin_customer_order(chat_id, cid, name):
+    # گفتگوی «انتخاب مشتری» (اگر باز باشد) با گفتگوی سفارش جایگزین می‌شود
+    send_message(chat_id, f"مشتری انتخاب شد: {name}\nحالا محصولات را اضافه کنید؛ چند آیتم را می‌توانید یک‌جا بفرستید (مثال: 12x2, 5, 7x3).\nبرای انتخاب از منو 'list'، سبد 'cart' و برای پایان و ثبت سفارش 'done' وارد کنید.", reply_markup=types.ReplyKeyboardRemove())
+    send_picker(chat_id)
+    # key: idempotency key سفارش که همراه گفتگو در سشن ذخیره می‌شود؛ ثبت دوباره همان سفارش را برمی‌گرداند
+    start_flow(chat_id, 'order', {'customer_id': cid, 'customer': name, 'items': [], 'key': uuid.uuid4().hex})
+
+CUSTOMER_BY_ID_SQL = "SELECT id, name FROM customers WHERE id = %s"
+CUSTOMER_LIST_SQL = "SELECT id, name, phone FROM customers ORDER BY name LIMIT %s"
+
+@router.text('انتخاب مشتری')
+def select_customer_start(m):
+    start_flow(m.chat.id, 'select_customer')
+
+def select_customer_process(chat_id, text, data):
     conn = get_db_connection()
+    if conn is None:
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
     try:
         cur = conn.cursor()
-        cur.execute("UPDATE products SET category_id = %s WHERE id = %s", (new_cat, pid))
-        conn.commit()
-        bot.send_message(chat_id, "دسته محصول به‌روزرسانی شد.", reply_markup=main_menu())
-        sess['temp'].pop('edit_product', None)
+        if text.isdigit() and len(text) < 7:
+            # کد مشتری
+            cur.execute(CUSTOMER_BY_ID_SQL, (int(text),))
+            row = cur.fetchone()
+            if not row:
+                raise InvalidInput("مشتری یافت نشد.")
+            begin_customer_order(chat_id, row[0], row[1])
+            return None
+        if text.lower() == 'list':
+            cur.execute(CUSTOMER_LIST_SQL, (CUSTOMER_SEARCH_LIMIT,))
+            rows = cur.fetchall()
+            header = f"{CUSTOMER_SEARCH_LIMIT} مشتری اول (برای یافتن بقیه نام یا شماره را جستجو کنید):"
+        else:
+            rows = search_customers(cur, text)
+            header = "نتایج جستجو:"
         cur.close()
+        if not rows:
+            raise InvalidInput("مشتری‌ای یافت نشد.")
+        send_message(chat_id, header, reply_markup=customers_markup(rows))
+        return 'pick'
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}")
+        return None
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'حذف محصول')
-@login_required
-def delete_product_start(m):
-    msg = bot.send_message(m.chat.id, "کد محصول برای حذف را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, delete_product_confirm)
+register_flow(Flow('select_customer', 'search', {
+    'search': State("کد مشتری، بخشی از نام یا شماره تلفن را وارد کنید (یا 'list'):",
+                    parse=required_text("عبارت جستجو نامعتبر است."), handle=select_customer_process,
+                    markup=no_keyboard, limit=EXPENSIVE),
+    'pick': State("مشتری را انتخاب کنید یا جستجوی دیگری وارد کنید:",
+                  parse=required_text("عبارت جستجو نامعتبر است."), handle=select_customer_process, limit=EXPENSIVE),
+}))
 
-def delete_product_confirm(message):
-    chat_id = message.chat.id
-    pid_text = message.text.strip()
-    if not pid_text.isdigit():
-        bot.send_message(chat_id, "کد محصول باید عدد باشد.")
-        return
-    pid = int(pid_text)
+@router.callback('selcust')
+def callback_select_customer(call):
+    chat_id = call.message.chat.id
+    cid = int(call.data.split(":", 1)[1])
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT name FROM products WHERE id = %s", (pid,))
+        cur.execute(CUSTOMER_BY_ID_SQL, (cid,))
         row = cur.fetchone()
+        cur.close()
         if not row:
-            bot.send_message(chat_id, "محصول یافت نشد.")
+            bot.answer_callback_query(call.id, "مشتری یافت نشد.")
             return
-        name = row[0]
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("حذف کن", callback_data=f"delprod:{pid}"))
-        markup.add(types.InlineKeyboardButton("انصراف", callback_data="cancel"))
-        bot.send_message(chat_id, f"آیا می‌خواهید محصول '{name}' حذف شود؟", reply_markup=markup)
-        cur.close()
+        bot.answer_callback_query(call.id)
+        begin_customer_order(chat_id, row[0], row[1])
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        bot.answer_callback_query(call.id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("delprod:"))
-def callback_delete_product(call):
+ORDER_ITEM_PROMPT = "کد محصول (یا چند آیتم مثل 12x2, 5, 7x3)، 'list'، 'cart' یا 'done':"
+_ORDER_ITEM_RE = re.compile(r'(\d+)\s*(?:[x×*]\s*(\d+))?')
+_ORDER_SEPARATORS_RE = re.compile(r'[\s,،;]*')
+
+def parse_order_items(text):
+    # «12x2, 5, 7x3» -> {12: 2, 5: 1, 7: 3}؛ سطرهای تکراری جمع می‌شوند
+    text = text.translate(_PHONE_DIGITS).lower()
+    items = {}
+    pos = 0
+    for m in _ORDER_ITEM_RE.finditer(text):
+        if not _ORDER_SEPARATORS_RE.fullmatch(text, pos, m.start()):
+            raise ValueError()
+        pid, qty = int(m.group(1)), int(m.group(2) or 1)
+        if qty < 1:
+            raise ValueError()
+        items[pid] = items.get(pid, 0) + qty
+        pos = m.end()
+    if not items or not _ORDER_SEPARATORS_RE.fullmatch(text, pos):
+        raise ValueError()
+    return items
+
+def cart_set(order, product, qty, add=True):
+    # هر محصول فقط یک سطر در سبد دارد؛ qty <= 0 سطر را حذف می‌کند
+    for it in order['items']:
+        if it['product_id'] == product['id']:
+            it['quantity'] = it['quantity'] + qty if add else qty
+            if it['quantity'] <= 0:
+                order['items'].remove(it)
+            return
+    if qty > 0:
+        order['items'].append({'product_id': product['id'], 'name': product['name'], 'quantity': qty, 'price': product['price']})
+
+def render_cart(order):
+    if not order['items']:
+        return "سبد خالی است."
+    text = "سبد سفارش:\n"
+    for it in order['items']:
+        text += f"{it['product_id']} — {it['name']} x {it['quantity']} — {it['quantity'] * it['price']:.2f}\n"
+    total = sum(it['quantity'] * it['price'] for it in order['items'])
+    text += f"جمع: {total:.2f} تومان\nحذف: -کد   تغییر تعداد: کد=تعداد"
+    return text
+
+def add_order_item(chat_id, text, order):
+    command = text.lower()
+    if command == 'list':
+        send_picker(chat_id)
+        return 'items'
+    if command in ('cart', 'سبد'):
+        send_message(chat_id, render_cart(order))
+        return 'items'
+    if command == 'done':
+        # ثبت سفارش نهایی؛ اگر ثبت نشد سبد می‌ماند تا دوباره 'done' زده شود
+        if not order['items']:
+            send_message(chat_id, "هیچ آیتمی اضافه نشده است. سفارش لغو شد.")
+            return None
+        return None if save_order(chat_id, order) else 'items'
+    edit = re.fullmatch(r'(-)\s*(\d+)|(\d+)\s*=\s*(\d+)', text.translate(_PHONE_DIGITS))
+    if edit:
+        # ویرایش سبد: «-12» حذف، «12=3» تغییر تعداد
+        pid = int(edit.group(2) or edit.group(3))
+        qty = 0 if edit.group(1) else int(edit.group(4))
+        line = next((it for it in order['items'] if it['product_id'] == pid), None)
+        if line is None:
+            raise InvalidInput("این محصول در سبد نیست.")
+        cart_set(order, {'id': pid, 'name': line['name'], 'price': line['price']}, qty, add=False)
+        send_message(chat_id, render_cart(order))
+        return 'items'
+    if text.translate(_PHONE_DIGITS).isdigit():
+        # یک کد تنها: مثل قبل تعداد پرسیده می‌شود
+        order['pending_product'] = int(text.translate(_PHONE_DIGITS))
+        return 'quantity'
+    try:
+        wanted = parse_order_items(text)
+    except ValueError:
+        raise InvalidInput("ورودی نامعتبر است. نمونه: 12x2, 5, 7x3")
+    # اعتبارسنجی و قیمت همهٔ کدها یک‌جا
+    try:
+        products = menu_cache.products_by_ids(list(wanted))
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+        return 'items'
+    unknown = [str(pid) for pid in wanted if pid not in products]
+    if unknown:
+        # هیچ آیتمی اضافه نمی‌شود تا صندوق‌دار کل سطر را اصلاح کند
+        raise InvalidInput(f"این کدها یافت نشدند: {', '.join(unknown)}")
+    for pid, qty in wanted.items():
+        cart_set(order, products[pid], qty)
+    send_message(chat_id, render_cart(order))
+    return 'items'
+
+# ---------- انتخابگر محصول ----------
+# کاتالوگ به صورت کیبورد inline: دسته‌ها ← محصولات دسته (صفحه‌بندی‌شده) ← تعداد.
+# JSON هر کیبورد یک بار ساخته و در menu_cache نگه داشته می‌شود؛ هر لمس فقط یک
+# edit_message_text با همان JSON است و هیچ کوئری‌ای اجرا نمی‌کند.
+# callback_data:
+#   pk:r                   لیست دسته‌ها
+#   pk:c:<cat>:<page>      محصولات دسته (0 = بدون دسته)
+#   pk:p:<pid>             انتخاب تعداد
+#   pk:q:<pid>:<qty>:<cat>:<page>   افزودن به سبد و بازگشت به صفحهٔ همان دسته
+#   pk:cart / pk:done      نمایش سبد / ثبت سفارش
+PICKER_QUANTITIES = (1, 2, 3, 4, 5, 6)
+
+def _picker_root(data):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = [types.InlineKeyboardButton(f"{c['name']} ({len(data['by_category'][c['id']])})", callback_data=f"pk:c:{c['id']}:0")
+               for c in data['categories'] if c['id'] in data['by_category']]
+    if 0 in data['by_category']:
+        buttons.append(types.InlineKeyboardButton(f"بدون دسته ({len(data['by_category'][0])})", callback_data="pk:c:0:0"))
+    markup.add(*buttons)
+    markup.row(types.InlineKeyboardButton("سبد", callback_data="pk:cart"),
+               types.InlineKeyboardButton("ثبت سفارش", callback_data="pk:done"))
+    return markup.to_json()
+
+def _picker_category(cat, page):
+    def build(data):
+        pids = data['by_category'].get(cat, [])
+        pages = max(1, -(-len(pids) // PICKER_PAGE_SIZE))
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(*[types.InlineKeyboardButton(f"{data['products'][pid]['name']} — {data['products'][pid]['price']:,.0f}",
+                                                callback_data=f"pk:p:{pid}")
+                     for pid in pids[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE]])
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("«", callback_data=f"pk:c:{cat}:{page - 1}"))
+        nav.append(types.InlineKeyboardButton(f"دسته‌ها ({page + 1}/{pages})", callback_data="pk:r"))
+        if page + 1 < pages:
+            nav.append(types.InlineKeyboardButton("»", callback_data=f"pk:c:{cat}:{page + 1}"))
+        markup.row(*nav)
+        return markup.to_json()
+    return build
+
+def _picker_quantity(pid):
+    def build(data):
+        cat = data['products'][pid]['category_id'] or 0
+        back = f"{cat}:{data['by_category'][cat].index(pid) // PICKER_PAGE_SIZE}"
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(*[types.InlineKeyboardButton(str(q), callback_data=f"pk:q:{pid}:{q}:{back}") for q in PICKER_QUANTITIES])
+        markup.row(types.InlineKeyboardButton("بازگشت", callback_data=f"pk:c:{back}"))
+        return markup.to_json()
+    return build
+
+def send_picker(chat_id):
+    try:
+        markup = menu_cache.keyboard('root', _picker_root)
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+        return
+    send_message(chat_id, "دسته را انتخاب کنید:", reply_markup=markup)
+
+def _show_picker(call, key, build, text="دسته را انتخاب کنید:"):
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=menu_cache.keyboard(key, build))
+    except telebot.apihelper.ApiTelegramException:
+        # همان کیبورد دوباره زده شده (message is not modified)
+        pass
+
+@router.callback('pk')
+def callback_picker(call):
     chat_id = call.message.chat.id
-    pid = int(call.data.split(":",1)[1])
+    order = active_flow(chat_id, 'order')
+    if order is None:
+        bot.answer_callback_query(call.id, "هیچ سفارشی در جریان نیست. ابتدا مشتری را انتخاب کنید.")
+        return
+    parts = call.data.split(':')
+    action = parts[1]
+    try:
+        if action == 'r':
+            _show_picker(call, 'root', _picker_root)
+        elif action == 'c':
+            cat, page = int(parts[2]), int(parts[3])
+            _show_picker(call, ('cat', cat, page), _picker_category(cat, page))
+        elif action == 'p':
+            pid = int(parts[2])
+            product = menu_cache.product(pid)
+            if product is None or 'category_id' not in product:
+                # محصول حذف شده، یا هنوز به کش منو نرسیده (کیبورد قدیمی)
+                bot.answer_callback_query(call.id, "محصول یافت نشد.")
+                _show_picker(call, 'root', _picker_root)
+                return
+            _show_picker(call, ('qty', pid), _picker_quantity(pid), f"تعداد «{product['name']}»:")
+        elif action == 'q':
+            pid, qty, cat, page = map(int, parts[2:6])
+            product = menu_cache.product(pid)
+            if product is None:
+                bot.answer_callback_query(call.id, "محصول یافت نشد.")
+                return
+            cart_set(order, product, qty)
+            bot.answer_callback_query(call.id, f"{product['name']} x {qty} به سبد اضافه شد.")
+            _show_picker(call, ('cat', cat, page), _picker_category(cat, page))
+            return
+        elif action == 'cart':
+            send_message(chat_id, render_cart(order))
+        elif action == 'done':
+            bot.answer_callback_query(call.id)
+            if add_order_item(chat_id, 'done', order) is None:
+                end_flow(chat_id)
+            return
+    except Error as e:
+        bot.answer_callback_query(call.id, f"خطا: {e}")
+        return
+    bot.answer_callback_query(call.id)
+
+def add_order_item_quantity(chat_id, qty, order):
+    pid = order.pop('pending_product')
+    # گرفتن قیمت فعلی محصول از کش منو
+    try:
+        product = menu_cache.product(pid)
+    except Error as e:
+        send_message(chat_id, f"خطا: {e}")
+        return 'items'
+    if not product:
+        send_message(chat_id, "محصول یافت نشد.")
+        return 'items'
+    # اضافه کردن به سفارش موقتی (محصول تکراری به تعداد سطر قبلی اضافه می‌شود)
+    cart_set(order, product, qty)
+    send_message(chat_id, f"آیتم اضافه شد: {product['name']} x {qty} — واحد: {product['price']:.2f}")
+    return 'items'
+
+# دادهٔ گفتگوی سفارش همان سفارش موقتی است: {'customer_id', 'items': [...], 'key', 'pending_product'?}
+register_flow(Flow('order', 'items', {
+    'items': State(ORDER_ITEM_PROMPT, handle=add_order_item),
+    'quantity': State("تعداد را وارد کنید:", parse=int_value("تعداد باید عدد صحیح مثبت باشد.", minimum=1),
+                      handle=add_order_item_quantity),
+}))
+
+def persist_order(cur, order):
+    # هدر سفارش و همهٔ آیتم‌ها در یک دستور درج می‌شوند و مجموع در سمت سرور از
+    # همان ردیف‌های order_items محاسبه می‌شود (دو رفت‌وبرگشت، مستقل از تعداد آیتم‌ها)
+    # اگر سفارشی با همان idempotency key از قبل ثبت شده باشد هیچ ردیفی درج نمی‌شود و None برمی‌گردد.
+    # id و تاریخ از قبل گرفته می‌شوند تا کلید در order_keys ثبت و سفارش در پارتیشن همان ماه درج شود
+    items = order['items']
+    cur.execute("""
+        WITH ids AS (
+            SELECT nextval('orders_id_seq')::int AS id, LOCALTIMESTAMP AS order_date
+        ), claim AS (
+            INSERT INTO order_keys (key, order_id, order_date)
+            SELECT %(key)s::uuid, id, order_date FROM ids WHERE %(key)s IS NOT NULL
+            ON CONFLICT (key) DO NOTHING
+            RETURNING order_id
+        ), new_order AS (
+            INSERT INTO orders (id, customer_id, order_date, total, status)
+            SELECT id, %(customer)s, order_date, 0, 'pending' FROM ids
+            WHERE %(key)s IS NULL OR EXISTS (SELECT 1 FROM claim)
+            RETURNING id, order_date
+        )
+        INSERT INTO order_items (order_id, order_date, product_id, quantity, price_at_order)
+        SELECT new_order.id, new_order.order_date, v.product_id, v.quantity, v.price_at_order
+        FROM new_order,
+             unnest(%(products)s::int[], %(quantities)s::int[], %(prices)s::numeric[]) AS v(product_id, quantity, price_at_order)
+        RETURNING order_id, order_date
+    """, {'key': order.get('key'), 'customer': order['customer_id'],
+          'products': [it['product_id'] for it in items],
+          'quantities': [it['quantity'] for it in items],
+          'prices': [round(it['price'], 2) for it in items]})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    order_id, order_date = row
+    # جمع‌های روزانهٔ گزارش‌ها هم در همین دستور به‌روز می‌شوند
+    cur.execute("""
+        WITH upd AS (
+            UPDATE orders
+            SET total = (SELECT COALESCE(SUM(quantity * price_at_order), 0)
+                         FROM order_items WHERE order_id = %(id)s AND order_date = %(date)s)
+            WHERE id = %(id)s AND order_date = %(date)s
+            RETURNING id, order_date, total
+        ), day_orders AS (
+            INSERT INTO daily_orders (day, orders_count, revenue)
+            SELECT order_date::date, 1, total FROM upd
+            ON CONFLICT (day) DO UPDATE
+            SET orders_count = daily_orders.orders_count + EXCLUDED.orders_count,
+                revenue = daily_orders.revenue + EXCLUDED.revenue
+        ), day_sales AS (
+            INSERT INTO daily_sales (day, product_id, quantity, revenue)
+            SELECT upd.order_date::date, COALESCE(oi.product_id, 0), SUM(oi.quantity), SUM(oi.quantity * oi.price_at_order)
+            FROM upd JOIN order_items oi ON oi.order_id = upd.id AND oi.order_date = upd.order_date
+            GROUP BY 1, 2
+            ON CONFLICT (day, product_id) DO UPDATE
+            SET quantity = daily_sales.quantity + EXCLUDED.quantity,
+                revenue = daily_sales.revenue + EXCLUDED.revenue
+        )
+        SELECT order_date, total FROM upd
+    """, {'id': order_id, 'date': order_date})
+    order_date, total = cur.fetchone()
+    return order_id, order_date, total
+
+def apply_sales_delta(cur, order_ids, sign):
+    # ابزار نگهداری: سهم سفارش‌ها را به جمع‌های روزانه اضافه (sign=+1) یا از آن کم (sign=-1) می‌کند،
+    # مثلاً پیش از پاک کردن سفارش‌های آزمایشی (bench.py)؛ تغییر وضعیت این کار را خودش در transition_orders انجام می‌دهد
+    cur.execute("""
+        WITH o AS (
+            SELECT id, order_date, order_date::date AS day, total FROM orders WHERE id = ANY(%(ids)s)
+        ), day_orders AS (
+            INSERT INTO daily_orders (day, orders_count, revenue)
+            SELECT day, %(sign)s * COUNT(*), %(sign)s * SUM(total) FROM o GROUP BY day
+            ON CONFLICT (day) DO UPDATE
+            SET orders_count = daily_orders.orders_count + EXCLUDED.orders_count,
+                revenue = daily_orders.revenue + EXCLUDED.revenue
+        )
+        INSERT INTO daily_sales (day, product_id, quantity, revenue)
+        SELECT o.day, COALESCE(oi.product_id, 0), %(sign)s * SUM(oi.quantity), %(sign)s * SUM(oi.quantity * oi.price_at_order)
+        FROM o JOIN order_items oi ON oi.order_id = o.id AND oi.order_date = o.order_date
+        GROUP BY 1, 2
+        ON CONFLICT (day, product_id) DO UPDATE
+        SET quantity = daily_sales.quantity + EXCLUDED.quantity,
+            revenue = daily_sales.revenue + EXCLUDED.revenue
+    """, {'ids': list(order_ids), 'sign': sign})
+
+def notify_order_event(cur, order_id, status):
+    # payload «id:status»؛ بعد از commit به صف آشپزخانه (و هر شنوندهٔ دیگری) می‌رسد
+    cur.execute("SELECT pg_notify(%s, %s)", (ORDER_CHANNEL, f"{order_id}:{status}"))
+
+# تغییرهای مجاز وضعیت؛ cancelled پایانی است (سفارش لغوشده برنمی‌گردد)
+ORDER_TRANSITIONS = {
+    'pending': ('served', 'cancelled'),
+    'served': ('pending', 'cancelled'),
+    'cancelled': (),
+}
+
+def transition_orders(cur, new_status, ids=None, older_than=None, from_status=None, changed_by=None):
+    # یک دستور: قفل سفارش‌های هدف، UPDATE، ثبت در order_status_history، کم کردن سفارش‌های لغوشده
+    # از جمع‌های روزانه و NOTIFY. فقط سفارش‌هایی که از وضعیت فعلی‌شان به new_status مجازند تغییر می‌کنند.
+    # [(order_id, old_status), ...] برگردانده می‌شود
+    sources = [s for s, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    if from_status is not None:
+        sources = [s for s in sources if s == from_status]
+    filters = ""
+    if ids is not None:
+        filters += " AND id = ANY(%(ids)s)"
+    if older_than is not None:
+        filters += " AND order_date < now() - %(age)s"
+    cur.execute(f"""
+        WITH target AS (
+            SELECT id, order_date, status FROM orders
+            WHERE status = ANY(%(sources)s){filters}
+            ORDER BY id
+            FOR UPDATE
+        ), upd AS (
+            UPDATE orders o SET status = %(new)s
+            FROM target t
+            WHERE o.id = t.id AND o.order_date = t.order_date
+            RETURNING o.id, t.status AS old_status, o.order_date, o.order_date::date AS day, o.total
+        ), hist AS (
+            INSERT INTO order_status_history (order_id, old_status, new_status, changed_by)
+            SELECT id, old_status, %(new)s, %(by)s FROM upd
+        ), cancelled AS (
+            SELECT id, order_date, day, total FROM upd WHERE %(new)s = 'cancelled'
+        ), day_orders AS (
+            INSERT INTO daily_orders (day, orders_count, revenue)
+            SELECT day, -COUNT(*), -SUM(total) FROM cancelled GROUP BY day
+            ON CONFLICT (day) DO UPDATE
+            SET orders_count = daily_orders.orders_count + EXCLUDED.orders_count,
+                revenue = daily_orders.revenue + EXCLUDED.revenue
+        ), day_sales AS (
+            INSERT INTO daily_sales (day, product_id, quantity, revenue)
+            SELECT c.day, COALESCE(oi.product_id, 0), -SUM(oi.quantity), -SUM(oi.quantity * oi.price_at_order)
+            FROM cancelled c JOIN order_items oi ON oi.order_id = c.id AND oi.order_date = c.order_date
+            GROUP BY 1, 2
+            ON CONFLICT (day, product_id) DO UPDATE
+            SET quantity = daily_sales.quantity + EXCLUDED.quantity,
+                revenue = daily_sales.revenue + EXCLUDED.revenue
+        )
+        SELECT id, old_status, pg_notify(%(channel)s, id || ':' || %(new)s) FROM upd ORDER BY id
+    """, {'sources': sources, 'ids': list(ids) if ids is not None else None, 'age': older_than,
+          'new': new_status, 'by': changed_by, 'channel': ORDER_CHANNEL})
+    return [(r[0], r[1]) for r in cur.fetchall()]
+
+def set_order_status(cur, oid, new_status, expected=None, changed_by=None):
+    # وضعیت قبلی برگردانده می‌شود (None اگر سفارش نباشد یا این تغییر مجاز نباشد)
+    rows = transition_orders(cur, new_status, ids=[oid], from_status=expected, changed_by=changed_by)
+    return rows[0][1] if rows else None
+
+def save_order(chat_id, order):
+    # کد سفارش ثبت‌شده (True اگر ثبت قبلی همین سفارش دیگر در orders نباشد)، یا None در صورت خطا
     conn = get_db_connection()
     if conn is None:
-        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
-        return
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM products WHERE id = %s", (pid,))
+        result = persist_order(cur, order)
+        if result is None:
+            # همین سفارش قبلاً ثبت شده (done تکراری یا آپدیتی که دوباره تحویل شده)؛ همان نتیجه گزارش می‌شود
+            ORDERS_DUPLICATE.inc()
+            cur.execute("""
+                SELECT k.order_id, o.order_date, o.total
+                FROM order_keys k LEFT JOIN orders o ON o.id = k.order_id AND o.order_date = k.order_date
+                WHERE k.key = %s
+            """, (order['key'],))
+            result = cur.fetchone()
+            if result is None or result[2] is None:
+                # سفارش قبلی آرشیو یا حذف شده (یا کلیدش همزمان پاک شده)؛ فقط ثبت قبلی گزارش می‌شود
+                conn.commit()
+                code = f"\nکد سفارش: {result[0]}" if result else ""
+                send_message(chat_id, f"این سفارش قبلاً ثبت شده است.{code}", reply_markup=main_menu())
+                cur.close()
+                return result[0] if result else True
+        else:
+            notify_order_event(cur, result[0], 'pending')
         conn.commit()
-        bot.edit_message_text("محصول حذف شد.", chat_id, call.message.message_id)
+        order_id, order_date, total = result
+        send_message(chat_id, f"سفارش ثبت شد.\nکد سفارش: {order_id}\nتاریخ: {order_date.strftime('%Y-%m-%d %H:%M')}\nمجموع: {total:.2f} تومان", reply_markup=main_menu())
         cur.close()
     except Error as e:
-        bot.answer_callback_query(call.id, f"خطا: {e}")
+        send_message(chat_id, f"خطا در ثبت سفارش: {e}\nبرای تلاش دوباره 'done' را بفرستید.")
+        return None
     finally:
         if conn: conn.close()
+    # رسید از داده‌های همین سفارش ساخته می‌شود (بدون کوئری اضافه) و خطای آن سفارش ثبت‌شده را خراب نمی‌کند
+    if receipt_service.enabled:
+        try:
+            receipt_service.send(chat_id, receipt_from_order(order, order_id, order_date, total))
+        except Exception as e:
+            print(f"خطا در ساخت رسید سفارش {order_id}:", repr(e))
+    return order_id
 
-# ---------- دسته‌بندی‌ها ----------
-@bot.message_handler(func=lambda m: m.text == 'دسته‌بندی‌ها')
-@login_required
-def categories_root(m):
-    bot.send_message(m.chat.id, "مدیریت دسته‌بندی‌ها:", reply_markup=categories_menu())
+# ---------- مشاهده سفارش‌ها ----------
+@router.text('مشاهده سفارش‌ها')
+def view_orders_menu(m):
+    chat_id = m.chat.id
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add('لیست سفارش‌ها', 'جستجوی سفارش', 'تغییر وضعیت گروهی', 'خروجی سفارش‌ها', 'بازگشت')
+    send_message(chat_id, "مدیریت سفارش‌ها:", reply_markup=markup)
 
-@bot.message_handler(func=lambda m: m.text == 'لیست کتگوری‌ها')
-@login_required
-def list_categories(m):
+# فیلترها در callback_data به صورت دو حرف (وضعیت + بازه) نگه داشته می‌شوند
+ORDER_STATUS_FILTERS = [('a', None, 'همه'), ('p', 'pending', 'pending'), ('s', 'served', 'served'), ('c', 'cancelled', 'cancelled')]
+ORDER_PERIOD_FILTERS = [
+    ('a', None, 'همه زمان‌ها'),
+    ('t', "date_trunc('day', now())", 'امروز'),
+    ('w', "now() - interval '7 days'", '۷ روز'),
+    ('m', "date_trunc('month', now())", 'این ماه'),
+]
+_ORDER_CURSOR_EPOCH = datetime(1970, 1, 1)
+
+def encode_order_cursor(order_date, oid):
+    return f"{(order_date - _ORDER_CURSOR_EPOCH) // timedelta(microseconds=1)}:{oid}"
+
+def decode_order_cursor(ts, oid):
+    return _ORDER_CURSOR_EPOCH + timedelta(microseconds=int(ts)), int(oid)
+
+def fetch_orders_page(cur, status_code, period_code, direction='f', cursor=None, limit=ORDERS_PAGE_SIZE):
+    # صفحه‌بندی keyset: هزینهٔ هر صفحه مستقل از تعداد کل سفارش‌هاست
+    where = []
+    params = []
+    status = dict((c, v) for c, v, _ in ORDER_STATUS_FILTERS).get(status_code)
+    if status:
+        where.append("o.status = %s")
+        params.append(status)
+    since = dict((c, v) for c, v, _ in ORDER_PERIOD_FILTERS).get(period_code)
+    if since:
+        where.append(f"o.order_date >= {since}")
+    if cursor:
+        where.append("(o.order_date, o.id) " + ("<" if direction == 'n' else ">") + " (%s, %s)")
+        params.extend(cursor)
+    order = "ASC" if direction == 'p' else "DESC"
+    cur.execute(f"""
+        SELECT o.id, c.name, o.order_date, o.total, o.status
+        FROM orders o
+        LEFT JOIN customers c ON o.customer_id = c.id
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY o.order_date {order}, o.id {order}
+        LIMIT %s
+    """, params + [limit + 1])
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'p':
+        rows.reverse()
+    return rows, has_more
+
+def render_orders_page(rows, has_more, status_code, period_code, direction):
+    filt = status_code + period_code
+    if rows:
+        text = "سفارش‌ها:\n\n"
+        for r in rows:
+            cust = r[1] or "مشتری ناشناس"
+            text += f"سفارش #{r[0]} — {cust} — {r[2].strftime('%Y-%m-%d %H:%M')} — مجموع: {r[3]:.2f} — وضعیت: {r[4]}\n"
+    else:
+        text = "هیچ سفارشی با این فیلتر یافت نشد."
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*[types.InlineKeyboardButton(("✓ " if c == status_code else "") + label, callback_data=f"ordp:{c}{period_code}:f:0:0")
+                 for c, _, label in ORDER_STATUS_FILTERS])
+    markup.row(*[types.InlineKeyboardButton(("✓ " if c == period_code else "") + label, callback_data=f"ordp:{status_code}{c}:f:0:0")
+                 for c, _, label in ORDER_PERIOD_FILTERS])
+    has_prev = (direction == 'n') or (direction == 'p' and has_more)
+    has_next = (direction == 'p') or (direction != 'p' and has_more)
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton("« جدیدتر", callback_data=f"ordp:{filt}:p:{encode_order_cursor(rows[0][2], rows[0][0])}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton("قدیمی‌تر »", callback_data=f"ordp:{filt}:n:{encode_order_cursor(rows[-1][2], rows[-1][0])}"))
+    if not rows and direction != 'f':
+        nav.append(types.InlineKeyboardButton("صفحهٔ اول", callback_data=f"ordp:{filt}:f:0:0"))
+    if nav:
+        markup.row(*nav)
+    return text, markup
+
+@router.text('لیست سفارش‌ها', limit=EXPENSIVE)
+def list_orders(m):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(m.chat.id, "خطا در اتصال DB.")
+        send_message(m.chat.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM category ORDER BY name")
-        rows = cur.fetchall()
+        rows, has_more = fetch_orders_page(cur, 'a', 'a')
         if not rows:
-            bot.send_message(m.chat.id, "هیچ دسته‌ای ثبت نشده است.")
+            send_message(m.chat.id, "هیچ سفارشی ثبت نشده است.")
             return
-        text = "دسته‌ها:\n"
-        for r in rows:
-            text += f"{r[0]} — {r[1]}\n"
-        bot.send_message(m.chat.id, text)
+        text, markup = render_orders_page(rows, has_more, 'a', 'a', 'f')
+        send_message(m.chat.id, text, reply_markup=markup)
         cur.close()
     except Error as e:
-        bot.send_message(m.chat.id, f"خطا: {e}")
+        send_message(m.chat.id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'اضافه کردن کتگوری')
-@login_required
-def add_category_start(m):
-    msg = bot.send_message(m.chat.id, "نام دسته جدید را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, add_category_insert)
-
-def add_category_insert(message):
-    chat_id = message.chat.id
-    name = message.text.strip()
-    if not name:
-        bot.send_message(chat_id, "نام نامعتبر است.")
+@router.callback('ordp', limit=EXPENSIVE)
+def callback_orders_page(call):
+    chat_id = call.message.chat.id
+    try:
+        _, filt, direction, ts, oid = call.data.split(":")
+        status_code, period_code = filt[0], filt[1]
+        cursor = decode_order_cursor(ts, oid) if direction in ('n', 'p') else None
+    except (ValueError, IndexError):
+        bot.answer_callback_query(call.id, "درخواست نامعتبر.")
         return
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("INSERT INTO category (name) VALUES (%s) RETURNING id", (name,))
-        cid = cur.fetchone()[0]
-        conn.commit()
-        bot.send_message(chat_id, f"دسته ثبت شد. کد: {cid}", reply_markup=categories_menu())
+        rows, has_more = fetch_orders_page(cur, status_code, period_code, direction, cursor)
+        text, markup = render_orders_page(rows, has_more, status_code, period_code, direction)
+        bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+        bot.answer_callback_query(call.id)
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا در ثبت دسته: {e}")
+        bot.answer_callback_query(call.id, f"خطا: {e}")
+    except telebot.apihelper.ApiTelegramException:
+        # محتوای پیام تغییری نکرده (مثلاً زدن دوبارهٔ همان فیلتر)
+        bot.answer_callback_query(call.id)
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'ویرایش کتگوری')
-@login_required
-def edit_category_start(m):
-    msg = bot.send_message(m.chat.id, "کد دسته‌ای که می‌خواهید ویرایش کنید را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, edit_category_select)
+ORDER_BY_ID_SQL = """
+    SELECT o.id, c.name, o.order_date, o.total, o.status
+    FROM orders o
+    LEFT JOIN customers c ON o.customer_id = c.id
+    WHERE o.id = %s
+"""
+ORDER_ITEMS_SQL = """
+    SELECT oi.quantity, oi.price_at_order, p.name
+    FROM order_items oi
+    LEFT JOIN products p ON oi.product_id = p.id
+    WHERE oi.order_id = %s AND oi.order_date = %s
+"""
 
-def edit_category_select(message):
-    chat_id = message.chat.id
-    cid_text = message.text.strip()
-    if not cid_text.isdigit():
-        bot.send_message(chat_id, "کد دسته باید عدد باشد.")
-        return
-    cid = int(cid_text)
+@router.text('جستجوی سفارش')
+def search_order_start(m):
+    start_flow(m.chat.id, 'search_order')
+
+def search_order_by_id(chat_id, oid, data):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT name FROM category WHERE id = %s", (cid,))
+        cur.execute(ORDER_BY_ID_SQL, (oid,))
         row = cur.fetchone()
         if not row:
-            bot.send_message(chat_id, "دسته یافت نشد.")
-            return
-        bot.send_message(chat_id, f"نام فعلی: {row[0]}\nنام جدید را وارد کنید:")
-        bot.register_next_step_handler(bot.send_message(chat_id, "نام جدید:"), lambda msg, cid=cid: perform_edit_category_name(msg, cid))
+            raise InvalidInput("سفارشی با این کد یافت نشد.")
+        text = f"سفارش #{row[0]} — {row[1] or 'مشتری ناشناس'} — {row[2].strftime('%Y-%m-%d %H:%M')} — مجموع: {row[3]:.2f} — وضعیت: {row[4]}\n\nآیتم‌ها:\n"
+        cur.execute(ORDER_ITEMS_SQL, (oid, row[2]))
+        items = cur.fetchall()
+        for it in items:
+            text += f"{it[2] or 'محصول حذف شده'} — {it[0]} x {it[1]:.2f}\n"
+        # امکان تغییر وضعیت
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        markup.add('تغییر وضعیت', 'رسید', 'بازگشت')
+        send_message(chat_id, text, reply_markup=markup)
+        # ذخیرهٔ id برای ویرایش احتمالی
+        sess = ensure_session(chat_id)
+        sess['temp']['last_viewed_order'] = oid
+        save_session(chat_id)
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-def perform_edit_category_name(message, cid):
-    chat_id = message.chat.id
-    new_name = message.text.strip()
-    if not new_name:
-        bot.send_message(chat_id, "نام نامعتبر است.")
+register_flow(Flow('search_order', 'id', {
+    'id': State("کد سفارش را وارد کنید:", parse=int_value("کد سفارش باید عدد باشد."), handle=search_order_by_id, markup=no_keyboard),
+}))
+
+@router.text('تغییر وضعیت')
+def change_order_status_prompt(m):
+    chat_id = m.chat.id
+    sess = ensure_session(chat_id)
+    oid = sess['temp'].get('last_viewed_order')
+    if not oid:
+        send_message(chat_id, "ابتدا یک سفارش را جستجو یا مشاهده کنید.")
+        return
+    send_message(chat_id, "وضعیت جدید را انتخاب کنید:", reply_markup=order_status_menu())
+
+@router.text('pending', 'served', 'cancelled')
+def change_order_status(m):
+    chat_id = m.chat.id
+    new_status = m.text
+    sess = ensure_session(chat_id)
+    oid = sess['temp'].get('last_viewed_order')
+    if not oid:
+        send_message(chat_id, "ابتدا یک سفارش را انتخاب کنید.")
         return
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("UPDATE category SET name = %s WHERE id = %s", (new_name, cid))
+        if set_order_status(cur, oid, new_status, changed_by=chat_id) is None:
+            send_message(chat_id, f"سفارشی با این کد یافت نشد یا تغییر آن به '{new_status}' مجاز نیست.", reply_markup=main_menu())
+            return
         conn.commit()
-        bot.send_message(chat_id, "دسته با موفقیت ویرایش شد.", reply_markup=categories_menu())
+        send_message(chat_id, f"وضعیت سفارش #{oid} به '{new_status}' تغییر کرد.", reply_markup=main_menu())
+        sess['temp'].pop('last_viewed_order', None)
+        save_session(chat_id)
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا در تغییر وضعیت: {e}")
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'حذف کتگوری')
-@login_required
-def delete_category_start(m):
-    msg = bot.send_message(m.chat.id, "کد دسته برای حذف را وارد کنید (توجه: محصولات مرتبط دسته‌شان NULL خواهد شد):", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, delete_category_confirm)
+BULK_STATUS_HELP = (
+    "تغییر وضعیت گروهی — وضعیت جدید و سپس سفارش‌ها را وارد کنید:\n"
+    "served 12 15 18 — سفارش‌های مشخص (با فاصله یا کاما)\n"
+    "cancelled 40-55 — یک بازه از کدها\n"
+    f"served >30 — همهٔ سفارش‌های pending قدیمی‌تر از ۳۰ دقیقه (یا >2h برای ساعت؛ حداقل {BULK_STATUS_MIN_AGE} دقیقه، با تأیید)\n"
+    f"حداکثر {BULK_STATUS_MAX_IDS} سفارش در هر دستور"
+)
 
-def delete_category_confirm(message):
-    chat_id = message.chat.id
-    cid_text = message.text.strip()
-    if not cid_text.isdigit():
-        bot.send_message(chat_id, "کد دسته باید عدد باشد.")
-        return
-    cid = int(cid_text)
+def parse_bulk_status(text):
+    # (new_status, ids یا None, older_than به دقیقه یا None)
+    parts = text.translate(_PHONE_DIGITS).replace(',', ' ').replace('،', ' ').split()
+    if len(parts) < 2 or parts[0] not in ORDER_TRANSITIONS:
+        raise ValueError()
+    new_status, args = parts[0], parts[1:]
+    m = re.fullmatch(r'>(\d+)([mh]?)', ''.join(args))
+    if m:
+        minutes = int(m.group(1)) * (60 if m.group(2) == 'h' else 1)
+        if minutes < BULK_STATUS_MIN_AGE:
+            raise InvalidInput(f"حداقل سن سفارش‌ها {BULK_STATUS_MIN_AGE} دقیقه است.")
+        return new_status, None, minutes
+    ids = set()
+    for a in args:
+        r = re.fullmatch(r'(\d+)(?:-(\d+))?', a)
+        if not r:
+            raise ValueError()
+        lo, hi = int(r.group(1)), int(r.group(2) or r.group(1))
+        if hi < lo or hi - lo >= BULK_STATUS_MAX_IDS:
+            raise InvalidInput(f"حداکثر {BULK_STATUS_MAX_IDS} سفارش در هر دستور.")
+        ids.update(range(lo, hi + 1))
+        if len(ids) > BULK_STATUS_MAX_IDS:
+            raise InvalidInput(f"حداکثر {BULK_STATUS_MAX_IDS} سفارش در هر دستور.")
+    return new_status, sorted(ids), None
+
+PENDING_OLDER_THAN_COUNT_SQL = "SELECT count(*) FROM orders WHERE status = 'pending' AND order_date < now() - %s * interval '1 minute'"
+
+@router.text('تغییر وضعیت گروهی')
+def bulk_status_start(m):
+    start_flow(m.chat.id, 'bulk_status')
+
+def bulk_status_command(chat_id, command, data):
+    # کدهای مشخص مستقیم اجرا می‌شوند؛ «قدیمی‌تر از» اول شمرده و بعد از تأیید اجرا می‌شود
+    new_status, ids, minutes = command
+    if minutes is None:
+        return bulk_status_apply(chat_id, new_status, ids, None)
+    sources = [s for s, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    if 'pending' not in sources:
+        raise InvalidInput(f"سفارش pending را نمی‌توان به '{new_status}' تغییر داد.")
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
-        return
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT name FROM category WHERE id = %s", (cid,))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(chat_id, "دسته یافت نشد.")
-            return
-        name = row[0]
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("حذف", callback_data=f"delcat:{cid}"))
-        markup.add(types.InlineKeyboardButton("انصراف", callback_data="cancel"))
-        bot.send_message(chat_id, f"آیا می‌خواهید دسته '{name}' حذف شود؟", reply_markup=markup)
+        cur.execute(PENDING_OLDER_THAN_COUNT_SQL, (minutes,))
+        count = cur.fetchone()[0]
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}", reply_markup=main_menu())
+        return None
     finally:
-        if conn: conn.close()
+        conn.close()
+    if not count:
+        send_message(chat_id, "سفارش pending قدیمی‌تری یافت نشد.", reply_markup=main_menu())
+        return None
+    data['bulk'] = {'status': new_status, 'minutes': minutes, 'count': count}
+    return 'confirm'
 
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("delcat:"))
-def callback_delete_category(call):
-    cid = int(call.data.split(":",1)[1])
+def bulk_status_confirm_prompt(chat_id, data):
+    b = data['bulk']
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add('تأیید', 'انصراف')
+    send_message(chat_id, f"{b['count']} سفارش pending قدیمی‌تر از {b['minutes']} دقیقه به '{b['status']}' تغییر می‌کند. تأیید می‌کنید؟",
+                 reply_markup=markup)
+
+def bulk_status_confirmed(chat_id, text, data):
+    if text != 'تأیید':
+        raise InvalidInput("برای اجرا 'تأیید' و برای لغو 'انصراف' را بفرستید.")
+    b = data['bulk']
+    return bulk_status_apply(chat_id, b['status'], None, b['minutes'])
+
+def bulk_status_apply(chat_id, new_status, ids, minutes):
     conn = get_db_connection()
     if conn is None:
-        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
-        return
+        send_message(chat_id, "خطا در اتصال DB.")
+        return None
     try:
         cur = conn.cursor()
-        # حذف دسته — محصولات مرتبط category_id = NULL خواهد شد بخاطر ON DELETE SET NULL (یا می‌توانیم دستی انجام دهیم)
-        cur.execute("DELETE FROM category WHERE id = %s", (cid,))
+        # «قدیمی‌تر از» فقط روی سفارش‌های pending اعمال می‌شود
+        older_than = timedelta(minutes=minutes) if minutes is not None else None
+        changed = transition_orders(cur, new_status, ids=ids, older_than=older_than,
+                                    from_status='pending' if older_than else None, changed_by=chat_id)
         conn.commit()
-        bot.edit_message_text("دسته حذف شد.", call.message.chat.id, call.message.message_id)
+        text = f"{len(changed)} سفارش به '{new_status}' تغییر کرد."
+        if ids is not None and len(changed) < len(ids):
+            done = {oid for oid, _ in changed}
+            skipped = [str(oid) for oid in ids if oid not in done]
+            text += f"\nتغییر نکردند (یافت نشد یا تغییر مجاز نیست): {', '.join(skipped[:50])}"
+            if len(skipped) > 50:
+                text += f" و {len(skipped) - 50} مورد دیگر"
+        send_message(chat_id, text, reply_markup=main_menu())
         cur.close()
     except Error as e:
-        bot.answer_callback_query(call.id, f"خطا: {e}")
+        send_message(chat_id, f"خطا در تغییر وضعیت: {e}", reply_markup=main_menu())
     finally:
         if conn: conn.close()
+    return None
 
-# ---------- سفارش‌گیری ----------
-@bot.message_handler(func=lambda m: m.text == 'ثبت سفارش')
-@login_required
-def start_order(m):
-    chat_id = m.chat.id
-    # گزینه: انتخاب مشتری یا افزودن مشتری جدید
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add('انتخاب مشتری', 'اضافه کردن مشتری', 'انصراف')
-    bot.send_message(chat_id, "می‌خواهید با کدام مشتری سفارش ثبت شود؟", reply_markup=markup)
+register_flow(Flow('bulk_status', 'command', {
+    'command': State(BULK_STATUS_HELP, parse=parsed(parse_bulk_status, "دستور نامعتبر است."),
+                     handle=bulk_status_command, markup=no_keyboard, limit=EXPENSIVE),
+    'confirm': State(bulk_status_confirm_prompt, handle=bulk_status_confirmed, limit=EXPENSIVE),
+}))
 
-@bot.message_handler(func=lambda m: m.text == 'اضافه کردن مشتری')
-@login_required
-def add_customer_start(m):
-    msg = bot.send_message(m.chat.id, "نام مشتری را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, add_customer_name)
+# ---------- رسید سفارش ----------
+# رندر تصویر/PDF رسید کار سنگین CPU است و در ProcessPoolExecutor (ماژول receipts) انجام می‌شود تا
+# ترد‌های پردازش آپدیت و GIL را نگه ندارد. حداکثر max_pending رسید در صف یا در حال رندر است و
+# بیشتر از آن رد می‌شود (پیام متنی سفارش کافی است). رسیدهای ساخته‌شده با کلید (کد سفارش، وضعیت)
+# در LRU نگه داشته می‌شوند و درخواست‌های همزمان برای یک رسید یک رندر مشترک دارند.
+def receipt_from_order(order, order_id, order_date, total):
+    # رسید سفارش تازه ثبت‌شده از داده‌های گفتگوی سفارش
+    return {'id': order_id, 'date': order_date.strftime('%Y-%m-%d %H:%M'), 'customer': order.get('customer'),
+            'total': float(total), 'status': 'pending', 'title': RECEIPT_TITLE, 'qr': RECEIPT_QR.format(id=order_id),
+            'items': [(it['name'], it['quantity'], float(it['price'])) for it in order['items']]}
 
-def add_customer_name(message):
-    chat_id = message.chat.id
-    name = message.text.strip()
-    if not name:
-        bot.send_message(chat_id, "نام نامعتبر است.")
-        return
-    sess = ensure_session(chat_id)
-    sess['temp']['new_customer'] = {'name': name}
-    msg = bot.send_message(chat_id, "شماره تلفن را وارد کنید (اختیاری):")
-    bot.register_next_step_handler(msg, add_customer_insert)
+RECEIPT_ITEMS_SQL = """
+    SELECT p.name, oi.quantity, oi.price_at_order
+    FROM order_items oi LEFT JOIN products p ON p.id = oi.product_id
+    WHERE oi.order_id = %s AND oi.order_date = %s
+    ORDER BY oi.id
+"""
 
-def add_customer_insert(message):
-    chat_id = message.chat.id
-    phone = message.text.strip() if message.text else None
-    sess = ensure_session(chat_id)
-    cust = sess['temp'].pop('new_customer', None)
-    if not cust:
-        bot.send_message(chat_id, "خطا در افزودن مشتری.")
-        return
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
-        return
-    try:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO customers (name, phone) VALUES (%s, %s) RETURNING id", (cust['name'], phone))
-        cid = cur.fetchone()[0]
-        conn.commit()
-        bot.send_message(chat_id, f"مشتری ثبت شد. کد مشتری: {cid}\nحال می‌توانید سفارش را ادامه دهید.", reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add('انتخاب مشتری'))
-        cur.close()
-    except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
-    finally:
-        if conn: conn.close()
+def fetch_receipt(cur, order_id, order_date=None):
+    # داده‌های لازم برای receipts.render_receipt، یا None اگر سفارش نباشد
+    cur.execute(f"""
+        SELECT o.id, o.order_date, c.name, o.total, o.status
+        FROM orders o LEFT JOIN customers c ON c.id = o.customer_id
+        WHERE o.id = %s{" AND o.order_date = %s" if order_date else ""}
+    """, (order_id, order_date) if order_date else (order_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    cur.execute(RECEIPT_ITEMS_SQL, (row[0], row[1]))
+    items = [(r[0], r[1], float(r[2])) for r in cur.fetchall()]
+    return {'id': row[0], 'date': row[1].strftime('%Y-%m-%d %H:%M'), 'customer': row[2], 'total': float(row[3]),
+            'status': row[4], 'items': items, 'title': RECEIPT_TITLE, 'qr': RECEIPT_QR.format(id=row[0])}
 
-@bot.message_handler(func=lambda m: m.text == 'انتخاب مشتری')
-@login_required
-def select_customer_start(m):
-    chat_id = m.chat.id
-    msg = bot.send_message(chat_id, "لطفاً کد مشتری را وارد کنید (یا 'list' برای نمایش مشتریان):", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, select_customer_process)
+class ReceiptService:
+    def __init__(self, fmt=RECEIPT_FORMAT, workers=RECEIPT_WORKERS, max_pending=RECEIPT_MAX_PENDING,
+                 cache_size=RECEIPT_CACHE_SIZE, font=RECEIPT_FONT):
+        self.fmt = fmt
+        self.workers = workers
+        self.cache_size = cache_size
+        self.font = font
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._cache = OrderedDict()    # (order_id, status) -> bytes
+        self._inflight = {}            # (order_id, status) -> Future
+        self._executor = None
+        self._closed = False
+        # ارسال فایل به تلگرام بیرون از ترد مدیریت ProcessPoolExecutor انجام می‌شود
+        self._senders = ThreadPoolExecutor(2, thread_name_prefix="receipt-send")
 
-def select_customer_process(message):
-    chat_id = message.chat.id
-    text = message.text.strip()
-    if text.lower() == 'list':
-        # نمایش مشتریان
-        conn = get_db_connection()
-        if conn is None:
-            bot.send_message(chat_id, "خطا در اتصال DB.")
+    @property
+    def enabled(self):
+        return self.fmt in ('png', 'pdf')
+
+    @property
+    def pending(self):
+        return len(self._inflight)
+
+    def _pool(self):
+        # spawn به جای fork، چون این پروسه چندتردی است (قفل‌های گرفته‌شده در فرزند کپی نشوند).
+        # هر پروسهٔ spawn ماژول __main__ (app.py یا bench.py) را دوباره اجرا می‌کند، پس کد سطح ماژول
+        # این فایل فقط شیء می‌سازد و هر کار جانبی (ترد، اتصال، چاپ) زیر if __name__ == '__main__' است
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def render(self, receipt):
+        # Future با bytes فایل رسید، یا None اگر صف پر باشد
+        key = (receipt['id'], receipt['status'])
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                RECEIPTS.inc(result='cached')
+                fut = Future()
+                fut.set_result(data)
+                return fut
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut
+            if not self._slots.acquire(blocking=False):
+                RECEIPTS.inc(result='rejected')
+                return None
+            try:
+                try:
+                    fut = self._pool().submit(receipts.render_receipt, receipt, self.fmt, self.font)
+                except BrokenProcessPool:
+                    # پروسه‌ای از بیرون کشته شده (مثلاً OOM)؛ استخر از نو ساخته می‌شود
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                    fut = self._pool().submit(receipts.render_receipt, receipt, self.fmt, self.font)
+            except BaseException:
+                self._slots.release()
+                raise
+            self._inflight[key] = fut
+        start = time.perf_counter()
+        fut.add_done_callback(lambda f: self._done(key, f, start))
+        return fut
+
+    def _done(self, key, fut, start):
+        RECEIPT_SECONDS.observe(time.perf_counter() - start)
+        self._slots.release()
+        with self._lock:
+            self._inflight.pop(key, None)
+            if fut.cancelled() or fut.exception() is not None:
+                RECEIPTS.inc(result='error')
+                return
+            RECEIPTS.inc(result='rendered')
+            self._cache[key] = fut.result()
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def send(self, chat_id, receipt, reply_markup=None, notify_busy=False):
+        # رندر و ارسال غیرهمزمان؛ False اگر رسید الان قابل ساخت نباشد
+        if not self.enabled:
+            return False
+        fut = self.render(receipt)
+        if fut is None:
+            if notify_busy:
+                send_message(chat_id, "صف ساخت رسید پر است؛ کمی بعد دوباره تلاش کنید.", reply_markup=reply_markup)
+            return False
+        fut.add_done_callback(lambda f: self._schedule_delivery(chat_id, receipt, f, reply_markup))
+        return True
+
+    def _schedule_delivery(self, chat_id, receipt, fut, reply_markup):
+        # رندری که بعد از close (یا هنگام خروج مفسر) تمام شود دیگر ارسال نمی‌شود
+        if self._closed:
             return
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT id, name, phone FROM customers ORDER BY name")
-            rows = cur.fetchall()
-            if not rows:
-                bot.send_message(chat_id, "هیچ مشتری ثبت نشده است.")
-                return
-            txt = "مشتریان:\n"
-            for r in rows:
-                txt += f"{r[0]} — {r[1]} — {r[2] or '-'}\n"
-            bot.send_message(chat_id, txt)
-            # دوباره درخواست کد
-            msg = bot.send_message(chat_id, "کد مشتری را وارد کنید:")
-            bot.register_next_step_handler(msg, select_customer_process)
-            cur.close()
-        except Error as e:
-            bot.send_message(chat_id, f"خطا: {e}")
-        finally:
-            if conn: conn.close()
-        return
+            self._senders.submit(self._deliver, chat_id, receipt, fut, reply_markup)
+        except RuntimeError:
+            pass
+
+    def _deliver(self, chat_id, receipt, fut, reply_markup):
+        if fut.cancelled() or fut.exception() is not None:
+            print(f"خطا در ساخت رسید سفارش {receipt['id']}:", None if fut.cancelled() else repr(fut.exception()))
+            send_message(chat_id, "خطا در ساخت رسید.", reply_markup=reply_markup)
+            return
+        caption = f"رسید سفارش #{receipt['id']} — مجموع: {receipt['total']:.2f} تومان"
+        f = io.BytesIO(fut.result())
+        f.name = f"receipt_{receipt['id']}.{self.fmt}"
+        # پیام‌های متنی همان چت که در صف outbox مانده‌اند قبل از رسید فرستاده شوند
+        outbox.flush(chat_id)
+        try:
+            if self.fmt == 'pdf':
+                bot.send_document(chat_id, f, caption=caption, visible_file_name=f.name, reply_markup=reply_markup)
+            else:
+                bot.send_photo(chat_id, f, caption=caption, reply_markup=reply_markup)
+        except telebot.apihelper.ApiException as e:
+            print(f"خطا در ارسال رسید به {chat_id}:", e)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            executor = self._executor
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._senders.shutdown(wait=False)
 
-    if not text.isdigit():
-        bot.send_message(chat_id, "کد مشتری باید عدد یا 'list' باشد.")
+receipt_service = ReceiptService()
+metrics.gauge("bot_receipts_pending", "Receipts queued or rendering in the process pool", lambda: receipt_service.pending)
+
+@router.text('رسید')
+def order_receipt(m):
+    chat_id = m.chat.id
+    oid = ensure_session(chat_id)['temp'].get('last_viewed_order')
+    if not oid:
+        send_message(chat_id, "ابتدا یک سفارش را جستجو یا مشاهده کنید.")
+        return
+    if not receipt_service.enabled:
+        send_message(chat_id, "رسید تصویری غیرفعال است.")
         return
-    cid = int(text)
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, name FROM customers WHERE id = %s", (cid,))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(chat_id, "مشتری یافت نشد.")
-            return
-        sess = ensure_session(chat_id)
-        sess['temp']['current_order'] = {'customer_id': cid, 'items': []}
-        bot.send_message(chat_id, f"مشتری انتخاب شد: {row[1]}\nحالا محصولات را اضافه کنید.\nبرای دیدن لیست محصولات 'list' وارد کنید.\nبرای پایان و ثبت سفارش 'done' وارد کنید.", reply_markup=types.ReplyKeyboardRemove())
-        msg = bot.send_message(chat_id, "کد محصول یا 'list' یا 'done':")
-        bot.register_next_step_handler(msg, add_order_item)
+        receipt = fetch_receipt(cur, oid)
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        send_message(chat_id, f"خطا: {e}")
+        return
     finally:
-        if conn: conn.close()
-
-def add_order_item(message):
-    chat_id = message.chat.id
-    text = message.text.strip()
-    sess = ensure_session(chat_id)
-    if 'current_order' not in sess['temp']:
-        bot.send_message(chat_id, "هیچ سفارشی در جریان نیست. ابتدا مشتری را انتخاب کنید.")
+        conn.close()
+    if receipt is None:
+        send_message(chat_id, "سفارشی با این کد یافت نشد.")
         return
-    order = sess['temp']['current_order']
-    if text.lower() == 'list':
-        # نمایش محصولات
-        conn = get_db_connection()
-        if conn is None:
-            bot.send_message(chat_id, "خطا در اتصال DB.")
-            return
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT id, name, price FROM products ORDER BY id")
-            rows = cur.fetchall()
-            if not rows:
-                bot.send_message(chat_id, "هیچ محصولی ثبت نشده است.")
+    receipt_service.send(chat_id, receipt, notify_busy=True)
+
+# ---------- صف آشپزخانه ----------
+# سفارش‌های pending از طریق NOTIFY روی order_events به‌صورت افزایشی نگه داشته می‌شوند (فقط
+# سفارش تازه با یک کوئری خوانده می‌شود) و در هر ایستگاه یک پیام زنده با edit_message_text
+# به‌روز می‌شود. رویدادهای پشت سر هم با KITCHEN_DEBOUNCE در یک ویرایش جمع می‌شوند.
+def fetch_kitchen_orders(cur, ids=None, max_age_hours=KITCHEN_MAX_AGE_HOURS):
+    # ids=None یعنی همهٔ سفارش‌های pending اخیر (بارگذاری کامل)
+    only_ids = "AND o.id = ANY(%(ids)s)" if ids is not None else ""
+    cur.execute(f"""
+        SELECT o.id, o.order_date, c.name,
+               string_agg(COALESCE(p.name, 'محصول حذف شده') || ' x' || oi.quantity, '، ' ORDER BY oi.id)
+        FROM orders o
+        LEFT JOIN customers c ON c.id = o.customer_id
+        LEFT JOIN order_items oi ON oi.order_id = o.id AND oi.order_date = o.order_date
+        LEFT JOIN products p ON p.id = oi.product_id
+        WHERE o.status = 'pending'
+          AND o.order_date >= now() - %(age)s * interval '1 hour'
+          {only_ids}
+        GROUP BY o.id, o.order_date, c.name
+    """, {'ids': list(ids) if ids is not None else None, 'age': max_age_hours})
+    return [{'id': r[0], 'date': r[1], 'customer': r[2], 'items': r[3] or ''} for r in cur.fetchall()]
+
+def render_kitchen_queue(orders, limit=KITCHEN_QUEUE_LIMIT):
+    markup = types.InlineKeyboardMarkup()
+    if not orders:
+        return "صف آشپزخانه خالی است.", markup
+    text = f"صف آشپزخانه — {len(orders)} سفارش در انتظار\n"
+    for o in orders[:limit]:
+        text += f"\n#{o['id']} — {o['date'].strftime('%H:%M')} — {o['customer'] or 'مشتری ناشناس'}\n{o['items']}\n"
+        markup.row(types.InlineKeyboardButton(f"✅ #{o['id']} آماده شد", callback_data=f"kq:s:{o['id']}"),
+                   types.InlineKeyboardButton(f"✖ #{o['id']} لغو", callback_data=f"kq:c:{o['id']}"))
+    if len(orders) > limit:
+        text += f"\n... و {len(orders) - limit} سفارش دیگر"
+    if len(text) > TELEGRAM_MAX_TEXT:
+        text = text[:TELEGRAM_MAX_TEXT - 3] + "..."
+    return text, markup
+
+class KitchenQueue:
+    def __init__(self, stations, debounce=KITCHEN_DEBOUNCE, limit=KITCHEN_QUEUE_LIMIT):
+        self.stations = list(stations)
+        self.debounce = debounce
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._orders = {}       # id -> سفارش pending
+        self._to_fetch = set()
+        self._gone = set()      # سفارش‌هایی که در حین خواندن از صف خارج شدند
+        self._reload = True
+        self._repost = False
+        self._messages = {}     # chat_id ایستگاه -> (message_id, text)
+        self._thread = None
+
+    def on_event(self, payload):
+        # در ترد pg-listener اجرا می‌شود؛ فقط وضعیت علامت زده می‌شود. None یعنی اتصال دوباره برقرار شد
+        with self._lock:
+            if payload is None:
+                self._reload = True
             else:
-                txt = "محصولات:\n"
-                for r in rows:
-                    txt += f"{r[0]} — {r[1]} — {r[2]:.2f}\n"
-                bot.send_message(chat_id, txt)
-            cur.close()
-        except Error as e:
-            bot.send_message(chat_id, f"خطا: {e}")
-        finally:
-            if conn: conn.close()
-        msg = bot.send_message(chat_id, "کد محصول یا 'done':")
-        bot.register_next_step_handler(msg, add_order_item)
-        return
-    if text.lower() == 'done':
-        # ثبت سفارش نهایی
-        if not order['items']:
-            bot.send_message(chat_id, "هیچ آیتمی اضافه نشده است. سفارش لغو شد.")
-            sess['temp'].pop('current_order', None)
+                try:
+                    oid, status = payload.split(':', 1)
+                    oid = int(oid)
+                except ValueError:
+                    return
+                if status == 'pending':
+                    self._to_fetch.add(oid)
+                    self._repost = True
+                else:
+                    self._to_fetch.discard(oid)
+                    self._orders.pop(oid, None)
+                    self._gone.add(oid)
+        self._wake.set()
+
+    def start(self):
+        if not self.stations or self._thread is not None:
             return
-        save_order(chat_id, order)
-        sess['temp'].pop('current_order', None)
-        return
-    # در غیر این صورت انتظار داریم یک کد محصول عددی
-    if not text.isdigit():
-        bot.send_message(chat_id, "کد محصول باید عدد، 'list' یا 'done' باشد.")
-        return
-    pid = int(text)
-    # درخواست تعداد
-    sess['temp']['pending_product'] = pid
-    msg = bot.send_message(chat_id, "تعداد را وارد کنید:")
-    bot.register_next_step_handler(msg, add_order_item_quantity)
+        self._thread = threading.Thread(target=self._run, name="kitchen-queue", daemon=True)
+        self._thread.start()
 
-def add_order_item_quantity(message):
-    chat_id = message.chat.id
-    qty_text = message.text.strip()
-    sess = ensure_session(chat_id)
-    if 'pending_product' not in sess['temp'] or 'current_order' not in sess['temp']:
-        bot.send_message(chat_id, "خطا در روند افزودن آیتم.")
-        return
-    if not qty_text.isdigit():
-        bot.send_message(chat_id, "تعداد باید عدد صحیح مثبت باشد.")
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait()
+            self._stop_event.wait(self.debounce)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except (Error, telebot.apihelper.ApiException) as e:
+                print("خطا در به‌روزرسانی صف آشپزخانه:", e)
+                self._stop_event.wait(5)
+                self._wake.set()
+
+    def refresh(self):
+        with self._lock:
+            reload, ids, repost = self._reload, self._to_fetch, self._repost
+            self._reload, self._to_fetch, self._repost = False, set(), False
+            self._gone = set()
+        if reload or ids:
+            try:
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    rows = fetch_kitchen_orders(cur, None if reload else ids)
+                    cur.close()
+                    conn.rollback()
+            except Error:
+                with self._lock:
+                    self._reload, self._repost = True, self._repost or repost
+                raise
+            with self._lock:
+                if reload:
+                    self._orders = {}
+                for r in rows:
+                    if r['id'] not in self._gone:
+                        self._orders[r['id']] = r
+        with self._lock:
+            orders = sorted(self._orders.values(), key=lambda o: (o['date'], o['id']))
+        text, markup = render_kitchen_queue(orders, self.limit)
+        for chat_id in self.stations:
+            self._publish(chat_id, text, markup, repost)
+
+    def _publish(self, chat_id, text, markup, repost):
+        # سفارش جدید: پیام دوباره فرستاده می‌شود تا پایین چت و همراه اعلان باشد؛ بقیه فقط ویرایش
+        prev = self._messages.get(chat_id)
+        if prev is not None and not repost:
+            if prev[1] == text:
+                return
+            try:
+                bot.edit_message_text(text, chat_id, prev[0], reply_markup=markup)
+                self._messages[chat_id] = (prev[0], text)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if 'message is not modified' in str(e):
+                    self._messages[chat_id] = (prev[0], text)
+                    return
+                # پیام حذف شده یا دیگر قابل ویرایش نیست
+        if prev is not None:
+            try:
+                bot.delete_message(chat_id, prev[0])
+            except telebot.apihelper.ApiException:
+                pass
+        msg = bot.send_message(chat_id, text, reply_markup=markup)
+        self._messages[chat_id] = (msg.message_id, text)
+
+kitchen_queue = KitchenQueue(KITCHEN_CHAT_IDS)
+if KITCHEN_CHAT_IDS:
+    pg_listener.subscribe(ORDER_CHANNEL, kitchen_queue.on_event)
+
+@router.callback('kq', login=False)
+def callback_kitchen_queue(call):
+    chat_id = call.message.chat.id
+    if chat_id not in KITCHEN_CHAT_IDS and not check_login(chat_id):
+        bot.answer_callback_query(call.id, "دسترسی ندارید.")
         return
-    qty = int(qty_text)
-    if qty < 1:
-        bot.send_message(chat_id, "تعداد باید بزرگتر از صفر باشد.")
+    try:
+        _, action, oid = call.data.split(":")
+        oid = int(oid)
+        new_status = {'s': 'served', 'c': 'cancelled'}[action]
+    except (ValueError, KeyError):
+        bot.answer_callback_query(call.id, "دادهٔ نامعتبر.")
         return
-    pid = sess['temp'].pop('pending_product')
-    # گرفتن قیمت فعلی محصول
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        bot.answer_callback_query(call.id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("SELECT name, price FROM products WHERE id = %s", (pid,))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(chat_id, "محصول یافت نشد.")
+        # فقط از pending؛ دو لمس همزمان از دو ایستگاه سفارش را دو بار تغییر نمی‌دهد
+        if set_order_status(cur, oid, new_status, expected='pending', changed_by=call.from_user.id) is None:
+            conn.rollback()
+            bot.answer_callback_query(call.id, "این سفارش دیگر در انتظار نیست.")
             return
-        pname, price = row[0], float(row[1])
-        # اضافه کردن به سفارش موقتی
-        order = sess['temp']['current_order']
-        order['items'].append({'product_id': pid, 'name': pname, 'quantity': qty, 'price': price})
-        bot.send_message(chat_id, f"آیتم اضافه شد: {pname} x {qty} — واحد: {price:.2f}")
-        # ادامهٔ اضافه کردن
-        msg = bot.send_message(chat_id, "کد محصول بعدی یا 'list' یا 'done':")
-        bot.register_next_step_handler(msg, add_order_item)
+        conn.commit()
+        # پیام صف با NOTIFY همین تغییر به‌روز می‌شود
+        bot.answer_callback_query(call.id, f"سفارش #{oid}: {new_status}")
         cur.close()
     except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
+        bot.answer_callback_query(call.id, f"خطا: {e}")
     finally:
         if conn: conn.close()
 
-def save_order(chat_id, order):
-    # محاسبهٔ مجموع
-    total = sum(item['quantity'] * item['price'] for item in order['items'])
+# ---------- خروجی CSV ----------
+# COPY ... TO STDOUT ردیف‌ها را تکه‌تکه مستقیم در فایل gzip می‌نویسد؛
+# حافظهٔ مصرفی به تعداد ردیف‌ها بستگی ندارد
+EXPORT_QUERIES = [
+    ("orders", """
+        SELECT o.id, o.order_date, o.customer_id, c.name AS customer_name, c.phone AS customer_phone, o.status, o.total
+        FROM orders o LEFT JOIN customers c ON c.id = o.customer_id
+        WHERE o.order_date >= %(start)s AND o.order_date < %(end)s
+        ORDER BY o.order_date, o.id
+    """),
+    ("order_items", """
+        SELECT oi.order_id, o.order_date, oi.product_id, p.name AS product_name, oi.quantity, oi.price_at_order,
+               oi.quantity * oi.price_at_order AS line_total
+        FROM order_items oi
+        JOIN orders o ON o.id = oi.order_id AND o.order_date = oi.order_date
+        LEFT JOIN products p ON p.id = oi.product_id
+        WHERE oi.order_date >= %(start)s AND oi.order_date < %(end)s
+        ORDER BY oi.order_date, oi.order_id, oi.id
+    """),
+]
+
+def export_orders_csv(conn, start, end, dest_dir):
+    # بازهٔ [start, end) — مسیر فایل‌های csv.gz ساخته‌شده برگردانده می‌شود
+    cur = conn.cursor()
+    paths = []
+    for name, sql in EXPORT_QUERIES:
+        query = cur.mogrify(sql, {'start': start, 'end': end}).decode()
+        path = os.path.join(dest_dir, f"{name}_{start:%Y%m%d}_{(end - timedelta(days=1)):%Y%m%d}.csv.gz")
+        with gzip.open(path, "wb", compresslevel=6) as f:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+        paths.append(path)
+    cur.close()
+    return paths
+
+def parse_export_range(text):
+    # «2026-01-01 2026-01-31» یا فقط یک تاریخ
+    parts = text.replace('تا', ' ').split()
+    if not 1 <= len(parts) <= 2:
+        raise ValueError()
+    start = datetime.strptime(parts[0], '%Y-%m-%d')
+    end = datetime.strptime(parts[-1], '%Y-%m-%d')
+    if end < start:
+        raise ValueError()
+    return start, end + timedelta(days=1)
+
+@router.text('خروجی سفارش‌ها')
+def export_orders_start(m):
+    start_flow(m.chat.id, 'export_orders')
+
+def export_orders_process(chat_id, date_range, data):
+    start, end = date_range
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
+    tmpdir = tempfile.mkdtemp(prefix="export-", dir=EXPORT_DIR)
     try:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO orders (customer_id, total, status) VALUES (%s, %s, %s) RETURNING id, order_date", (order['customer_id'], round(total,2), 'pending'))
-        row = cur.fetchone()
-        order_id = row[0]
-        order_date = row[1]
-        # درج آیتم‌ها
-        for it in order['items']:
-            cur.execute("""
-                INSERT INTO order_items (order_id, product_id, quantity, price_at_order)
-                VALUES (%s, %s, %s, %s)
-            """, (order_id, it['product_id'], it['quantity'], round(it['price'],2)))
-        conn.commit()
-        bot.send_message(chat_id, f"سفارش ثبت شد.\nکد سفارش: {order_id}\nتاریخ: {order_date.strftime('%Y-%m-%d %H:%M')}\nمجموع: {total:.2f} تومان", reply_markup=main_menu())
-        cur.close()
+        paths = export_orders_csv(conn, start, end, tmpdir)
+        conn.rollback()
+        conn.close()
+        conn = None
+        for path in paths:
+            with open(path, "rb") as f:
+                bot.send_document(chat_id, f, visible_file_name=os.path.basename(path))
+        send_message(chat_id, "خروجی ارسال شد.", reply_markup=main_menu())
     except Error as e:
-        bot.send_message(chat_id, f"خطا در ثبت سفارش: {e}")
+        send_message(chat_id, f"خطا در تهیهٔ خروجی: {e}")
+    except telebot.apihelper.ApiException as e:
+        send_message(chat_id, f"خطا در ارسال فایل: {e}")
     finally:
         if conn: conn.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-# ---------- مشاهده سفارش‌ها ----------
-@bot.message_handler(func=lambda m: m.text == 'مشاهده سفارش‌ها')
-@login_required
-def view_orders_menu(m):
-    chat_id = m.chat.id
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add('لیست سفارش‌ها', 'جستجوی سفارش', 'بازگشت')
-    bot.send_message(chat_id, "مدیریت سفارش‌ها:", reply_markup=markup)
+register_flow(Flow('export_orders', 'range', {
+    'range': State("بازهٔ تاریخ را وارد کنید (مثال: 2026-01-01 2026-01-31):",
+                   parse=parsed(parse_export_range, "بازهٔ تاریخ نامعتبر است. قالب: YYYY-MM-DD YYYY-MM-DD"),
+                   handle=export_orders_process, markup=no_keyboard, limit=EXPENSIVE),
+}))
 
-@bot.message_handler(func=lambda m: m.text == 'لیست سفارش‌ها')
-@login_required
-def list_orders(m):
+# ---------- گزارش‌ها ----------
+# همهٔ گزارش‌ها از جدول‌های daily_orders و daily_sales خوانده می‌شوند، نه از orders/order_items
+REPORT_DAYS = int(os.environ.get("REPORT_DAYS", "30"))
+
+def run_report(chat_id, build):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(m.chat.id, "خطا در اتصال DB.")
+        send_message(chat_id, "خطا در اتصال DB.")
         return
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT o.id, c.name, o.order_date, o.total, o.status
-            FROM orders o
-            LEFT JOIN customers c ON o.customer_id = c.id
-            ORDER BY o.order_date DESC
-            LIMIT 50
-        """)
-        rows = cur.fetchall()
-        if not rows:
-            bot.send_message(m.chat.id, "هیچ سفارشی ثبت نشده است.")
-            return
-        text = "سفارش‌ها:\n\n"
-        for r in rows:
-            cust = r[1] or "مشتری ناشناس"
-            text += f"سفارش #{r[0]} — {cust} — {r[2].strftime('%Y-%m-%d %H:%M')} — مجموع: {r[3]:.2f} — وضعیت: {r[4]}\n"
-        bot.send_message(m.chat.id, text)
+        send_message(chat_id, build(cur))
         cur.close()
     except Error as e:
-        bot.send_message(m.chat.id, f"خطا: {e}")
+        send_message(chat_id, f"خطا در تهیهٔ گزارش: {e}")
     finally:
         if conn: conn.close()
 
-@bot.message_handler(func=lambda m: m.text == 'جستجوی سفارش')
-@login_required
-def search_order_start(m):
-    msg = bot.send_message(m.chat.id, "کد سفارش را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, search_order_by_id)
+def _avg_ticket(count, revenue):
+    return revenue / count if count else 0
 
-def search_order_by_id(message):
-    chat_id = message.chat.id
-    text = message.text.strip()
-    if not text.isdigit():
-        bot.send_message(chat_id, "کد سفارش باید عدد باشد.")
-        return
-    oid = int(text)
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
-        return
-    try:
-        cur = conn.cursor()
+@router.text('گزارش‌ها')
+def reports_root(m):
+    send_message(m.chat.id, "گزارش‌های فروش:", reply_markup=reports_menu())
+
+@router.text('فروش امروز', limit=EXPENSIVE)
+def report_today(m):
+    def build(cur):
+        cur.execute("SELECT orders_count, revenue FROM daily_orders WHERE day = current_date")
+        row = cur.fetchone() or (0, 0)
+        text = (f"فروش امروز:\nتعداد سفارش: {row[0]}\nدرآمد: {row[1]:.2f} تومان\n"
+                f"میانگین هر سفارش: {_avg_ticket(row[0], row[1]):.2f} تومان\n\nپرفروش‌های امروز:\n")
         cur.execute("""
-            SELECT o.id, c.name, o.order_date, o.total, o.status
-            FROM orders o
-            LEFT JOIN customers c ON o.customer_id = c.id
-            WHERE o.id = %s
-        """, (oid,))
-        row = cur.fetchone()
-        if not row:
-            bot.send_message(chat_id, "سفارشی با این کد یافت نشد.")
-            return
-        text = f"سفارش #{row[0]} — {row[1] or 'مشتری ناشناس'} — {row[2].strftime('%Y-%m-%d %H:%M')} — مجموع: {row[3]:.2f} — وضعیت: {row[4]}\n\nآیتم‌ها:\n"
+            SELECT COALESCE(p.name, 'محصول حذف شده'), ds.quantity, ds.revenue
+            FROM daily_sales ds LEFT JOIN products p ON p.id = ds.product_id
+            WHERE ds.day = current_date AND ds.quantity > 0
+            ORDER BY ds.revenue DESC
+            LIMIT 5
+        """)
+        for r in cur.fetchall():
+            text += f"{r[0]} — {r[1]} عدد — {r[2]:.2f}\n"
+        return text
+    run_report(m.chat.id, build)
+
+@router.text('فروش هفتگی', limit=EXPENSIVE)
+def report_week(m):
+    def build(cur):
         cur.execute("""
-            SELECT oi.quantity, oi.price_at_order, p.name
-            FROM order_items oi
-            LEFT JOIN products p ON oi.product_id = p.id
-            WHERE oi.order_id = %s
-        """, (oid,))
-        items = cur.fetchall()
-        for it in items:
-            text += f"{it[2] or 'محصول حذف شده'} — {it[0]} x {it[1]:.2f}\n"
-        # امکان تغییر وضعیت
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('تغییر وضعیت', 'بازگشت')
-        bot.send_message(chat_id, text, reply_markup=markup)
-        # ذخیرهٔ id برای ویرایش احتمالی
-        sess = ensure_session(chat_id)
-        sess['temp']['last_viewed_order'] = oid
-        cur.close()
-    except Error as e:
-        bot.send_message(chat_id, f"خطا: {e}")
-    finally:
-        if conn: conn.close()
+            SELECT d.day::date, COALESCE(o.orders_count, 0), COALESCE(o.revenue, 0)
+            FROM generate_series(current_date - 6, current_date, interval '1 day') AS d(day)
+            LEFT JOIN daily_orders o ON o.day = d.day::date
+            ORDER BY 1
+        """)
+        rows = cur.fetchall()
+        text = "فروش ۷ روز اخیر:\n\n"
+        for r in rows:
+            text += f"{r[0].strftime('%Y-%m-%d')} — {r[1]} سفارش — {r[2]:.2f} تومان\n"
+        count = sum(r[1] for r in rows)
+        revenue = sum(r[2] for r in rows)
+        text += f"\nمجموع: {count} سفارش — {revenue:.2f} تومان\nمیانگین هر سفارش: {_avg_ticket(count, revenue):.2f} تومان"
+        return text
+    run_report(m.chat.id, build)
 
-@bot.message_handler(func=lambda m: m.text == 'تغییر وضعیت')
-@login_required
-def change_order_status_prompt(m):
-    chat_id = m.chat.id
-    sess = ensure_session(chat_id)
-    oid = sess['temp'].get('last_viewed_order')
-    if not oid:
-        bot.send_message(chat_id, "ابتدا یک سفارش را جستجو یا مشاهده کنید.")
-        return
-    bot.send_message(chat_id, "وضعیت جدید را انتخاب کنید:", reply_markup=order_status_menu())
+@router.text('پرفروش‌ترین محصولات', limit=EXPENSIVE)
+def report_top_products(m):
+    def build(cur):
+        text = f"پرفروش‌ترین محصولات ({REPORT_DAYS} روز اخیر)\n"
+        for title, order_by in (("بر اساس درآمد:", "revenue"), ("بر اساس تعداد:", "quantity")):
+            cur.execute(f"""
+                SELECT COALESCE(p.name, 'محصول حذف شده'), SUM(ds.quantity) AS quantity, SUM(ds.revenue) AS revenue
+                FROM daily_sales ds LEFT JOIN products p ON p.id = ds.product_id
+                WHERE ds.day > current_date - %s
+                GROUP BY ds.product_id, p.name
+                HAVING SUM(ds.quantity) > 0
+                ORDER BY {order_by} DESC
+                LIMIT 10
+            """, (REPORT_DAYS,))
+            text += f"\n{title}\n"
+            for r in cur.fetchall():
+                text += f"{r[0]} — {r[1]} عدد — {r[2]:.2f} تومان\n"
+        return text
+    run_report(m.chat.id, build)
 
-@bot.message_handler(func=lambda m: m.text in ['pending', 'served', 'cancelled'])
-@login_required
-def change_order_status(m):
-    chat_id = m.chat.id
-    new_status = m.text
-    sess = ensure_session(chat_id)
-    oid = sess['temp'].get('last_viewed_order')
-    if not oid:
-        bot.send_message(chat_id, "ابتدا یک سفارش را انتخاب کنید.")
-        return
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال DB.")
-        return
-    try:
-        cur = conn.cursor()
-        cur.execute("UPDATE orders SET status = %s WHERE id = %s", (new_status, oid))
-        conn.commit()
-        bot.send_message(chat_id, f"وضعیت سفارش #{oid} به '{new_status}' تغییر کرد.", reply_markup=main_menu())
-        sess['temp'].pop('last_viewed_order', None)
-        cur.close()
-    except Error as e:
-        bot.send_message(chat_id, f"خطا در تغییر وضعیت: {e}")
-    finally:
-        if conn: conn.close()
+@router.text('فروش دسته‌ها', limit=EXPENSIVE)
+def report_categories(m):
+    def build(cur):
+        cur.execute("""
+            SELECT COALESCE(c.name, 'بدون دسته'), SUM(ds.quantity), SUM(ds.revenue)
+            FROM daily_sales ds
+            LEFT JOIN products p ON p.id = ds.product_id
+            LEFT JOIN category c ON c.id = p.category_id
+            WHERE ds.day > current_date - %s
+            GROUP BY 1
+            HAVING SUM(ds.quantity) > 0
+            ORDER BY 3 DESC
+        """, (REPORT_DAYS,))
+        rows = cur.fetchall()
+        if not rows:
+            return "در این بازه فروشی ثبت نشده است."
+        text = f"فروش دسته‌ها ({REPORT_DAYS} روز اخیر):\n\n"
+        for r in rows:
+            text += f"{r[0]} — {r[1]} عدد — {r[2]:.2f} تومان\n"
+        return text
+    run_report(m.chat.id, build)
 
 # ---------- سایر هندلرها ----------
-@bot.message_handler(func=lambda m: m.text == 'بازگشت')
-@login_required
+@router.command('dbstats', login=True, limit=EXPENSIVE)
+def db_stats(m):
+    st = get_pool().stats()
+    text = (f"استخر اتصال: {st['in_use']} در حال استفاده / {st['idle']} بیکار (حداکثر {st['max']})\n"
+            f"تعداد دریافت اتصال: {st['checkouts']} — میانگین انتظار: {st['wait_avg']*1000:.1f}ms — بیشینه: {st['wait_max']*1000:.1f}ms\n"
+            f"timeout: {st['timeouts']} — اتصال مجدد: {st['reconnects']}")
+    send_message(m.chat.id, text)
+
+@router.text('بازگشت')
 def go_back(m):
-    bot.send_message(m.chat.id, "بازگشت به منوی اصلی.", reply_markup=main_menu())
+    send_message(m.chat.id, "بازگشت به منوی اصلی.", reply_markup=main_menu())
 
-@bot.message_handler(func=lambda message: True)
+@router.default
 def fallback(message):
     # پاسخ پیش‌فرض برای ورودی‌های شناخته نشده
     if check_login(message.chat.id):
-        bot.send_message(message.chat.id, "لطفاً یکی از گزینه‌ها را از منو انتخاب کنید.", reply_markup=main_menu())
+        send_message(message.chat.id, "لطفاً یکی از گزینه‌ها را از منو انتخاب کنید.", reply_markup=main_menu())
     else:
-        bot.send_message(message.chat.id, "برای شروع /start را بزنید.", reply_markup=login_menu())
+        send_message(message.chat.id, "برای شروع /start را بزنید.", reply_markup=login_menu())
 
 if __name__ == '__main__':
-    create_tables()
-    print("Bot is running ...")
-    bot.polling(none_stop=True)
+    # python app.py migrate | check-indexes
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'migrate':
+        sys.exit(0 if migrate() else 1)
+    if command == 'check-indexes':
+        sys.exit(0 if migrate() and check_query_plans() else 1)
+    migrate()
+    if METRICS_PORT:
+        start_metrics_server()
+    pg_listener.start()
+    partition_manager.start()
+    kitchen_queue.start()
+    session_store.start()
+    outbox.start()
+    print(f"Bot is running ({BOT_WORKERS} workers) ...")
+    try:
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            run_polling()
+    finally:
+        outbox.join(timeout=10)
+        receipt_service.close()
+        session_store.close()
@@ -0,0 +1,640 @@
+# bench.py — بنچمارک‌های ربات صندوق کافه
+# استفاده:
+#   DB_URI=postgresql://... python bench.py save_order [--rounds 50]
+#   DB_URI=postgresql://... python bench.py export [--orders 1000000]
+#   python bench.py webhook --url http://127.0.0.1:8443/webhook [--file updates.jsonl] [--rate 2000]
+#   DB_URI=postgresql://... python bench.py cashiers [--cashiers 8] [--rounds 20] [--api-latency 30]
+#   python bench.py cashiers --temp-cluster        # پایگاه دادهٔ موقت با initdb
+#   python bench.py compare bench_results/a.json bench_results/b.json
+#   python bench.py router [--sizes 10 100 1000]
+#   python bench.py receipts [--workers 1 2 4] [--count 400] [--items 8] [--format png]
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import shutil
+import socket
+import argparse
+import threading
+import statistics
+import subprocess
+import http.client
+import http.server
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_USERNAME", "bench")
+os.environ.setdefault("ADMIN_PASSWORD", "bench")
+# صندوق‌دارهای مصنوعی با سرعت ماشین پیام می‌فرستند؛ سهمیهٔ هر چت (RATE_LIMITS) خاموش است
+os.environ.setdefault("RATE_LIMITS", "")
+import psycopg2
+import telebot
+import app
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def report(title, samples):
+    ms = [x * 1000 for x in samples]
+    print(f"{title:<28} n={len(ms):<5} p50={percentile(ms, 50):8.2f}ms  "
+          f"p95={percentile(ms, 95):8.2f}ms  mean={statistics.mean(ms):8.2f}ms")
+
+
+# ---------- save_order ----------
+def legacy_persist_order(cur, order):
+    # مسیر قدیمی: یک INSERT برای هر آیتم و محاسبهٔ مجموع در سمت کلاینت
+    total = sum(item['quantity'] * item['price'] for item in order['items'])
+    cur.execute("INSERT INTO orders (customer_id, total, status) VALUES (%s, %s, %s) RETURNING id, order_date",
+                (order['customer_id'], round(total, 2), 'pending'))
+    order_id, order_date = cur.fetchone()
+    for it in order['items']:
+        cur.execute("""
+            INSERT INTO order_items (order_id, order_date, product_id, quantity, price_at_order)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (order_id, order_date, it['product_id'], it['quantity'], round(it['price'], 2)))
+    # جمع‌های روزانه مثل persist_order به‌روز می‌شوند تا مقایسه فقط تفاوت INSERTها را نشان دهد
+    app.apply_sales_delta(cur, [order_id], 1)
+    return order_id, order_date, total
+
+
+def bench_save_order(args):
+    # سفارش‌ها تک‌تک commit می‌شوند (هزینهٔ commit جزو اندازه‌گیری است) و در پایان سهمشان از
+    # daily_orders/daily_sales کم و خودشان پاک می‌شوند
+    app.migrate()
+    conn = psycopg2.connect(app.DB_URI)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO products (name, price) VALUES ('bench product', 12.5) RETURNING id")
+    pid = cur.fetchone()[0]
+    conn.commit()
+    created = []
+    try:
+        for size in args.sizes:
+            order = {'customer_id': None,
+                     'items': [{'product_id': pid, 'quantity': 1 + i % 3, 'price': 12.5} for i in range(size)]}
+            for name, fn in (("legacy (N+1)", legacy_persist_order), ("bulk", app.persist_order)):
+                samples = []
+                for _ in range(args.rounds):
+                    start = time.perf_counter()
+                    order_id = fn(cur, order)[0]
+                    conn.commit()
+                    samples.append(time.perf_counter() - start)
+                    created.append(order_id)
+                report(f"{name} items={size}", samples)
+    finally:
+        conn.rollback()
+        app.apply_sales_delta(cur, created, -1)
+        cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (created,))
+        cur.execute("DELETE FROM products WHERE id = %s", (pid,))
+        conn.commit()
+        conn.close()
+
+
+# ---------- export ----------
+def bench_export(args):
+    # سفارش‌های مصنوعی در یک تراکنش ساخته، خروجی گرفته و در پایان rollback می‌شوند
+    from datetime import datetime, timedelta
+    app.migrate()
+    conn = psycopg2.connect(app.DB_URI)
+    cur = conn.cursor()
+    start = datetime(2000, 1, 1)
+    end = start + timedelta(days=30)
+    try:
+        cur.execute("INSERT INTO products (name, price) VALUES ('bench product', 12.5) RETURNING id")
+        pid = cur.fetchone()[0]
+        # پارتیشن ماه مصنوعی هم داخل همین تراکنش ساخته و با rollback حذف می‌شود
+        app.create_order_partitions(cur, start, start)
+        t0 = time.perf_counter()
+        cur.execute("""
+            WITH o AS (
+                INSERT INTO orders (customer_id, order_date, total, status)
+                SELECT NULL, %s + (g * interval '1 second') * (30 * 86400.0 / %s), 25, 'served'
+                FROM generate_series(1, %s) g
+                RETURNING id, order_date
+            )
+            INSERT INTO order_items (order_id, order_date, product_id, quantity, price_at_order)
+            SELECT id, order_date, %s, 2, 12.5 FROM o
+        """, (start, args.orders, args.orders, pid))
+        print(f"generated {args.orders} orders in {time.perf_counter() - t0:.1f}s")
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with tempfile.TemporaryDirectory() as tmpdir:
+            t0 = time.perf_counter()
+            paths = app.export_orders_csv(conn, start, end, tmpdir)
+            elapsed = time.perf_counter() - t0
+            for path in paths:
+                print(f"  {os.path.basename(path)}: {os.path.getsize(path) / 1e6:.1f} MB")
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"export: {elapsed:.2f}s — {args.orders / elapsed:.0f} orders/s — "
+              f"peak RSS growth {(rss_after - rss_before) / 1024:.1f} MB")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# ---------- webhook ----------
+def synthetic_updates(chats, count):
+    for i in range(count):
+        chat_id = 100000 + i % chats
+        yield {"update_id": i + 1, "message": {
+            "message_id": i + 1, "date": int(time.time()), "text": "بازگشت",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"}}}
+
+
+def load_updates(args):
+    if not args.file:
+        return list(synthetic_updates(args.chats, args.count))
+    with open(args.file, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    # آپدیت‌های ضبط‌شده تا رسیدن به count تکرار و update_id یکتا می‌شوند
+    updates = []
+    for i in range(args.count):
+        u = dict(recorded[i % len(recorded)])
+        u["update_id"] = i + 1
+        updates.append(u)
+    return updates
+
+
+def bench_webhook(args):
+    url = urlsplit(args.url)
+    bodies = [json.dumps(u, ensure_ascii=False).encode("utf-8") for u in load_updates(args)]
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+    counts = {}
+    latencies = []
+    lock = threading.Lock()
+    interval = args.threads / args.rate if args.rate else 0.0
+
+    def worker(offset):
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+        next_at = time.perf_counter()
+        for body in bodies[offset::args.threads]:
+            if interval:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at += interval
+            start = time.perf_counter()
+            try:
+                conn.request("POST", url.path, body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+                if resp.will_close:
+                    conn.close()
+            except OSError as e:
+                status = type(e).__name__
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+            elapsed = time.perf_counter() - start
+            with lock:
+                counts[status] = counts.get(status, 0) + 1
+                latencies.append(elapsed)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print(f"sent {len(bodies)} updates in {elapsed:.2f}s — {len(bodies) / elapsed:.0f} req/s")
+    for status, n in sorted(counts.items(), key=lambda kv: str(kv[0])):
+        print(f"  {status}: {n}")
+    report("POST /webhook", latencies)
+
+
+# ---------- cashiers ----------
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    # فقط متدهایی که هندلرها صدا می‌زنند؛ پیام‌های ارسالی برای خواندن در سناریو ثبت می‌شوند
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_call(b"")
+
+    def do_POST(self):
+        self.handle_call(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+    def handle_call(self, body):
+        url = urlsplit(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = dict(parse_qsl(url.query))
+        if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode("utf-8")))
+        result = self.server.api_call(method, params)
+        payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramAPI(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.calls = {}
+        self.last = {}      # chat_id -> آخرین پیام ارسال/ویرایش‌شده
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot{{0}}/{{1}}"
+
+    def api_call(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method not in ("sendMessage", "editMessageText"):
+                return True
+            self.message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+            self.last[chat_id] = {"text": params.get("text", ""), "reply_markup": markup}
+            return {"message_id": int(params.get("message_id") or self.message_id), "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    def last_message(self, chat_id):
+        with self.lock:
+            return self.last.get(chat_id) or {"text": "", "reply_markup": None}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def temp_cluster():
+    # کلاستر دورریختنی: initdb در یک پوشهٔ موقت، اتصال فقط از طریق سوکت یونیکس
+    bindir = ""
+    if shutil.which("pg_config"):
+        bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True).stdout.strip()
+    initdb = os.path.join(bindir, "initdb") if bindir else shutil.which("initdb")
+    if not initdb or not os.path.exists(initdb):
+        sys.exit("initdb پیدا نشد؛ DB_URI را تنظیم کنید.")
+    pg_ctl = os.path.join(os.path.dirname(initdb), "pg_ctl")
+    tmpdir = tempfile.mkdtemp(prefix="bench-pg-")
+    data = os.path.join(tmpdir, "data")
+    port = free_port()
+    subprocess.run([initdb, "-D", data, "-U", "bench", "-A", "trust", "--no-sync"], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, "-D", data, "-l", os.path.join(tmpdir, "postgres.log"), "-w", "start",
+                    "-o", f"-p {port} -k {tmpdir} -c listen_addresses=''"], check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f"postgresql://bench@/postgres?host={tmpdir}&port={port}"
+    finally:
+        subprocess.run([pg_ctl, "-D", data, "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def seed(cur, cashiers, products):
+    cur.execute("INSERT INTO category (name) VALUES ('bench') ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id")
+    cat_id = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO products (name, price, category_id)
+        SELECT 'bench product ' || g, 10 + g %% 7, %s FROM generate_series(1, %s) g RETURNING id
+    """, (cat_id, products))
+    product_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("""
+        INSERT INTO customers (name) SELECT 'bench cashier ' || g FROM generate_series(1, %s) g RETURNING id
+    """, (cashiers,))
+    customer_ids = [r[0] for r in cur.fetchall()]
+    return product_ids, customer_ids
+
+
+def cleanup(cur, product_ids, customer_ids):
+    cur.execute("SELECT id FROM orders WHERE customer_id = ANY(%s) AND status <> 'cancelled'", (customer_ids,))
+    app.apply_sales_delta(cur, [r[0] for r in cur.fetchall()], -1)
+    cur.execute("DELETE FROM orders WHERE customer_id = ANY(%s) RETURNING id", (customer_ids,))
+    # تاریخچه و کلیدهای تکرار به orders کلید خارجی ندارند و جدا پاک می‌شوند
+    order_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("DELETE FROM order_status_history WHERE order_id = ANY(%s)", (order_ids,))
+    cur.execute("DELETE FROM order_keys WHERE order_id = ANY(%s)", (order_ids,))
+    cur.execute("DELETE FROM customers WHERE id = ANY(%s)", (customer_ids,))
+    cur.execute("DELETE FROM products WHERE id = ANY(%s)", (product_ids,))
+
+
+class Cashier:
+    # یک صندوق‌دار: آپدیت‌ها پشت سر هم و همان‌طور که dispatcher اجرا می‌کند به process_update داده می‌شوند
+    _update_ids = iter(range(1, 1 << 62))
+
+    def __init__(self, api, chat_id, customer_id, product_ids, samples):
+        self.api = api
+        self.chat_id = chat_id
+        self.customer_id = customer_id
+        self.product_ids = product_ids
+        self.samples = samples      # step -> [(seconds, queries)]
+        self.updates = 0
+
+    def _run(self, step, update):
+        update["update_id"] = next(self._update_ids)
+        update = telebot.types.Update.de_json(update)
+        queries = app.query_count()
+        start = time.perf_counter()
+        app.process_update(update)
+        elapsed = time.perf_counter() - start
+        self.samples.setdefault(step, []).append((elapsed, app.query_count() - queries))
+        self.updates += 1
+        return self.api.last_message(self.chat_id)
+
+    def _user(self):
+        return {"id": self.chat_id, "is_bot": False, "first_name": "bench"}
+
+    def send(self, step, text):
+        return self._run(step, {"message": {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": self.chat_id, "type": "private"}, "from": self._user()}})
+
+    def press(self, step, data):
+        return self._run(step, {"callback_query": {
+            "id": str(self.updates), "chat_instance": "bench", "data": data, "from": self._user(),
+            "message": {"message_id": 1, "date": int(time.time()), "text": "",
+                        "chat": {"id": self.chat_id, "type": "private"}}}})
+
+    def login(self):
+        self.send("cmd_start", "/start")
+        self.send("ask_username", "ورود به سیستم")
+        self.send("process_username", app.ADMIN_USERNAME)
+        self.send("process_password", app.ADMIN_PASSWORD)
+
+    def round(self, n):
+        pids = self.product_ids
+        self.send("start_order", "ثبت سفارش")
+        self.send("select_customer_start", "انتخاب مشتری")
+        self.send("select_customer_process", str(self.customer_id))
+        items = ", ".join(f"{pids[(n + i) % len(pids)]}x{1 + i % 3}" for i in range(3))
+        self.send("add_order_item", items)
+        self.send("add_order_item", str(pids[(n + 3) % len(pids)]))
+        self.send("add_order_item_quantity", "2")
+        # یک آیتم هم با انتخابگر inline (کیبوردهای کش‌شده)
+        reply = self.press("callback_picker", f"pk:p:{pids[(n + 4) % len(pids)]}")
+        buttons = [b.get("callback_data", "") for row in (reply["reply_markup"] or {}).get("inline_keyboard", []) for b in row]
+        tap = next((d for d in buttons if d.startswith("pk:q:")), None)
+        if tap:
+            self.press("callback_picker", tap)
+        reply = self.send("save_order", "done")
+        order_id = next((line.split(":", 1)[1].strip() for line in reply["text"].splitlines()
+                         if line.startswith("کد سفارش:")), None)
+        self.send("view_orders_menu", "مشاهده سفارش‌ها")
+        reply = self.send("list_orders", "لیست سفارش‌ها")
+        buttons = [b.get("callback_data", "") for row in (reply["reply_markup"] or {}).get("inline_keyboard", []) for b in row]
+        older = next((d for d in buttons if d.startswith("ordp:") and ":n:" in d), None)
+        if older:
+            self.press("callback_orders_page", older)
+        if order_id:
+            self.send("search_order_start", "جستجوی سفارش")
+            self.send("search_order_by_id", order_id)
+            self.send("change_order_status_prompt", "تغییر وضعیت")
+            self.send("change_order_status", "served")
+
+
+def run_cashiers(args):
+    api = FakeTelegramAPI(args.api_latency / 1000.0)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    telebot.apihelper.API_URL = api.url
+    app.migrate()
+    conn = psycopg2.connect(app.DB_URI)
+    cur = conn.cursor()
+    product_ids, customer_ids = seed(cur, args.cashiers, args.products)
+    conn.commit()
+    samples = {}
+    cashiers = [Cashier(api, 300000 + i, customer_ids[i], product_ids, {}) for i in range(args.cashiers)]
+    errors = []
+
+    def worker(c):
+        try:
+            c.login()
+            for n in range(args.rounds):
+                c.round(n)
+        except Exception as e:
+            errors.append(repr(e))
+
+    try:
+        threads = [threading.Thread(target=worker, args=(c,)) for c in cashiers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        cleanup(cur, product_ids, customer_ids)
+        conn.commit()
+        conn.close()
+        api.shutdown()
+    for c in cashiers:
+        for step, values in c.samples.items():
+            samples.setdefault(step, []).extend(values)
+    updates = sum(c.updates for c in cashiers)
+    steps = {}
+    for step, values in samples.items():
+        ms = [v[0] * 1000 for v in values]
+        steps[step] = {"n": len(ms), "p50": percentile(ms, 50), "p95": percentile(ms, 95), "p99": percentile(ms, 99),
+                       "mean": statistics.mean(ms), "queries": statistics.mean(v[1] for v in values)}
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip(),
+        "args": {"cashiers": args.cashiers, "rounds": args.rounds, "products": args.products,
+                 "api_latency_ms": args.api_latency, "pool_max": app.DB_POOL_MAX},
+        "updates": updates,
+        "elapsed": elapsed,
+        "throughput": updates / elapsed,
+        "queries_per_update": sum(s["queries"] * s["n"] for s in steps.values()) / max(updates, 1),
+        "api_calls": api.calls,
+        "pool": app.get_pool().stats(),
+        "errors": errors,
+        "steps": steps,
+    }
+
+
+def print_steps(result):
+    print(f"{'step':<28} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'queries':>8}")
+    for step, s in sorted(result["steps"].items(), key=lambda kv: -kv[1]["p95"]):
+        print(f"{step:<28} {s['n']:>6} {s['p50']:>7.2f}ms {s['p95']:>7.2f}ms {s['p99']:>7.2f}ms {s['queries']:>8.1f}")
+    print(f"{result['updates']} updates in {result['elapsed']:.2f}s — {result['throughput']:.0f} updates/s — "
+          f"{result['queries_per_update']:.2f} queries/update")
+
+
+def bench_cashiers(args):
+    if args.temp_cluster:
+        with temp_cluster() as uri:
+            app.DB_URI = uri
+            result = run_cashiers(args)
+    else:
+        result = run_cashiers(args)
+    print_steps(result)
+    for e in result["errors"]:
+        print("error:", e)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = args.output or os.path.join(RESULTS_DIR, f"cashiers-{time.strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'nogit'}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved {path}")
+
+
+def bench_compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def delta(a, b):
+        return f"{(b - a) / a * 100:+6.1f}%" if a else "     -"
+
+    print(f"{'step':<28} {'p50':>18} {'p95':>18} {'queries':>12}")
+    for step in sorted(set(base["steps"]) | set(new["steps"])):
+        a, b = base["steps"].get(step), new["steps"].get(step)
+        if not a or not b:
+            print(f"{step:<28} {'only in ' + ('new' if b else 'base'):>18}")
+            continue
+        print(f"{step:<28} {b['p50']:>8.2f}ms {delta(a['p50'], b['p50'])} {b['p95']:>8.2f}ms {delta(a['p95'], b['p95'])} "
+              f"{a['queries']:>5.1f}->{b['queries']:<5.1f}")
+    print(f"throughput: {base['throughput']:.0f} -> {new['throughput']:.0f} updates/s {delta(base['throughput'], new['throughput'])}")
+    print(f"queries/update: {base['queries_per_update']:.2f} -> {new['queries_per_update']:.2f}")
+
+
+# ---------- router ----------
+def text_message(text, chat_id=1):
+    return telebot.types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "bench"}})
+
+
+def time_dispatch(bot, message, iterations):
+    # process_new_messages همان مسیری است که process_update برای هر پیام طی می‌کند
+    start = time.perf_counter()
+    for _ in range(iterations):
+        bot.process_new_messages([message])
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_router(args):
+    # فیلترهای lambda به ترتیب ثبت امتحان می‌شوند؛ Router با یک lookup در dict
+    def noop(m):
+        pass
+
+    print(f"{'routes':>7} {'target':<9} {'lambda filters':>15} {'router':>10}")
+    for n in args.sizes:
+        texts = [f"menu item {i}" for i in range(n)]
+        linear = telebot.TeleBot("0:bench", threaded=False)
+        for t in texts:
+            linear.message_handler(func=lambda m, t=t: m.text == t)(noop)
+        linear.message_handler(func=lambda m: True)(noop)
+        router = app.Router()
+        for t in texts:
+            router.text(t, login=False)(noop)
+        router.default(noop)
+        routed = telebot.TeleBot("0:bench", threaded=False)
+        routed.register_message_handler(router.dispatch_message)
+        for label, text in (("first", texts[0]), ("last", texts[-1]), ("fallback", "unknown")):
+            message = text_message(text)
+            a = time_dispatch(linear, message, args.iterations)
+            b = time_dispatch(routed, message, args.iterations)
+            print(f"{n:>7} {label:<9} {a * 1e6:>13.1f}µs {b * 1e6:>8.1f}µs")
+
+
+# ---------- receipts ----------
+def synthetic_receipt(i, items):
+    return {'id': i, 'date': '2026-01-01 12:00', 'customer': 'مشتری بنچمارک', 'status': 'pending',
+            'total': 12.5 * 2 * items, 'title': app.RECEIPT_TITLE, 'qr': app.RECEIPT_QR.format(id=i),
+            'items': [(f'محصول بنچمارک {n}', 2, 12.5) for n in range(items)]}
+
+
+def bench_receipts(args):
+    # رسیدهای متفاوت (بدون کش) یک بار در همین پروسه و سپس با ProcessPoolExecutor با تعداد پروسهٔ مختلف
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    batch = [synthetic_receipt(i, args.items) for i in range(args.count)]
+    t0 = time.perf_counter()
+    for r in batch[:max(1, args.count // 4)]:
+        app.receipts.render_receipt(r, args.format, app.RECEIPT_FONT)
+    inline = max(1, args.count // 4) / (time.perf_counter() - t0)
+    print(f"{'inline':<10} {inline:8.1f} receipts/s")
+    for workers in args.workers:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # گرم کردن: راه‌اندازی پروسه‌ها و بارگذاری فونت در زمان اندازه‌گیری حساب نشود
+            list(pool.map(app.receipts.render_receipt, batch[:workers], [args.format] * workers, [app.RECEIPT_FONT] * workers))
+            t0 = time.perf_counter()
+            sizes = list(pool.map(app.receipts.render_receipt, batch, [args.format] * len(batch),
+                                  [app.RECEIPT_FONT] * len(batch), chunksize=4))
+            elapsed = time.perf_counter() - t0
+        rate = args.count / elapsed
+        print(f"workers={workers:<2} {rate:8.1f} receipts/s  {rate / workers:8.1f}/s per core  "
+              f"avg {sum(len(s) for s in sizes) / len(sizes) / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="بنچمارک‌های ربات صندوق کافه")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("save_order", help="مقایسهٔ ثبت سفارش N+1 و دسته‌ای")
+    p.add_argument("--rounds", type=int, default=50)
+    p.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100])
+    p.set_defaults(func=bench_save_order, needs_db=True)
+    p = sub.add_parser("export", help="خروجی CSV از سفارش‌های مصنوعی")
+    p.add_argument("--orders", type=int, default=1000000)
+    p.set_defaults(func=bench_export, needs_db=True)
+    p = sub.add_parser("webhook", help="ارسال آپدیت‌های ضبط‌شده یا مصنوعی به سرور وب‌هوک")
+    p.add_argument("--url", default="http://127.0.0.1:8443/webhook")
+    p.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET"))
+    p.add_argument("--file", help="فایل JSON lines از آپدیت‌های ضبط‌شده")
+    p.add_argument("--count", type=int, default=10000)
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--rate", type=float, default=2000, help="درخواست در ثانیه (0 = بدون محدودیت)")
+    p.add_argument("--threads", type=int, default=16)
+    p.set_defaults(func=bench_webhook)
+    p = sub.add_parser("cashiers", help="سناریوی چند صندوق‌دار همزمان با API جعلی تلگرام")
+    p.add_argument("--cashiers", type=int, default=8)
+    p.add_argument("--rounds", type=int, default=20, help="تعداد سفارش هر صندوق‌دار")
+    p.add_argument("--products", type=int, default=50)
+    p.add_argument("--api-latency", type=float, default=0.0, help="تأخیر شبیه‌سازی‌شدهٔ هر فراخوانی API (ms)")
+    p.add_argument("--temp-cluster", action="store_true", help="اجرا روی کلاستر موقت initdb")
+    p.add_argument("--output", help="مسیر فایل نتیجه (پیش‌فرض: bench_results/)")
+    p.set_defaults(func=bench_cashiers, needs_db=True)
+    p = sub.add_parser("compare", help="مقایسهٔ دو نتیجهٔ ذخیره‌شدهٔ cashiers")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.set_defaults(func=bench_compare)
+    p = sub.add_parser("router", help="هزینهٔ مسیریابی پیام: فیلترهای lambda در برابر Router")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    p.add_argument("--iterations", type=int, default=2000)
+    p.set_defaults(func=bench_router)
+    p = sub.add_parser("receipts", help="رندر رسید در ProcessPoolExecutor: رسید در ثانیه به ازای هر هسته")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--count", type=int, default=400)
+    p.add_argument("--items", type=int, default=8, help="تعداد آیتم هر رسید")
+    p.add_argument("--format", choices=["png", "pdf"], default="png")
+    p.set_defaults(func=bench_receipts)
+    args = parser.parse_args()
+    if getattr(args, "needs_db", False) and not app.DB_URI and not getattr(args, "temp_cluster", False):
+        sys.exit("DB_URI تنظیم نشده است.")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# receipts.py — رندر رسید سفارش (PNG یا PDF) با Pillow و qrcode
+# فقط توابع خالص و بدون وابستگی به app که در پروسه‌های spawn از ProcessPoolExecutor اجرا می‌شوند.
+# spawn در هر پروسه ماژول __main__ والد (app.py یا bench.py) را هم دوباره import می‌کند؛ کد سطح ماژول
+# آن‌ها فقط شیء می‌سازد (بدون ترد، اتصال DB یا چاپ) و راه‌اندازی ربات زیر if __name__ == '__main__' است
+import io
+import qrcode
+from PIL import Image, ImageDraw, ImageFont, features
+
+WIDTH = 576        # عرض کاغذ چاپگر حرارتی 80mm در 203dpi
+MARGIN = 24
+DPI = 203
+# بدون libraqm حروف فارسی به هم نمی‌چسبند و جهت راست‌به‌چپ اعمال نمی‌شود
+RTL = {'direction': 'rtl'} if features.check('raqm') else {}
+
+_fonts = {}
+
+def _font(path, size):
+    # فونت‌ها در هر پروسه یک بار بارگذاری می‌شوند
+    key = (path, size)
+    font = _fonts.get(key)
+    if font is None:
+        try:
+            font = ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
+        except OSError:
+            font = ImageFont.load_default(size)
+        _fonts[key] = font
+    return font
+
+def _fit(draw, text, font, width):
+    # کوتاه کردن متن تا در width پیکسل جا شود
+    if draw.textlength(text, font=font, **RTL) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font, **RTL) > width:
+        text = text[:-1]
+    return text + "…"
+
+def render_receipt(receipt, fmt='png', font_path=None):
+    # receipt: {'id', 'date', 'customer', 'status', 'total', 'qr', 'title', 'items': [(name, qty, price), ...]}
+    # خروجی bytes فایل png یا pdf
+    body, big = _font(font_path, 24), _font(font_path, 32)
+    qr = qrcode.QRCode(border=1, box_size=6)
+    qr.add_data(receipt['qr'])
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white").get_image().convert('L')
+    line, big_line = 34, 46
+    height = MARGIN * 2 + big_line * 2 + line * (5 + len(receipt['items'])) + 20 * 2 + 16 + qr_img.height
+    img = Image.new('L', (WIDTH, height), 255)
+    draw = ImageDraw.Draw(img)
+    right, left, y = WIDTH - MARGIN, MARGIN, MARGIN
+
+    def rtl(text, font, y, x=right, anchor='ra'):
+        draw.text((x, y), text, font=font, fill=0, anchor=anchor, **RTL)
+
+    def rule(y):
+        draw.line((left, y + 8, right, y + 8), fill=0, width=2)
+        return y + 20
+
+    rtl(receipt['title'], big, y, WIDTH // 2, 'ma')
+    y += big_line
+    rtl(f"سفارش #{receipt['id']}", body, y)
+    draw.text((left, y), receipt['date'], font=body, fill=0)
+    y += line
+    rtl(f"مشتری: {receipt['customer'] or 'مشتری ناشناس'}", body, y)
+    y += line
+    rtl(f"وضعیت: {receipt['status']}", body, y)
+    y += line
+    y = rule(y)
+    for name, qty, price in receipt['items']:
+        amount = f"{qty} x {price:.2f} = {qty * price:.2f}"
+        amount_width = draw.textlength(amount, font=body)
+        draw.text((left, y), amount, font=body, fill=0)
+        rtl(_fit(draw, name or 'محصول حذف شده', body, right - left - amount_width - 16), body, y)
+        y += line
+    y = rule(y)
+    rtl(f"مجموع: {receipt['total']:.2f} تومان", big, y)
+    y += big_line + line
+    img.paste(qr_img, ((WIDTH - qr_img.width) // 2, y))
+    y += qr_img.height + 16
+    rtl(f"کد سفارش: {receipt['id']}", body, y, WIDTH // 2, 'ma')
+    buf = io.BytesIO()
+    if fmt == 'pdf':
+        img.save(buf, 'PDF', resolution=DPI)
+    else:
+        img.save(buf, 'PNG', optimize=False)
+    return buf.getvalue()